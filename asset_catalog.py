@@ -0,0 +1,64 @@
+import os
+import re
+from collections import namedtuple
+from typing import Dict, Iterable, List
+
+AssetEntry = namedtuple('AssetEntry', ['chart_id', 'audio_path', 'audio_ext', 'audio_size', 'audio_mtime', 'sprite_path'])
+
+_AUDIO_RE = re.compile(r'^music_chart_(.+)(\.ogg|\.wav)$')
+_SPRITE_RE = re.compile(r'^song_(.+)_0\.png$')
+
+# 同一曲目同时有ogg和wav时优先ogg, 与逐个exists检查时的顺序一致
+_AUDIO_PRIORITY = {'.ogg': 0, '.wav': 1}
+
+
+def _scan(directory, pattern):
+    found = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                m = pattern.match(entry.name)
+                if m and entry.is_file():
+                    found.setdefault(m.group(1), []).append((entry, m))
+    except FileNotFoundError:
+        pass
+    return found
+
+
+class AssetCatalog:
+    """对audiogroup_default/和Sprites/各做一次scandir, 之后按chart_id查询不再产生stat调用"""
+
+    def __init__(self, audio_dir, sprite_dir):
+        self.audio_dir = audio_dir
+        self.sprite_dir = sprite_dir
+        self.entries: Dict[str, AssetEntry] = {}
+        self.sprites: Dict[str, str] = {}
+        self.refresh()
+
+    def refresh(self):
+        sprites = {chart_id: matches[0][0].path for chart_id, matches in _scan(self.sprite_dir, _SPRITE_RE).items()}
+        entries = {}
+        for chart_id, matches in _scan(self.audio_dir, _AUDIO_RE).items():
+            entry, m = min(matches, key=lambda em: _AUDIO_PRIORITY[em[1].group(2)])
+            st = entry.stat()
+            entries[chart_id] = AssetEntry(chart_id, entry.path, m.group(2), st.st_size, st.st_mtime,
+                                           sprites.get(chart_id))
+        self.entries = entries
+        self.sprites = sprites
+
+    def get(self, chart_id):
+        # 没有音频时返回None
+        return self.entries.get(chart_id)
+
+    def sprite(self, chart_id):
+        return self.sprites.get(chart_id)
+
+    def missing_report(self, chart_ids: Iterable[str]) -> Dict[str, List[str]]:
+        chart_ids = sorted(set(chart_ids))
+        return {
+            "audio": [c for c in chart_ids if c not in self.entries],
+            "sprite": [c for c in chart_ids if c not in self.sprites],
+        }
+
+    def __len__(self):
+        return len(self.entries)
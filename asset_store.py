@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from typing import Optional
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+INDEX_NAME = "index.sqlite"
+_HASH_CHUNK = 1 << 20
+
+
+class AssetStore:
+    """内容寻址的资源缓存: 键为源文件哈希加生成参数, 对象按最近使用时间淘汰
+
+    源文件的哈希按(路径, 大小, mtime)记在索引中, 源文件不变时不会重新读取.
+    多个进程可以共用同一个目录.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sources (
+            path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS objects (
+            key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL
+        );
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(root, INDEX_NAME), check_same_thread=False, timeout=30)
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 上限可能比上次小
+        self.evict()
+
+    def _object_path(self, key):
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def source_digest(self, path) -> str:
+        st = os.stat(path)
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime_ns, digest FROM sources WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                               (path, st.st_size, st.st_mtime_ns, digest))
+            self._conn.commit()
+        return digest
+
+    @staticmethod
+    def make_key(kind, sources, params=None) -> str:
+        # sources为源文件哈希(缺失的源用None), params为影响输出的生成参数
+        payload = json.dumps([kind, list(sources), params or {}], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key) -> Optional[str]:
+        path = self._object_path(key)
+        with self._lock:
+            found = self._conn.execute("UPDATE objects SET last_used = ? WHERE key = ?", (time.time(), key)).rowcount
+            self._conn.commit()
+            if found and os.path.exists(path):
+                self.hits += 1
+                return path
+            self.misses += 1
+        return None
+
+    def put(self, key, produce) -> str:
+        """produce(临时路径)写出对象内容; 写完后原子地放入缓存"""
+        path = self._object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            produce(tmp_path)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)", (key, size, time.time()))
+            self._conn.commit()
+        self.evict(keep=key)
+        return path
+
+    def put_file(self, key, src_path) -> str:
+        return self.put(key, lambda tmp_path: shutil.copyfile(src_path, tmp_path))
+
+    @staticmethod
+    def link(path, dst):
+        # 同一文件系统上硬链接, 否则复制; 缓存对象只读, 共用inode是安全的
+        try:
+            os.link(path, dst)
+        except OSError:
+            shutil.copyfile(path, dst)
+
+    def fetch_cached(self, key, dst) -> bool:
+        """缓存中有key时链接到dst并返回True"""
+        path = self.get(key)
+        if path is None:
+            return False
+        try:
+            self.link(path, dst)
+        except FileNotFoundError:
+            # 刚被其它进程淘汰
+            return False
+        return True
+
+    def fetch(self, key, dst, produce) -> bool:
+        """把key对应的对象放到dst, 缓存中没有时先用produce生成; 返回是否命中"""
+        if self.fetch_cached(key, dst):
+            return True
+        self.link(self.put(key, produce), dst)
+        return False
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def evict(self, keep=None):
+        # keep: 刚放入、马上要链接的对象, 即使超出上限也暂不淘汰
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for key, size in self._conn.execute("SELECT key, size FROM objects ORDER BY last_used"):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                victims.append(key)
+                total -= size
+            self._conn.executemany("DELETE FROM objects WHERE key = ?", [(k,) for k in victims])
+            self._conn.commit()
+        # 已链接到staging的文件不受影响
+        for key in victims:
+            try:
+                os.remove(self._object_path(key))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
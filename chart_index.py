@@ -0,0 +1,184 @@
+import os
+import sys
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List
+
+import numpy as np
+
+from vsb_parser import read_vsb_notes
+from vsd_parser import VSDParser
+from vsb_stats import note_arrays, DENSITY_WINDOW
+from vsb2pez import CHARTS_DIR, DIFFICULTY_MAP, find_lint_targets
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SONG_INFO_BIN_PATH = os.path.join(BASE_DIR, "song_information.bin")
+INDEX_PATH = os.path.join(BASE_DIR, "chart_index.npz")
+
+LEVELS = {name.replace(".json", ""): info["level"] for name, info in DIFFICULTY_MAP.items()}
+
+# 列名 -> dtype, 字符串列在保存时按最长值定宽
+COLUMNS = {
+    "chart_id": str, "difficulty": str, "level": np.int8,
+    "name": str, "artist": str, "display": str, "constant": np.float32, "designer": str,
+    "notes": np.int32, "chips": np.int32, "bumpers": np.int32, "holds": np.int32, "mines": np.int32,
+    "hold_coverage": np.float32, "max_chain": np.int32, "mean_chain": np.float32,
+    "peak_nps": np.float32, "avg_nps": np.float32, "duration": np.float32,
+}
+
+
+def _run_lengths(mask):
+    # 连续True段的长度
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return edges[1::2] - edges[0::2]
+
+
+def compute_chart_row(notes) -> Dict[str, Any]:
+    types, lanes, times = note_arrays(notes)
+    ends = times.copy()
+    hold = types == 2
+    if hold.any():
+        ends[hold] = [float(n['extra'].get('1', n['time'])) for n, h in zip(notes, hold) if h]
+
+    chip = types == 0
+    bumper = (types == 1) | (types == 8)
+    mine = (types == 6) | (types == 7)
+    playable = chip | bumper | hold
+
+    # bumper链: 与convert_vsb_to_notes一致, 在各半区按时间稳定排序后连续的bumper
+    chains = []
+    is_bumper_lane = bumper | (types == 7)
+    half = np.where(is_bumper_lane, lanes, np.where(lanes < 2, 0, 2))
+    for target_half in (0, 2):
+        sel = np.flatnonzero((half == target_half) & (playable | mine))
+        order = sel[np.argsort(times[sel], kind='stable')]
+        chains.append(_run_lengths(bumper[order]))
+    chains = np.concatenate(chains)
+
+    row = {
+        "notes": int(playable.sum()),
+        "chips": int(chip.sum()),
+        "bumpers": int(bumper.sum()),
+        "holds": int(hold.sum()),
+        "mines": int(mine.sum()),
+        "max_chain": int(chains.max()) if len(chains) else 0,
+        "mean_chain": float(chains.mean()) if len(chains) else 0.0,
+    }
+
+    t = np.sort(times[playable]) / 1000
+    if len(t):
+        in_window = np.searchsorted(t, t + DENSITY_WINDOW, side='left') - np.arange(len(t))
+        duration = float(ends[playable].max() / 1000 - t[0])
+        row["peak_nps"] = float(in_window.max() / DENSITY_WINDOW)
+        row["avg_nps"] = len(t) / duration if duration > 0 else 0.0
+        row["duration"] = duration
+    else:
+        row["peak_nps"] = row["avg_nps"] = row["duration"] = 0.0
+
+    # Hold覆盖率: Hold区间并集长度 / 谱面时长
+    if hold.any() and row["duration"] > 0:
+        order = np.argsort(times[hold])
+        starts, stops = times[hold][order], ends[hold][order]
+        reach = np.maximum.accumulate(stops)
+        prev_reach = np.concatenate(([-np.inf], reach[:-1]))
+        covered = np.clip(stops - np.maximum(starts, prev_reach), 0, None)
+        row["hold_coverage"] = float(covered.sum() / 1000 / row["duration"])
+    else:
+        row["hold_coverage"] = 0.0
+    return row
+
+
+def index_chart(chart_id, difficulty, vsb_path):
+    try:
+        row = compute_chart_row(read_vsb_notes(vsb_path))
+    except Exception as e:
+        print(f"  ✗ {chart_id}/{difficulty}: {e}")
+        return None
+    row["chart_id"] = chart_id
+    row["difficulty"] = difficulty
+    return row
+
+
+def load_metadata(path=SONG_INFO_BIN_PATH) -> Dict[str, Dict[str, Any]]:
+    if not os.path.exists(path):
+        print(f"警告: 找不到{path}, 索引中不含曲目信息")
+        return {}
+    records = VSDParser(Path(path)).parse_file()
+    return {r["chart_id"]: r for r in records if "chart_id" in r}
+
+
+def build_index(charts_dir=CHARTS_DIR, song_info_path=SONG_INFO_BIN_PATH, workers=None) -> Dict[str, np.ndarray]:
+    metadata = load_metadata(song_info_path)
+    targets = find_lint_targets(charts_dir)
+    rows = []
+    if targets:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = [r for r in pool.map(index_chart, *zip(*targets), chunksize=16) if r is not None]
+
+    for row in rows:
+        level = LEVELS[row["difficulty"]]
+        info = metadata.get(row["chart_id"], {})
+        row["level"] = level
+        row["name"] = info.get("formatted_name", "")
+        row["artist"] = info.get("artist", "")
+        row["display"] = info.get(f"difficulty_display_{level}", "")
+        row["constant"] = info.get(f"difficulty_constant_{level}", 0.0)
+        row["designer"] = info.get(f"note_designer_{level}", "")
+
+    return {name: np.array([row[name] for row in rows], dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def save_index(columns, path=INDEX_PATH):
+    np.savez_compressed(path, **columns)
+
+
+def load_index(path=INDEX_PATH) -> Dict[str, np.ndarray]:
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def query(columns, sort_by, limit=20, difficulty=None, descending=True) -> List[Dict[str, Any]]:
+    mask = np.ones(len(columns["chart_id"]), dtype=bool)
+    if difficulty:
+        mask &= columns["difficulty"] == difficulty.upper()
+    idx = np.flatnonzero(mask)
+    order = np.argsort(columns[sort_by][idx], kind='stable')
+    if descending:
+        order = order[::-1]
+    return [{name: columns[name][i].item() for name in columns} for i in idx[order[:limit]]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="全曲库谱面统计索引")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("build", help="解码所有.vsb并生成索引")
+    top = sub.add_parser("top", help="按某一列排序查询")
+    top.add_argument("column", choices=[c for c, t in COLUMNS.items() if t is not str])
+    top.add_argument("-n", type=int, default=20)
+    top.add_argument("--difficulty", help="如 FINALE")
+    top.add_argument("--asc", action="store_true")
+    parser.add_argument("--index", default=INDEX_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        if not os.path.isdir(CHARTS_DIR):
+            print(f"错误: 找不到Charts目录: {CHARTS_DIR}")
+            return 1
+        columns = build_index()
+        save_index(columns, args.index)
+        print(f"索引 {len(columns['chart_id'])} 个谱面 -> {args.index}")
+        return 0
+
+    if not os.path.exists(args.index):
+        print(f"错误: 找不到索引 {args.index}, 请先运行 build")
+        return 1
+    columns = load_index(args.index)
+    for row in query(columns, args.column, args.n, args.difficulty, not args.asc):
+        print(f"  {row[args.column]:>10.3f}  {row['chart_id']}/{row['difficulty']}  {row['name']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
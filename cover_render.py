@@ -0,0 +1,240 @@
+import os
+import zlib
+import hashlib
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from asset_store import AssetStore
+
+# 封面合成参数, 也是资源缓存键的一部分
+COVER_SIZE = (300, 300)
+COVER_OFFSET_DIVISORS = (15, 2)
+
+# compress_type为zlib策略, None时使用Pillow的默认值; colors不为None时量化为调色板PNG;
+# background_scale<1时整张图缩小后再编码
+CoverProfile = namedtuple('CoverProfile', ['compress_level', 'compress_type', 'colors', 'background_scale'])
+
+COVER_PROFILES = {
+    # 与之前的输出逐字节相同
+    "legacy": CoverProfile(6, None, None, 1.0),
+    # 无损; 插画底图用Z_RLE编码快约3倍, 大小基本不变
+    "fast": CoverProfile(6, zlib.Z_RLE, None, 1.0),
+    # 量化为256色, 约为原来的1/5, 渐变处可能出现色带
+    "small": CoverProfile(9, None, 256, 1.0),
+    "compact": CoverProfile(9, None, 256, 0.5),
+}
+DEFAULT_COVER_PROFILE = "fast"
+
+
+def get_cover_profile(profile=None) -> CoverProfile:
+    # 接受档位名或CoverProfile
+    if profile is None:
+        profile = DEFAULT_COVER_PROFILE
+    if isinstance(profile, CoverProfile):
+        return profile
+    if profile not in COVER_PROFILES:
+        raise ValueError(f"未知封面档位: {profile}")
+    return COVER_PROFILES[profile]
+
+
+def cover_image_size(base_size, profile=None):
+    # 按档位编码后的封面尺寸
+    profile = get_cover_profile(profile)
+    if profile.background_scale >= 1:
+        return tuple(base_size)
+    return tuple(max(1, round(n * profile.background_scale)) for n in base_size)
+
+
+def load_sprite(sprite_path, size=COVER_SIZE):
+    """按size最近邻缩放的RGBA曲绘
+
+    JPEG等支持draft的格式按不小于size的尺寸解码; 先在原始模式下缩放再转RGBA, 只转换缩放后的像素,
+    结果与先转换再缩放相同.
+    """
+    image = Image.open(sprite_path)
+    image.draft(image.mode, size)
+    return image.resize(size, Image.NEAREST).convert("RGBA")
+
+
+def compose_cover(base, sprite_path, warnings=None):
+    # 曲绘贴到base上(原地修改), 返回是否按预期合成
+    if not sprite_path:
+        return True
+    try:
+        cover = load_sprite(sprite_path)
+        base_w, base_h = base.size
+        offset_x = (base_w - COVER_SIZE[0]) // COVER_OFFSET_DIVISORS[0]
+        offset_y = (base_h - COVER_SIZE[1]) // COVER_OFFSET_DIVISORS[1]
+        base.paste(cover, (offset_x, offset_y), cover)
+    except Exception as e:
+        if warnings is None:
+            print(f"警告: 封面处理失败 {sprite_path}: {e}")
+        else:
+            warnings.append(f"封面处理失败 {sprite_path}: {e}")
+        return False
+    return True
+
+
+def encode_cover(image, output, profile=None):
+    profile = get_cover_profile(profile)
+    size = cover_image_size(image.size, profile)
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    if profile.colors:
+        image = image.quantize(profile.colors, method=Image.Quantize.FASTOCTREE)
+    options = {"compress_level": profile.compress_level}
+    if profile.compress_type is not None:
+        options["compress_type"] = profile.compress_type
+    image.save(output, "PNG", **options)
+
+
+def render_cover(base, sprite_path, output_png_path, warnings=None, profile=None):
+    # 返回封面是否按预期合成, 失败时只输出底图
+    ok = compose_cover(base, sprite_path, warnings)
+    encode_cover(base, output_png_path, profile)
+    return ok
+
+
+class _RenderFailed(Exception):
+    pass
+
+
+class CoverRenderer:
+    """每张曲绘只合成、编码一次, 同一曲目的各难度链接同一个文件; render_many在线程池中批量渲染
+
+    有AssetStore时结果放进缓存(键由key_func给出); 否则放在cache_dir中, 没有给出时在work_dir下建临时目录,
+    close时删除. 两者都没有时不缓存, 每次直接渲染. 合成失败的结果不缓存.
+    """
+
+    def __init__(self, base_image, profile=None, store=None, key_func=None, cache_dir=None, work_dir=None):
+        self.base_image = base_image
+        self.profile = get_cover_profile(profile)
+        self.store = store
+        self._key_func = key_func
+        self.cache_dir = cache_dir
+        self._work_dir = work_dir
+        self._owns_dir = False
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # 正在使用的转换数; retire之后最后一个使用者release时才close
+        self._users = 0
+        self._retired = False
+
+    def acquire(self):
+        with self._lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            done = self._retired and self._users == 0
+        if done:
+            self.close()
+
+    def retire(self):
+        """不再交给新的使用者; 进行中的使用都release后close"""
+        with self._lock:
+            self._retired = True
+            done = self._users == 0
+        if done:
+            self.close()
+
+    @property
+    def caching(self):
+        return self.store is not None or self.cache_dir is not None or self._work_dir is not None
+
+    def _key(self, sprite_path):
+        if self.store is not None:
+            return self._key_func(sprite_path)
+        # 与NoteCache一样带上mtime和大小, 曲绘被修改后自然失效; 底图只在reload时变化, 届时整个渲染器重建
+        try:
+            st = os.stat(sprite_path) if sprite_path else None
+        except OSError:
+            st = None
+        stamp = (st.st_mtime_ns, st.st_size) if st else None
+        return hashlib.sha256(repr((sprite_path, stamp, tuple(self.profile))).encode('utf-8')).hexdigest()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _dir(self):
+        with self._lock:
+            if self.cache_dir is None:
+                os.makedirs(self._work_dir, exist_ok=True)
+                self.cache_dir = tempfile.mkdtemp(prefix=".covers-", dir=self._work_dir)
+                self._owns_dir = True
+            return self.cache_dir
+
+    def shared_dir(self):
+        # 交给其它进程的cache_dir; 有AssetStore时各进程直接共用缓存
+        return None if self.store is not None else self._dir()
+
+    def _render_to(self, sprite_path, warnings):
+        def produce(tmp_path):
+            if not render_cover(self.base_image.copy(), sprite_path, tmp_path, warnings, self.profile):
+                raise _RenderFailed
+        return produce
+
+    def ensure(self, sprite_path, warnings=None):
+        """返回缓存中的封面路径, 没有时先渲染; 合成失败时返回None"""
+        key = self._key(sprite_path)
+        produce = self._render_to(sprite_path, warnings)
+        with self._key_lock(key):
+            try:
+                if self.store is not None:
+                    return self.store.get(key) or self.store.put(key, produce)
+
+                path = os.path.join(self._dir(), f"{key}.png")
+                if os.path.exists(path):
+                    return path
+                # 多个进程可能共用cache_dir
+                tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+                try:
+                    produce(tmp_path)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                return path
+            except _RenderFailed:
+                return None
+
+    def fetch(self, sprite_path, dst, warnings=None):
+        if self.caching:
+            path = self.ensure(sprite_path, warnings)
+            if path is not None:
+                try:
+                    AssetStore.link(path, dst)
+                    return
+                except FileNotFoundError:
+                    # 刚被其它进程淘汰
+                    pass
+            else:
+                # 警告已在ensure中记录
+                warnings = []
+        # 合成失败时输出底图
+        render_cover(self.base_image.copy(), sprite_path, dst, warnings, self.profile)
+
+    def render_many(self, sprite_paths, workers=None) -> int:
+        """预先渲染, 之后fetch只做链接; 返回合成失败的数量"""
+        if not self.caching:
+            return 0
+        unique = list(dict.fromkeys(sprite_paths))
+        with ThreadPoolExecutor(workers or min(8, os.cpu_count() or 1)) as pool:
+            results = list(pool.map(lambda sprite_path: self.ensure(sprite_path, []), unique))
+        return sum(path is None for path in results)
+
+    def close(self):
+        with self._lock:
+            if self._owns_dir:
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+                self.cache_dir = None
+                self._owns_dir = False
@@ -0,0 +1,288 @@
+import io
+import os
+import sys
+import json
+import argparse
+import tempfile
+import importlib
+from fractions import Fraction
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from vsb_parser import VSBRawConverter, read_vsb_notes
+from vsd_parser import VSDParser
+from vsb2pez import (CHARTS_DIR, convert_vsb_to_notes, iter_notes_time_ordered, build_final_json, write_final_json,
+                     generate_meta_str, find_lint_targets)
+from memory_harness import synthesize_vsb
+from incremental import IncrementalConverter
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SONG_INFO_BIN_PATH = os.path.join(BASE_DIR, "song_information.bin")
+REPORT_PATH = os.path.join(BASE_DIR, "difftest_report.json")
+
+REFERENCE = "reference"
+
+# 阶段 -> {引擎名: 函数}; 每个阶段的reference为当前实现, 其它引擎与它逐项比较
+#   vsb:   .vsb路径 -> 音符列表(extra键为字符串)
+#   vsd:   .bin路径 -> 曲目记录列表
+#   notes: 音符列表 -> RPE音符列表
+#   json:  (meta_str, RPE音符列表) -> 谱面JSON字符串
+ENGINES: Dict[str, Dict[str, Any]] = {"vsb": {}, "vsd": {}, "notes": {}, "json": {}}
+# 输出顺序不要求与参考实现一致的引擎, 结果按多重集合比较
+UNORDERED = set()
+# (阶段, 引擎名) -> 对该引擎输出的额外检查, 返回None或差异; 用于参考实现不提供的性质
+CHECKS = {}
+
+_SONG_INFO = {"formatted_name": "difftest", "artist": "", "jacket_artist": ""}
+_CONTEXT_CHARS = 40
+
+
+def register_engine(stage, name, ordered=True, check=None):
+    """把函数登记为stage的一个实现; 优化后的版本用它接入差分测试"""
+    def decorator(func):
+        ENGINES[stage][name] = func
+        if not ordered:
+            UNORDERED.add((stage, name))
+        if check is not None:
+            CHECKS[(stage, name)] = check
+        return func
+    return decorator
+
+
+def _rpe_beat(time):
+    whole, numerator, denominator = time
+    return whole + Fraction(numerator, denominator)
+
+
+def check_time_order(notes_list) -> Optional[Dict[str, Any]]:
+    """startTime应不减"""
+    previous = None
+    for i, note in enumerate(notes_list):
+        start = _rpe_beat(note["startTime"])
+        if previous is not None and start < previous:
+            return {"index": i, "unordered": f"startTime {note['startTime']} 早于前一个音符"}
+        previous = start
+    return None
+
+
+@register_engine("vsb", REFERENCE)
+def _vsb_reference(vsb_path):
+    return read_vsb_notes(vsb_path)
+
+
+@register_engine("vsb", "vsbjson")
+def _vsb_via_json(vsb_path):
+    # vsb2pez.py实际读的是vsb_parser.py写出的vsbjson
+    converter = VSBRawConverter(vsb_path)
+    converter.read()
+    return json.loads(json.dumps(converter.notes, ensure_ascii=False))
+
+
+@register_engine("vsd", REFERENCE)
+def _vsd_reference(bin_path):
+    return VSDParser(Path(bin_path)).parse_file()
+
+
+@register_engine("notes", REFERENCE)
+def _notes_reference(vsb_data):
+    return convert_vsb_to_notes(vsb_data, [])
+
+
+@register_engine("notes", "time_ordered", ordered=False, check=check_time_order)
+def _notes_time_ordered(vsb_data):
+    return list(iter_notes_time_ordered(vsb_data, []))
+
+
+@register_engine("notes", "incremental")
+def _notes_incremental(vsb_data):
+    # 先把每7个音符中的一个换成不参与转换的音符, 再逐个改回来
+    placeholder = {"type": -1, "lane": 0, "time": 0, "extra": {}}
+    converter = IncrementalConverter([placeholder if i % 7 == 3 else note for i, note in enumerate(vsb_data)],
+                                     collect_issues=True)
+    for i in range(3, len(vsb_data), 7):
+        converter.update({i: vsb_data[i]})
+    return converter.notes()
+
+
+@register_engine("json", REFERENCE)
+def _json_reference(meta_str, notes_list):
+    return build_final_json(meta_str, notes_list)
+
+
+@register_engine("json", "stream")
+def _json_stream(meta_str, notes_list):
+    buf = io.StringIO()
+    write_final_json(buf, meta_str, iter(notes_list))
+    return buf.getvalue()
+
+
+def _canonical_order(items):
+    return sorted(items, key=lambda item: json.dumps(item, sort_keys=True, default=str))
+
+
+def first_difference(expected, actual) -> Optional[Dict[str, Any]]:
+    """列表按项比较, 字符串按字符比较; 相同时返回None"""
+    if isinstance(expected, str) and isinstance(actual, str):
+        if expected == actual:
+            return None
+        n = min(len(expected), len(actual))
+        pos = next((i for i in range(n) if expected[i] != actual[i]), n)
+        return {
+            "offset": pos,
+            "line": expected.count('\n', 0, pos) + 1,
+            "expected": expected[max(0, pos - _CONTEXT_CHARS):pos + _CONTEXT_CHARS],
+            "actual": actual[max(0, pos - _CONTEXT_CHARS):pos + _CONTEXT_CHARS],
+        }
+
+    if isinstance(expected, list) and isinstance(actual, list):
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            if e != a:
+                diff = {"index": i, "expected": e, "actual": a}
+                if isinstance(e, dict) and isinstance(a, dict):
+                    diff["keys"] = sorted(k for k in e.keys() | a.keys() if e.get(k) != a.get(k))
+                return diff
+        if len(expected) != len(actual):
+            n = min(len(expected), len(actual))
+            return {"index": n, "expected_length": len(expected), "actual_length": len(actual)}
+        return None
+
+    if expected == actual:
+        return None
+    return {"expected": repr(expected)[:200], "actual": repr(actual)[:200]}
+
+
+def _compare(stage, args, engines):
+    # 参考实现出错时整个用例无法比较, 由调用方处理
+    expected = ENGINES[stage][REFERENCE](*args)
+    divergences = {}
+    for name, func in ENGINES[stage].items():
+        if name == REFERENCE or (engines and name not in engines):
+            continue
+        try:
+            actual = func(*args)
+            if (stage, name) in UNORDERED:
+                diff = first_difference(_canonical_order(expected), _canonical_order(actual))
+            else:
+                diff = first_difference(expected, actual)
+            if diff is None and (stage, name) in CHECKS:
+                diff = CHECKS[(stage, name)](actual)
+        except Exception as e:
+            diff = {"error": f"{type(e).__name__}: {e}"}
+        if diff is not None:
+            divergences[name] = diff
+    return expected, divergences
+
+
+def diff_chart(case, vsb_path, stages, engines) -> Dict[str, Any]:
+    # 下游阶段的输入始终取参考实现的输出, 每个引擎只对自己负责的阶段比较
+    report = {"case": case, "divergences": {}}
+    try:
+        vsb_data, report["divergences"]["vsb"] = _compare("vsb", (vsb_path,), engines)
+        if "notes" in stages or "json" in stages:
+            notes_list, report["divergences"]["notes"] = _compare("notes", (vsb_data,), engines)
+        if "json" in stages:
+            meta_str = generate_meta_str(_SONG_INFO, "FINALE.json", 120.0, "0", ".ogg")
+            _, report["divergences"]["json"] = _compare("json", (meta_str, notes_list), engines)
+    except Exception as e:
+        report["error"] = f"参考实现失败: {type(e).__name__}: {e}"
+    report["divergences"] = {s: d for s, d in report["divergences"].items() if s in stages and d}
+    return report
+
+
+def diff_synthetic(note_count, seed, stages, engines) -> Dict[str, Any]:
+    fd, vsb_path = tempfile.mkstemp(suffix=".vsb")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(synthesize_vsb(note_count, seed))
+        return diff_chart(f"synthetic/{note_count}/{seed}", vsb_path, stages, engines)
+    finally:
+        os.remove(vsb_path)
+
+
+def diff_song_information(bin_path, engines) -> Dict[str, Any]:
+    report = {"case": os.path.basename(bin_path), "divergences": {}}
+    try:
+        _, divergences = _compare("vsd", (bin_path,), engines)
+        if divergences:
+            report["divergences"]["vsd"] = divergences
+    except Exception as e:
+        report["error"] = f"参考实现失败: {type(e).__name__}: {e}"
+    return report
+
+
+def _run_case(kind, args):
+    if kind == "chart":
+        return diff_chart(*args)
+    if kind == "synthetic":
+        return diff_synthetic(*args)
+    return diff_song_information(*args)
+
+
+def _import_engine_modules(modules):
+    # 工作进程中也要导入, 引擎才会登记到ENGINES
+    for module in modules:
+        importlib.import_module(module)
+
+
+def run(stages, engines=None, charts_dir=CHARTS_DIR, song_info_path=SONG_INFO_BIN_PATH,
+        synthetic_sizes=(), seeds=1, modules=(), workers=None) -> List[Dict[str, Any]]:
+    stages = set(stages)
+    engines = set(engines) if engines else None
+    cases = []
+    if stages & {"vsb", "notes", "json"}:
+        cases += [("chart", (f"{chart_id}/{difficulty}", path, stages, engines))
+                  for chart_id, difficulty, path in find_lint_targets(charts_dir)]
+        cases += [("synthetic", (size, seed, stages, engines)) for size in synthetic_sizes for seed in range(seeds)]
+    if "vsd" in stages and os.path.exists(song_info_path):
+        cases.append(("vsd", (song_info_path, engines)))
+    if not cases:
+        return []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_import_engine_modules,
+                             initargs=(tuple(modules),)) as pool:
+        return list(pool.map(_run_case, *zip(*cases)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把各阶段的其它实现与参考实现逐项对比")
+    parser.add_argument("--stage", action="append", choices=list(ENGINES), help="默认全部阶段")
+    parser.add_argument("--engine", action="append", help="只比较这些引擎, 默认全部")
+    parser.add_argument("--engine-module", action="append", default=[], help="导入后会登记引擎的模块")
+    parser.add_argument("--synthetic", type=int, nargs="*", default=[200, 2000], help="合成谱面的音符数")
+    parser.add_argument("--seeds", type=int, default=3, help="每个大小生成几个合成谱面")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--report", default=REPORT_PATH)
+    args = parser.parse_args(argv)
+
+    _import_engine_modules(args.engine_module)
+    for stage, engines in ENGINES.items():
+        others = [name for name in engines if name != REFERENCE]
+        print(f"{stage}: {', '.join(others) if others else '(无其它实现)'}")
+
+    results = run(args.stage or list(ENGINES), args.engine, synthetic_sizes=args.synthetic, seeds=args.seeds,
+                  modules=args.engine_module, workers=args.workers)
+    diverged = [r for r in results if r["divergences"] or r.get("error")]
+    for r in diverged:
+        print(f"✗ {r['case']}")
+        if r.get("error"):
+            print(f"    {r['error']}")
+        for stage, engines in r["divergences"].items():
+            for name, diff in engines.items():
+                print(f"    {stage}/{name}: {json.dumps(diff, ensure_ascii=False, default=str)[:300]}")
+
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump({"total": len(results), "diverged": len(diverged), "results": results},
+                  f, indent=2, ensure_ascii=False, default=str)
+
+    print("=" * 60)
+    print(f"差分测试完成: 用例{len(results)} | 一致{len(results) - len(diverged)} | 不一致{len(diverged)}")
+    print(f"报告: {args.report}")
+    print("=" * 60)
+    return 1 if diverged else 0
+
+
+if __name__ == '__main__':
+    # 通过模块名运行, 插件模块import difftest时登记到同一个ENGINES
+    import difftest
+    sys.exit(difftest.main())
@@ -0,0 +1,208 @@
+import sys
+import time
+import random
+import bisect
+import argparse
+from typing import Dict, Iterable, List, Optional
+
+from vsb_parser import read_vsb_notes
+from vsb2pez import _raw_note, _scan_half, convert_vsb_to_notes, load_vsb_data
+
+HALVES = (0, 2)
+_AFTER = float("inf")
+
+
+class _HalfState:
+    """一个半区的转换结果: 排好序的原始音符和按组划分的RPE音符"""
+
+    def __init__(self, target_half, raw_notes, collect_issues=False):
+        self.target_half = target_half
+        self.collect_issues = collect_issues
+        self.raw = raw_notes
+        # 排序键(时间, 序号)与_prepare_raw_notes的稳定排序一致
+        self.keys = [(r[0], r[3]) for r in raw_notes]
+        # 每组第一个音符的排序键、开始前的轨道状态(见_scan_half)、音符数、产生的问题(collect_issues时),
+        # 以及所有组的RPE音符
+        self.group_keys, self.group_states, self.group_sizes, self.group_issues, self.flat = \
+            self._scan(self.raw, self.keys)[:5]
+
+    def _scan(self, raw, keys, start=0, lane_state=None, stop_after=None):
+        """从start处理到stop_after之后的第一个非bumper音符为止, 返回各组的结果和停下的位置"""
+        group_keys, group_states, group_sizes, group_issues, flat = [], [], [], [], []
+        issues = [] if self.collect_issues else None
+        stop = None
+        for pos, state, group in _scan_half(raw, self.target_half, issues, start, lane_state):
+            # 之后的非bumper音符之后的分组与改动前相同
+            if stop_after is not None and pos >= stop_after and raw[pos][1] != 1:
+                stop = pos
+                break
+            group_keys.append(keys[pos])
+            group_states.append(state)
+            group_sizes.append(len(group))
+            flat.extend(note for _, note in group)
+            if issues is not None:
+                group_issues.append(list(issues))
+                issues.clear()
+        return group_keys, group_states, group_sizes, group_issues, flat, stop
+
+    def reconvert(self, removed, added):
+        """removed/added为原始音符; 只重新处理受影响的组, 返回交给commit的结果, 不修改自身"""
+        raw = list(self.raw)
+        keys = list(self.keys)
+        for r in removed:
+            pos = bisect.bisect_left(keys, (r[0], r[3]))
+            del raw[pos], keys[pos]
+        for r in added:
+            pos = bisect.bisect_left(keys, (r[0], r[3]))
+            raw.insert(pos, r)
+            keys.insert(pos, (r[0], r[3]))
+
+        changed = list(removed) + list(added)
+        # 从改动前一组开始: 改动可能接上前一条bumper链, 或是它的尾音符
+        lo = max(0, min(bisect.bisect_left(self.group_keys, (r[0], r[3])) for r in changed) - 1)
+        start = 0 if lo == 0 else bisect.bisect_left(keys, self.group_keys[lo])
+        hi = max(self._affected_until(raw, keys, r) for r in changed)
+
+        *groups, stop = self._scan(raw, keys, start, None if lo == 0 else self.group_states[lo], hi)
+        end = len(self.group_keys) if stop is None else bisect.bisect_left(self.group_keys, keys[stop])
+        count = (len(raw) if stop is None else stop) - start
+        return raw, keys, lo, end, groups, count
+
+    def commit(self, result):
+        raw, keys, lo, end, (new_keys, new_states, new_sizes, new_issues, new_flat), count = result
+        offset = sum(self.group_sizes[:lo])
+        self.flat[offset:offset + sum(self.group_sizes[lo:end])] = new_flat
+        self.group_keys[lo:end] = new_keys
+        self.group_states[lo:end] = new_states
+        self.group_sizes[lo:end] = new_sizes
+        if self.collect_issues:
+            self.group_issues[lo:end] = new_issues
+        self.raw, self.keys = raw, keys
+        return count
+
+    def _affected_until(self, raw, keys, r):
+        # 改动后的列表中, 受r影响的组都从这个位置之前开始
+        pos = bisect.bisect_left(keys, (r[0], r[3]))
+        until = pos + 1
+        time_, typ, lane = r[0], r[1], r[2]
+        if typ == 2:
+            # hold覆盖其结束时间之前的bumper
+            until = max(until, bisect.bisect_right(keys, (r[4], _AFTER)))
+        if typ != 1 and lane - self.target_half in (0, 1):
+            # 之后的bumper链以同一轨道上最后一个非bumper音符为头音符, 直到该轨道出现下一个
+            nxt = pos + 1 if pos < len(keys) and keys[pos] == (time_, r[3]) else pos
+            while nxt < len(raw) and not (raw[nxt][2] == lane and raw[nxt][1] != 1):
+                nxt += 1
+            until = max(until, nxt)
+        return until
+
+
+class IncrementalConverter:
+    """保存一次convert_vsb_to_notes的中间状态, 改动少量音符后只重新处理受影响的bumper链
+
+    bumper的轨道分配只依赖同一半区内的链本身、头音符(各轨道最后一个非bumper音符)、尾音符和覆盖它的hold,
+    因此一次改动只影响附近的几组. 结果与对改动后的vsb_data完整转换相同.
+    """
+
+    def __init__(self, vsb_data, collect_issues=False):
+        """collect_issues为True时非法配置记录到issues()中, 与convert_vsb_to_notes传入issues列表相同; 否则抛出"""
+        self.vsb_data = list(vsb_data)
+        # 每个音符的序号, 删除音符后其余音符的序号不变, 同一时间的音符仍按原顺序排列
+        self._seqs = list(range(len(self.vsb_data)))
+        self._next_seq = len(self.vsb_data)
+        raws = sorted((r for r in (_raw_note(i, n) for i, n in enumerate(self.vsb_data)) if r is not None),
+                      key=lambda x: x[0])
+        self._halves = {half: _HalfState(half, [r for r in raws if r[5] == half], collect_issues)
+                        for half in HALVES}
+
+    def notes(self) -> List[dict]:
+        return self._halves[0].flat + self._halves[2].flat
+
+    def issues(self) -> List[dict]:
+        return [issue for half in HALVES for group in self._halves[half].group_issues for issue in group]
+
+    def update(self, changed: Optional[Dict[int, dict]] = None, removed: Iterable[int] = (),
+               added: Iterable[dict] = ()) -> int:
+        """changed: {索引: 新音符}; removed: 要删除的索引; added: 追加到末尾的音符
+
+        索引都指更新前的vsb_data. 返回重新处理的原始音符数.
+        """
+        changed = changed or {}
+        removed = sorted(set(removed))
+        added = list(added)
+        old_raw = [_raw_note(self._seqs[idx], self.vsb_data[idx]) for idx in list(changed) + removed]
+        new_raw = [_raw_note(self._seqs[idx], note) for idx, note in changed.items()]
+        new_raw += [_raw_note(self._next_seq + i, note) for i, note in enumerate(added)]
+
+        # 两个半区都处理成功后才修改状态, 非法配置抛出异常时状态不变
+        results = {}
+        for half, state in self._halves.items():
+            half_old = [r for r in old_raw if r is not None and r[5] == half]
+            half_new = [r for r in new_raw if r is not None and r[5] == half]
+            if half_old or half_new:
+                results[half] = state.reconvert(half_old, half_new)
+        reconverted = sum(self._halves[half].commit(result) for half, result in results.items())
+
+        for idx, note in changed.items():
+            self.vsb_data[idx] = note
+        for idx in reversed(removed):
+            del self.vsb_data[idx], self._seqs[idx]
+        self.vsb_data += added
+        self._seqs += range(self._next_seq, self._next_seq + len(added))
+        self._next_seq += len(added)
+        return reconverted
+
+
+def _random_edit(rng, vsb_data):
+    # 移动一个音符, 与编辑器中拖动一个音符相同
+    idx = rng.randrange(len(vsb_data))
+    note = dict(vsb_data[idx], time=max(0, vsb_data[idx]['time'] + rng.choice([-50, 50, 200])))
+    if note['type'] == 2:
+        length = int(vsb_data[idx]['extra']['1']) - vsb_data[idx]['time']
+        note['extra'] = dict(note['extra'], **{'1': note['time'] + length})
+    return {idx: note}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="增量重新转换: 随机移动音符, 与完整转换比较结果和耗时")
+    parser.add_argument("chart", help=".vsb谱面或vsb_parser.py写出的vsbjson")
+    parser.add_argument("--edits", type=int, default=200)
+    parser.add_argument("--check-every", type=int, default=20, help="每隔几次改动与完整转换比较一次")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    vsb_data = load_vsb_data(args.chart) if args.chart.endswith('.json') else read_vsb_notes(args.chart)
+    start = time.perf_counter()
+    try:
+        converter = IncrementalConverter(vsb_data)
+    except ValueError as e:
+        print(f"错误: {e}")
+        return 1
+    full = time.perf_counter() - start
+    print(f"{len(vsb_data)} 个音符, 完整转换 {full * 1000:.1f} ms")
+
+    rng = random.Random(args.seed)
+    timings = []
+    for i in range(args.edits):
+        edit = _random_edit(rng, converter.vsb_data)
+        start = time.perf_counter()
+        try:
+            converter.update(edit)
+        except ValueError as e:
+            print(f"  改动{i}产生非法配置, 跳过: {e}")
+            continue
+        timings.append(time.perf_counter() - start)
+        if args.check_every and (i + 1) % args.check_every == 0:
+            if converter.notes() != convert_vsb_to_notes(converter.vsb_data):
+                print(f"✗ 改动{i}后与完整转换不一致")
+                return 1
+
+    timings.sort()
+    if timings:
+        print(f"增量转换 {len(timings)} 次: 中位数 {timings[len(timings) // 2] * 1000:.2f} ms, "
+              f"最大 {timings[-1] * 1000:.2f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
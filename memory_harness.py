@@ -0,0 +1,175 @@
+import os
+import sys
+import gc
+import json
+import random
+import struct
+import argparse
+import tempfile
+import tracemalloc
+from collections import namedtuple
+from typing import Dict, Any, List
+
+from vsb_parser import VSBRawConverter, MAGIC
+from vsb2pez import convert_vsb_to_notes, build_final_json, generate_meta_str
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPORT_PATH = os.path.join(BASE_DIR, "memory_report.json")
+
+DEFAULT_SIZES = (1000, 4000, 8000)
+# 整条流水线峰值的每音符字节预算
+DEFAULT_BUDGET = 16384
+
+STAGES = ("read", "json_notes", "convert", "build_json", "encode")
+
+StageMemory = namedtuple('StageMemory', ['stage', 'peak', 'retained'])
+
+# 生成谱面时的音符类型权重: chip, bumper, hold, mine
+_TYPE_WEIGHTS = ((0, 6), (1, 2), (2, 1), (6, 1))
+
+_SONG_INFO = {"formatted_name": "memory harness", "artist": "", "jacket_artist": ""}
+
+
+def synthesize_vsb(note_count, seed=0) -> bytes:
+    """生成note_count个音符的.vsb, 类型分布与普通谱面相近, 同一seed结果相同"""
+    rng = random.Random(seed)
+    types = [t for t, w in _TYPE_WEIGHTS for _ in range(w)]
+    out = bytearray(MAGIC)
+    out.append(0xC0)
+
+    # BPM音符, 与真实谱面一样放在最前
+    out += b'\xa0\xa2\x03\xa3\x00\xa4' + struct.pack('<f', 0.0) + b'\xa6\xb6\x01' + struct.pack('<f', 132.0) + b'\xa7\xa1'
+
+    t = 1000.0
+    for _ in range(note_count):
+        t += rng.choice((0.0, 113.0, 227.0, 454.0))
+        typ = rng.choice(types)
+        lane = rng.choice((0, 2)) if typ == 1 else rng.randrange(4)
+        out += b'\xa0\xa2' + bytes((typ,)) + b'\xa3' + bytes((lane,)) + b'\xa4' + struct.pack('<f', t)
+        if typ == 2:
+            out += b'\xa6\xb3\x01' + struct.pack('<i', int(t) + rng.choice((227, 454, 908))) + b'\xa7'
+        out.append(0xA1)
+
+    out += b'\xc1\xff'
+    return bytes(out)
+
+
+class MemoryHarness:
+    """按阶段记录一次转换的tracemalloc峰值和阶段结束后仍存活的分配"""
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.stages: List[StageMemory] = []
+        self.peak = 0
+
+    def _measure(self, stage, func, *args):
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = func(*args)
+        current, peak = tracemalloc.get_traced_memory()
+        # reset_peak会清掉之前阶段的峰值, 整体峰值取各阶段的最大值
+        self.peak = max(self.peak, peak)
+        self.stages.append(StageMemory(stage, peak - before, current - before))
+        return result
+
+    def run(self, vsb_path):
+        # 各阶段的结果与实际转换时一样一直持有到最后, 保留量会逐级累积
+        self.stages = []
+        self.peak = 0
+        tracemalloc.start(self.frames)
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+
+            def read():
+                converter = VSBRawConverter(vsb_path)
+                converter.read()
+                return converter
+
+            converter = self._measure("read", read)
+            vsb_data = self._measure("json_notes", converter.json_notes)
+            notes_list = self._measure("convert", convert_vsb_to_notes, vsb_data, [])
+            meta_str = generate_meta_str(_SONG_INFO, "FINALE.json", 120.0, "0", ".ogg")
+            chart_str = self._measure("build_json", build_final_json, meta_str, notes_list)
+            self._measure("encode", str.encode, chart_str, 'utf-8')
+        finally:
+            tracemalloc.stop()
+        return self.peak - start, len(notes_list)
+
+
+def measure_size(note_count, seed=0) -> Dict[str, Any]:
+    fd, vsb_path = tempfile.mkstemp(suffix=".vsb")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(synthesize_vsb(note_count, seed))
+        harness = MemoryHarness()
+        peak, converted = harness.run(vsb_path)
+    finally:
+        os.remove(vsb_path)
+
+    return {
+        "notes": note_count,
+        "converted_notes": converted,
+        "peak": peak,
+        "peak_per_note": peak / note_count,
+        "stages": {s.stage: {"peak": s.peak, "retained": s.retained,
+                             "peak_per_note": s.peak / note_count, "retained_per_note": s.retained / note_count}
+                   for s in harness.stages},
+    }
+
+
+def check_budgets(results, budget, stage_budgets) -> List[str]:
+    problems = []
+    for r in results:
+        if budget and r["peak_per_note"] > budget:
+            problems.append(f"{r['notes']} 音符: 峰值 {r['peak_per_note']:.0f} B/音符 超出预算 {budget}")
+        for stage, limit in stage_budgets.items():
+            per_note = r["stages"][stage]["peak_per_note"]
+            if per_note > limit:
+                problems.append(f"{r['notes']} 音符: {stage} 峰值 {per_note:.0f} B/音符 超出预算 {limit}")
+    return problems
+
+
+def _parse_stage_budget(text):
+    stage, _, limit = text.partition('=')
+    if stage not in STAGES or not limit:
+        raise argparse.ArgumentTypeError(f"格式应为 阶段=字节数, 阶段为 {', '.join(STAGES)}: {text}")
+    try:
+        return stage, float(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"预算不是数字: {text}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="按阶段测量转换的内存峰值, 超出每音符预算时返回非零")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="合成谱面的音符数")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="整体峰值每音符字节数, 0为不检查")
+    parser.add_argument("--stage-budget", type=_parse_stage_budget, action="append", default=[],
+                        metavar="STAGE=BYTES", help="单个阶段峰值的每音符字节数, 可重复")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", default=REPORT_PATH)
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in sorted(args.sizes):
+        r = measure_size(size, args.seed)
+        results.append(r)
+        print(f"{size} 音符: 峰值 {r['peak'] / 1048576:.1f} MiB ({r['peak_per_note']:.0f} B/音符)")
+        for stage in STAGES:
+            s = r["stages"][stage]
+            print(f"  {stage:<10} 峰值 {s['peak_per_note']:>8.0f} B/音符  保留 {s['retained_per_note']:>8.0f} B/音符")
+
+    stage_budgets = dict(args.stage_budget)
+    problems = check_budgets(results, args.budget, stage_budgets)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump({"budget": args.budget, "stage_budgets": stage_budgets, "results": results, "problems": problems},
+                  f, indent=2, ensure_ascii=False)
+
+    for problem in problems:
+        print(f"超出预算: {problem}")
+    print(f"报告: {args.report}")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
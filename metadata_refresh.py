@@ -0,0 +1,184 @@
+import os
+import re
+import sys
+import copy
+import json
+import struct
+import zipfile
+import argparse
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+from vsd_parser import VSDParser
+from vsb2pez import (
+    OUTPUT_DIR, SONG_INFO_PATH, DIFFICULTY_MAP, calculate_id, generate_meta_str, generate_info_txt,
+    get_pez_name, load_song_info, resolve_difficulty,
+)
+from pez_verify import parse_info_txt
+
+SONG_INFO_BIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "song_information.bin")
+
+_META_BLOCK = re.compile(r'   "META" : \{\n.*?\n   \},', re.S)
+_META_DURATION = re.compile(r'"duration" : ([0-9.]+),')
+_LAST_EDIT_TIME = re.compile(r'^LastEditTime: .*$', re.M)
+
+
+def load_records(path) -> Dict[str, Dict[str, Any]]:
+    # song_information.bin或vsd_parser.py写出的song_information.json
+    if str(path).endswith('.json'):
+        return load_song_info(path)
+    return {record["chart_id"]: record for record in VSDParser(Path(path)).parse_file() if "chart_id" in record}
+
+
+def _package_text(record, difficulty):
+    # META和info.txt中只取决于曲目记录的部分; 时长和音频扩展名用固定值, 编辑时间去掉
+    id_str = calculate_id(record["song_id"])
+    return (generate_meta_str(record, difficulty, 0.0, id_str, ".ogg"),
+            _LAST_EDIT_TIME.sub('', generate_info_txt(record, difficulty, id_str, 0.0, ".ogg")))
+
+
+def diff_records(old, new) -> Dict[str, Any]:
+    """返回META或info.txt会变化的(chart_id, 难度)以及新增、删除的曲目"""
+    changed = []
+    for chart_id in sorted(old.keys() & new.keys()):
+        if old[chart_id] == new[chart_id]:
+            continue
+        for difficulty in DIFFICULTY_MAP:
+            if _package_text(old[chart_id], difficulty) != _package_text(new[chart_id], difficulty):
+                changed.append((chart_id, difficulty))
+    return {"changed": changed, "added": sorted(new.keys() - old.keys()), "removed": sorted(old.keys() - new.keys())}
+
+
+def copy_entry_raw(src, info, dst, arcname=None):
+    """把src中的条目按原压缩数据写进dst(以'w'模式打开), 不解压也不重新压缩"""
+    src.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+    src.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    data = src.fp.read(info.compress_size)
+
+    new_info = copy.copy(info)
+    new_info.filename = new_info.orig_filename = arcname or info.filename
+    # CRC和大小都已知, 写进本地文件头, 不再需要数据描述符
+    new_info.flag_bits &= ~0x08
+    new_info.header_offset = dst.fp.tell()
+    dst.fp.write(new_info.FileHeader())
+    dst.fp.write(data)
+    dst.filelist.append(new_info)
+    dst.NameToInfo[new_info.filename] = new_info
+    dst.start_dir = dst.fp.tell()
+
+
+def refresh_pez(pez_path, record, output_path) -> Dict[str, Any]:
+    """重写pez中的META和info.txt, 音频和封面按原压缩数据复制; 写到output_path(可以与pez_path相同)"""
+    id_str = calculate_id(record["song_id"])
+    tmp_path = output_path + ".tmp"
+    with zipfile.ZipFile(pez_path) as src:
+        info = parse_info_txt(src.read("info.txt").decode('utf-8'))
+        difficulty = resolve_difficulty(info["Level"].split()[0])
+        audio_ext = os.path.splitext(info["Song"])[1]
+        chart = src.read(info["Chart"]).decode('utf-8')
+        match = _META_DURATION.search(chart)
+        if match is None or not _META_BLOCK.search(chart):
+            raise ValueError(f"谱面中找不到META: {info['Chart']}")
+        duration = float(match.group(1))
+
+        meta_str = generate_meta_str(record, difficulty, duration, id_str, audio_ext)
+        chart = _META_BLOCK.sub(lambda _: meta_str, chart, count=1)
+        # song_id变化时包内文件名也跟着变
+        renames = {info["Chart"]: f"{id_str}.json", info["Song"]: f"{id_str}{audio_ext}",
+                   info["Picture"]: f"{id_str}.png"}
+
+        try:
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for entry in src.infolist():
+                    if entry.filename == "info.txt":
+                        dst.writestr("info.txt", generate_info_txt(record, difficulty, id_str, duration, audio_ext))
+                    elif entry.filename == info["Chart"]:
+                        dst.writestr(renames[entry.filename], chart)
+                    else:
+                        copy_entry_raw(src, entry, dst, renames.get(entry.filename))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    os.replace(tmp_path, output_path)
+    if os.path.abspath(output_path) != os.path.abspath(pez_path):
+        os.remove(pez_path)
+    return {"difficulty": difficulty, "path": output_path, "renamed": output_path != pez_path}
+
+
+def find_pez(output_dir, chart_id, difficulty, record) -> Optional[str]:
+    path = os.path.join(output_dir, chart_id, get_pez_name(difficulty, record))
+    if os.path.exists(path):
+        return path
+    # 曲名在更早的更新中已经改过
+    suffix = f" - {difficulty.replace('.json', '')}.pez"
+    chart_dir = os.path.join(output_dir, chart_id)
+    if os.path.isdir(chart_dir):
+        for name in sorted(os.listdir(chart_dir)):
+            if name.endswith(suffix):
+                return os.path.join(chart_dir, name)
+    return None
+
+
+def refresh_tree(output_dir, old, new, dry_run=False) -> Dict[str, Any]:
+    diff = diff_records(old, new)
+    report = {"changed": [], "missing": [], "failed": [], "added": diff["added"], "removed": diff["removed"]}
+    for chart_id, difficulty in diff["changed"]:
+        pez_path = find_pez(output_dir, chart_id, difficulty, old[chart_id])
+        key = f"{chart_id}/{difficulty.replace('.json', '')}"
+        if pez_path is None:
+            # 没有这个难度, 或还没有构建过
+            report["missing"].append(key)
+            continue
+        output_path = os.path.join(output_dir, chart_id, get_pez_name(difficulty, new[chart_id]))
+        if dry_run:
+            report["changed"].append({"key": key, "path": pez_path, "renamed": output_path != pez_path})
+            continue
+        try:
+            result = refresh_pez(pez_path, new[chart_id], output_path)
+            report["changed"].append({"key": key, "path": result["path"], "renamed": result["renamed"]})
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            report["failed"].append({"key": key, "error": f"{type(e).__name__}: {e}"})
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="曲目信息更新后只重写已有pez中的META和info.txt, 不重新转换")
+    parser.add_argument("old", help="更新前的song_information.bin或song_information.json")
+    parser.add_argument("new", nargs="?", default=SONG_INFO_BIN_PATH, help="更新后的曲目信息, 默认song_information.bin")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--dry-run", action="store_true", help="只列出会改动的pez")
+    parser.add_argument("--write-json", action="store_true",
+                        help=f"同时用新的曲目信息覆盖{os.path.basename(SONG_INFO_PATH)}, 之后的构建使用新元数据")
+    args = parser.parse_args(argv)
+
+    for path in (args.old, args.new):
+        if not os.path.exists(path):
+            print(f"错误: 找不到{path}")
+            return 1
+    old, new = load_records(args.old), load_records(args.new)
+    report = refresh_tree(args.output_dir, old, new, args.dry_run)
+
+    for entry in report["changed"]:
+        print(f"  {'将更新' if args.dry_run else '✓'} {entry['key']}{' (重命名)' if entry['renamed'] else ''}")
+    for entry in report["failed"]:
+        print(f"  ✗ {entry['key']}: {entry['error']}")
+    if report["added"]:
+        print(f"新增曲目需要完整构建 ({len(report['added'])}): {', '.join(report['added'])}")
+    if report["removed"]:
+        print(f"已删除的曲目 ({len(report['removed'])}): {', '.join(report['removed'])}")
+
+    if args.write_json and not args.dry_run:
+        with open(SONG_INFO_PATH, 'w', encoding='utf-8') as f:
+            json.dump(list(new.values()), f, indent=2, ensure_ascii=False)
+
+    print("=" * 60)
+    print(f"元数据更新: {len(report['changed'])} 个pez | 未构建{len(report['missing'])} | 失败{len(report['failed'])}")
+    print("=" * 60)
+    return 1 if report["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any
+
+# 秒
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为+Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, data):
+        # data为另一个直方图的to_dict(), 桶的划分相同
+        for i, count in enumerate(data["buckets"].values()):
+            self.counts[i] += count
+        self.count += data["count"]
+        self.sum += data["sum"]
+        self.max = max(self.max, data["max"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "buckets": {str(b): c for b, c in zip(self.buckets + ("+Inf",), self.counts)},
+        }
+
+
+class Metrics:
+    """一次运行的计数器和各阶段耗时直方图, 线程安全"""
+
+    def __init__(self, prefix="vsb2pez"):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def merge(self, data):
+        """合并另一个进程中Metrics.to_dict()的计数器和直方图"""
+        with self.lock:
+            for name, value in data["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for stage, h in data["stages"].items():
+                self.histograms.setdefault(stage, Histogram()).merge(h)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "started": self.started,
+                "elapsed": round(time.time() - self.started, 3),
+                "counters": dict(sorted(self.counters.items())),
+                "stages": {k: h.to_dict() for k, h in sorted(self.histograms.items())},
+            }
+
+    def to_prometheus(self) -> str:
+        p = self.prefix
+        data = self.to_dict()
+        lines = [
+            f"# TYPE {p}_run_started_seconds gauge",
+            f"{p}_run_started_seconds {data['started']:.3f}",
+            f"# TYPE {p}_run_elapsed_seconds gauge",
+            f"{p}_run_elapsed_seconds {data['elapsed']}",
+        ]
+        for name, value in data["counters"].items():
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            lines.append(f"{p}_{name}_total {value}")
+
+        if data["stages"]:
+            lines.append(f"# TYPE {p}_stage_seconds histogram")
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            for stage, h in histograms:
+                cumulative = 0
+                for bound, count in zip(h.buckets + ("+Inf",), h.counts):
+                    cumulative += count
+                    lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {h.sum:.6f}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, output_dir, name="metrics"):
+        # textfile collector要求原子替换, 先写临时文件再rename
+        os.makedirs(output_dir, exist_ok=True)
+        json_path = os.path.join(output_dir, f"{name}.json")
+        prom_path = os.path.join(output_dir, f"{name}.prom")
+        for path, content in ((json_path, json.dumps(self.to_dict(), indent=2, ensure_ascii=False)),
+                              (prom_path, self.to_prometheus())):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return json_path, prom_path
+
+
+class Progress:
+    """进度、吞吐和预计剩余时间"""
+
+    def __init__(self, total, unit="个"):
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.started = time.perf_counter()
+
+    def advance(self, n=1):
+        self.done += n
+
+    def line(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        if rate > 0 and self.total >= self.done:
+            eta = int((self.total - self.done) / rate)
+            eta_str = f"{eta // 3600:02d}:{eta % 3600 // 60:02d}:{eta % 60:02d}"
+        else:
+            eta_str = "--:--:--"
+        return f"[{self.done}/{self.total} {rate:.2f}{self.unit}/s ETA {eta_str}]"
+
+
+# 进程内默认的指标集合
+METRICS = Metrics()
@@ -0,0 +1,441 @@
+import io
+import os
+import sys
+import time
+import shutil
+import struct
+import sqlite3
+import tempfile
+import subprocess
+import zipfile
+import argparse
+import warnings
+import threading
+from typing import List, Optional, Tuple
+
+BUNDLE_NAME = "library.zip"
+SQLITE_NAME = "library.sqlite"
+
+SINK_KINDS = ("dir", "bundle", "sqlite")
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# BundleSink追加前备份的中央目录: 8字节原中央目录偏移(-1表示库是本次新建的) + 原中央目录及其后的全部字节
+JOURNAL_SUFFIX = ".journal"
+_JOURNAL_HEADER = struct.Struct("<q")
+
+
+def pack_folder(folder_path) -> bytes:
+    # 与compress_folder_to_pez相同的打包方式, 但结果留在内存中
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for root, dirs, files in os.walk(folder_path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                zipf.write(file_path, os.path.relpath(file_path, folder_path))
+    return buf.getvalue()
+
+
+def is_sqlite_library(path):
+    # SQLite库中的pez BLOB带有zip签名, 不能用is_zipfile区分
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def entry_key(chart_id, difficulty):
+    return f"{chart_id}/{difficulty.replace('.json', '')}"
+
+
+class BundleSink:
+    """所有pez作为不压缩的条目存进一个zip, 条目名为<chart_id>/<难度>.pez, 注释为原pez文件名
+
+    zip的中央目录就是索引, 单个pez可随机读取; 重复构建的条目以最后一次为准.
+    原地追加, 新条目会覆盖旧的中央目录, 所以第一次写入前把旧中央目录备份到<库>.journal, close写出新的中央目录后删除;
+    中途被杀死时, 读取方按journal看到上次完整的库, 下一次打开BundleSink时截断并还原, 只丢失本次写入的条目.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._journal_path = path + JOURNAL_SUFFIX
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        recover_bundle(path)
+        if not os.path.exists(path):
+            _write_journal(self._journal_path, -1, b"")
+            self._journaled = True
+        else:
+            self._journaled = False
+        self._zip = zipfile.ZipFile(path, 'a', zipfile.ZIP_STORED)
+        self._lock = threading.Lock()
+
+    def _journal(self):
+        # 'a'模式从旧中央目录处开始写
+        if self._journaled:
+            return
+        offset = self._zip.start_dir
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            _write_journal(self._journal_path, offset, f.read())
+        self._journaled = True
+
+    def write(self, chart_id, difficulty, pez_name, staging_dir):
+        data = pack_folder(staging_dir)
+        info = zipfile.ZipInfo(entry_key(chart_id, difficulty) + ".pez", time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.comment = pez_name.encode('utf-8')
+        with self._lock, warnings.catch_warnings():
+            # 重复的条目名: 新条目在中央目录中生效, 旧数据留在文件中直到compact
+            warnings.simplefilter("ignore", UserWarning)
+            self._journal()
+            self._zip.writestr(info, data)
+        shutil.rmtree(staging_dir)
+        return f"{self.path}:{info.filename}", len(data)
+
+    def close(self):
+        with self._lock:
+            if self._zip is None:
+                return
+            self._zip.close()
+            self._zip = None
+            if self._journaled:
+                with open(self.path, 'rb') as f:
+                    os.fsync(f.fileno())
+                os.remove(self._journal_path)
+
+
+def _write_journal(journal_path, offset, data):
+    tmp_path = journal_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_JOURNAL_HEADER.pack(offset) + data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, journal_path)
+
+
+def _read_journal(journal_path):
+    with open(journal_path, 'rb') as f:
+        data = f.read()
+    return _JOURNAL_HEADER.unpack_from(data)[0], data[_JOURNAL_HEADER.size:]
+
+
+def recover_bundle(path) -> bool:
+    """上次BundleSink没有正常关闭时, 截断追加的数据并还原旧中央目录; 返回是否做了还原
+
+    不能与正在写入的BundleSink同时调用.
+    """
+    journal_path = path + JOURNAL_SUFFIX
+    if not os.path.exists(journal_path):
+        return False
+    offset, data = _read_journal(journal_path)
+    if offset < 0:
+        if os.path.exists(path):
+            os.remove(path)
+    else:
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    os.remove(journal_path)
+    return True
+
+
+class _CommittedView(io.RawIOBase):
+    """只读视图: 库的前offset字节加journal中的旧中央目录, 即上次完整关闭时的库; 不修改文件"""
+
+    def __init__(self, path, offset, tail):
+        self._f = open(path, 'rb')
+        self._offset = offset
+        self._tail = tail
+        self._size = offset + len(tail)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + pos)
+        return self._pos
+
+    def readinto(self, buf):
+        n = min(len(buf), max(0, self._size - self._pos))
+        if self._pos < self._offset:
+            self._f.seek(self._pos)
+            data = self._f.read(min(n, self._offset - self._pos))
+        else:
+            start = self._pos - self._offset
+            data = self._tail[start:start + n]
+        buf[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+
+def committed_view(path) -> Optional[_CommittedView]:
+    # 有未完成的写入时返回上次完整状态的视图, 否则返回None
+    journal_path = path + JOURNAL_SUFFIX
+    if not os.path.exists(journal_path):
+        return None
+    offset, tail = _read_journal(journal_path)
+    if offset < 0:
+        raise zipfile.BadZipFile(f"{path}还没有完整写入过")
+    return _CommittedView(path, offset, tail)
+
+
+class SQLiteSink:
+    """pez存为SQLite中的BLOB, 主键(chart_id, difficulty)"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pez (
+            chart_id TEXT NOT NULL,
+            difficulty TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            built REAL NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (chart_id, difficulty)
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(self.SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def write(self, chart_id, difficulty, pez_name, staging_dir):
+        data = pack_folder(staging_dir)
+        difficulty = difficulty.replace('.json', '')
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO pez VALUES (?, ?, ?, ?, ?, ?)",
+                               (chart_id, difficulty, pez_name, len(data), time.time(), data))
+            self._conn.commit()
+        shutil.rmtree(staging_dir)
+        return f"{self.path}:{chart_id}/{difficulty}", len(data)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class PezLibrary:
+    """读取BundleSink或SQLiteSink写出的库"""
+
+    def __init__(self, path):
+        self.path = path
+        self.kind = "sqlite" if is_sqlite_library(path) else "bundle"
+        if self.kind == "bundle":
+            self._view = committed_view(path)
+            self._zip = zipfile.ZipFile(self._view or path)
+        else:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+    def entries(self) -> List[Tuple[str, str, str, int]]:
+        """(chart_id, 难度, pez文件名, 字节数)"""
+        if self.kind == "sqlite":
+            return self._conn.execute("SELECT chart_id, difficulty, name, size FROM pez "
+                                      "ORDER BY chart_id, difficulty").fetchall()
+        result = []
+        for info in sorted(self._zip.NameToInfo.values(), key=lambda i: i.filename):
+            chart_id, _, difficulty = info.filename[:-len(".pez")].rpartition('/')
+            result.append((chart_id, difficulty, info.comment.decode('utf-8'), info.file_size))
+        return result
+
+    def find(self, chart_id, difficulty) -> Optional[Tuple[str, str, str, int]]:
+        key = entry_key(chart_id, difficulty)
+        return next((e for e in self.entries() if f"{e[0]}/{e[1]}" == key), None)
+
+    def read(self, chart_id, difficulty) -> Optional[bytes]:
+        key = entry_key(chart_id, difficulty)
+        if self.kind == "sqlite":
+            chart_id, _, difficulty = key.rpartition('/')
+            row = self._conn.execute("SELECT data FROM pez WHERE chart_id = ? AND difficulty = ?",
+                                     (chart_id, difficulty)).fetchone()
+            return row[0] if row else None
+        try:
+            return self._zip.read(key + ".pez")
+        except KeyError:
+            return None
+
+    def export(self, output_dir) -> int:
+        # 还原成DirectorySink的目录结构
+        count = 0
+        for chart_id, difficulty, name, _ in self.entries():
+            target = os.path.join(output_dir, chart_id, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(self.read(chart_id, difficulty))
+            count += 1
+        return count
+
+    def close(self):
+        if self.kind == "bundle":
+            self._zip.close()
+            if self._view is not None:
+                self._view.close()
+        else:
+            self._conn.close()
+
+
+def compact_bundle(path):
+    # 去掉被覆盖的旧条目, 写到临时文件后替换
+    recover_bundle(path)
+    tmp_path = path + ".tmp"
+    with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as dst:
+        for info in sorted(src.NameToInfo.values(), key=lambda i: i.filename):
+            dst.writestr(info, src.read(info))
+    os.replace(tmp_path, path)
+
+
+# 在子进程中向库追加一个条目, 中央目录写出前杀死自己
+_CRASH_WRITER = """
+import os, sys, signal
+sys.path.insert(0, {module_dir!r})
+from pez_library import BundleSink
+sink = BundleSink({path!r})
+sink.write("crash", "FINALE", "crash - FINALE.pez", {staging!r})
+sink._zip.fp.flush()
+os.kill(os.getpid(), getattr(signal, "SIGKILL", signal.SIGTERM))
+"""
+
+
+def _fake_staging(root, name):
+    staging_dir = tempfile.mkdtemp(dir=root)
+    with open(os.path.join(staging_dir, "info.txt"), 'w', encoding='utf-8') as f:
+        f.write(f"Name: {name}\n")
+    return staging_dir
+
+
+def crash_check() -> List[str]:
+    """追加写入中途被杀死后, 库中原有的条目应仍可读, 之后还能继续追加; 返回发现的问题"""
+    problems = []
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, BUNDLE_NAME)
+        sink = BundleSink(path)
+        for chart_id in ("a", "b"):
+            sink.write(chart_id, "FINALE", f"{chart_id} - FINALE.pez", _fake_staging(root, chart_id))
+        sink.close()
+        with open(path, 'rb') as f:
+            before = f.read()
+
+        code = _CRASH_WRITER.format(module_dir=os.path.dirname(os.path.abspath(__file__)), path=path,
+                                    staging=_fake_staging(root, "crash"))
+        if subprocess.run([sys.executable, "-c", code]).returncode == 0:
+            problems.append("写入进程没有被杀死")
+
+        try:
+            # 还原前读取方应看到中断前的库
+            library = PezLibrary(path)
+            try:
+                keys = [f"{e[0]}/{e[1]}" for e in library.entries()]
+                if keys != ["a/FINALE", "b/FINALE"]:
+                    problems.append(f"中断后库中的条目为{keys}")
+                for chart_id in ("a", "b"):
+                    if library.read(chart_id, "FINALE") is None:
+                        problems.append(f"中断后读不到{chart_id}/FINALE")
+            finally:
+                library.close()
+        except zipfile.BadZipFile as e:
+            problems.append(f"中断后库无法打开: {e}")
+
+        if not recover_bundle(path):
+            problems.append("中断后没有留下journal")
+        with open(path, 'rb') as f:
+            if f.read() != before:
+                problems.append("还原后的库与中断前不同")
+
+        # 没有写入时不改动库
+        BundleSink(path).close()
+        with open(path, 'rb') as f:
+            if f.read() != before:
+                problems.append("没有写入的BundleSink改动了库")
+
+        sink = BundleSink(path)
+        sink.write("c", "FINALE", "c - FINALE.pez", _fake_staging(root, "c"))
+        sink.close()
+        library = PezLibrary(path)
+        try:
+            keys = [f"{e[0]}/{e[1]}" for e in library.entries()]
+        finally:
+            library.close()
+        if keys != ["a/FINALE", "b/FINALE", "c/FINALE"]:
+            problems.append(f"中断后再次追加, 库中的条目为{keys}")
+        if os.path.exists(path + JOURNAL_SUFFIX):
+            problems.append("正常关闭后journal没有删除")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pez库(单个zip或SQLite)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="列出库中的pez").add_argument("library")
+    extract = sub.add_parser("extract", help="取出单个pez")
+    extract.add_argument("library")
+    extract.add_argument("chart_id")
+    extract.add_argument("difficulty")
+    extract.add_argument("-o", "--output", help="默认为原pez文件名")
+    export = sub.add_parser("export", help="还原成<chart_id>/<曲名> - <难度>.pez目录")
+    export.add_argument("library")
+    export.add_argument("output_dir")
+    sub.add_parser("compact", help="去掉zip库中被覆盖的旧条目").add_argument("library")
+    sub.add_parser("crash-check", help="检查追加写入中途被杀死后zip库是否仍可读")
+    args = parser.parse_args(argv)
+
+    if args.command == "crash-check":
+        problems = crash_check()
+        for problem in problems:
+            print(f"✗ {problem}")
+        print("通过" if not problems else f"失败: {len(problems)} 个问题")
+        return 1 if problems else 0
+
+    if not os.path.exists(args.library):
+        print(f"错误: 找不到库文件: {args.library}")
+        return 1
+
+    if args.command == "compact":
+        if is_sqlite_library(args.library):
+            print("错误: 只有zip库需要compact")
+            return 1
+        before = os.path.getsize(args.library)
+        compact_bundle(args.library)
+        print(f"{before} -> {os.path.getsize(args.library)} 字节")
+        return 0
+
+    library = PezLibrary(args.library)
+    try:
+        if args.command == "list":
+            entries = library.entries()
+            for chart_id, difficulty, name, size in entries:
+                print(f"  {chart_id}/{difficulty}  {size:>10}  {name}")
+            print(f"共 {len(entries)} 个pez")
+        elif args.command == "extract":
+            difficulty = args.difficulty.upper()
+            entry = library.find(args.chart_id, difficulty)
+            if entry is None:
+                print(f"错误: 库中没有 {args.chart_id}/{difficulty}")
+                return 1
+            output = args.output or entry[2]
+            with open(output, 'wb') as f:
+                f.write(library.read(args.chart_id, difficulty))
+            print(f"输出: {output}")
+        else:
+            print(f"导出 {library.export(args.output_dir)} 个pez -> {args.output_dir}")
+    finally:
+        library.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
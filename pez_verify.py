@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import zlib
+import struct
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from vsb2pez import OUTPUT_DIR, BLACK_PNG_PATH
+from cover_render import COVER_PROFILES, DEFAULT_COVER_PROFILE, cover_image_size
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+REPORT_NAME = "verify_report.json"
+
+# 压缩数据或谱面JSON损坏时抛出的异常
+CORRUPTION_ERRORS = (zipfile.BadZipFile, zlib.error, ValueError) + ((ijson.JSONError,) if ijson is not None else ())
+
+# ijson中开始一个值的事件; end_map/end_array与其所在的值前缀相同, 不计入
+_VALUE_EVENTS = {'start_map', 'start_array', 'string', 'number', 'boolean', 'null'}
+
+# load_base_image找不到black.png时的底图尺寸
+FALLBACK_IMAGE_SIZE = (300, 300)
+
+
+def png_size(f) -> Optional[Tuple[int, int]]:
+    # 只读签名和IHDR共24字节
+    header = f.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+
+def expected_image_size(black_png_path=BLACK_PNG_PATH, cover_profile=None):
+    try:
+        with open(black_png_path, 'rb') as f:
+            size = png_size(f) or FALLBACK_IMAGE_SIZE
+    except OSError:
+        size = FALLBACK_IMAGE_SIZE
+    return cover_image_size(size, cover_profile)
+
+
+def parse_info_txt(text) -> Dict[str, str]:
+    info = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            info[key.strip()] = value.strip()
+    return info
+
+
+def scan_chart(f) -> Dict[str, Any]:
+    """返回META中的文件名和各判定线的(numOfNotes, notes元素数, 其中不是对象的元素数)
+
+    有无ijson结果相同.
+    """
+    if ijson is None:
+        chart = json.load(f)
+        return {
+            "song": chart.get("META", {}).get("song"),
+            "background": chart.get("META", {}).get("background"),
+            "lines": [(line.get("numOfNotes"), len(line.get("notes", [])),
+                       sum(not isinstance(note, dict) for note in line.get("notes", [])))
+                      for line in chart.get("judgeLineList", [])],
+        }
+
+    # 流式解析, 不把音符展开成对象
+    result = {"song": None, "background": None, "lines": []}
+    for prefix, event, value in ijson.parse(f):
+        if prefix == 'judgeLineList.item' and event == 'start_map':
+            result["lines"].append([None, 0, 0])
+        elif prefix == 'judgeLineList.item.notes.item' and event in _VALUE_EVENTS:
+            result["lines"][-1][1] += 1
+            if event != 'start_map':
+                result["lines"][-1][2] += 1
+        elif prefix == 'judgeLineList.item.numOfNotes':
+            result["lines"][-1][0] = value
+        elif prefix == 'META.song':
+            result["song"] = value
+        elif prefix == 'META.background':
+            result["background"] = value
+    result["lines"] = [tuple(line) for line in result["lines"]]
+    return result
+
+
+def verify_pez(pez_path, image_size=None) -> Dict[str, Any]:
+    errors = []
+    report = {"path": pez_path, "ok": False, "errors": errors}
+    try:
+        with zipfile.ZipFile(pez_path) as zf:
+            # testzip逐个读出并校验CRC
+            bad = zf.testzip()
+            if bad is not None:
+                errors.append(f"CRC校验失败: {bad}")
+                return report
+
+            names = set(zf.namelist())
+            if "info.txt" not in names:
+                errors.append("缺少info.txt")
+                return report
+            info = parse_info_txt(zf.read("info.txt").decode('utf-8'))
+
+            for key in ("Song", "Picture", "Chart"):
+                if not info.get(key):
+                    errors.append(f"info.txt缺少{key}")
+                elif info[key] not in names:
+                    errors.append(f"info.txt中的{key}不在包内: {info[key]}")
+
+            chart_name = info.get("Chart")
+            if chart_name in names:
+                with zf.open(chart_name) as f:
+                    chart = scan_chart(f)
+                if not chart["lines"]:
+                    errors.append("谱面没有判定线")
+                for i, (declared, actual, malformed) in enumerate(chart["lines"]):
+                    if malformed:
+                        errors.append(f"判定线{i}: notes中有{malformed}个元素不是音符对象")
+                    if declared != actual:
+                        errors.append(f"判定线{i}: numOfNotes={declared}, 实际音符数{actual}")
+                if chart["song"] != info.get("Song"):
+                    errors.append(f"META.song与info.txt不一致: {chart['song']} / {info.get('Song')}")
+                if chart["background"] != info.get("Picture"):
+                    errors.append(f"META.background与info.txt不一致: {chart['background']} / {info.get('Picture')}")
+                report["notes"] = sum(actual for _, actual, _ in chart["lines"])
+
+            picture = info.get("Picture")
+            if picture in names:
+                with zf.open(picture) as f:
+                    size = png_size(f)
+                if size is None:
+                    errors.append(f"{picture} 不是PNG")
+                elif image_size and tuple(size) != tuple(image_size):
+                    errors.append(f"{picture} 尺寸为{size[0]}x{size[1]}, 应为{image_size[0]}x{image_size[1]}")
+    except (OSError,) + CORRUPTION_ERRORS as e:
+        errors.append(f"{type(e).__name__}: {e}")
+
+    report["ok"] = not errors
+    return report
+
+
+def find_pez_files(root) -> List[str]:
+    found = []
+    for dirpath, dirs, files in os.walk(root):
+        dirs.sort()
+        found.extend(os.path.join(dirpath, name) for name in sorted(files) if name.endswith('.pez'))
+    return found
+
+
+def verify_tree(root, workers=None, image_size=None) -> List[Dict[str, Any]]:
+    paths = find_pez_files(root)
+    if not paths:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(verify_pez, paths, [image_size] * len(paths), chunksize=8))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="不解压地并行校验输出目录中的所有.pez")
+    parser.add_argument("output_dir", nargs="?", default=OUTPUT_DIR)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--report", help=f"默认写到<output_dir>/{REPORT_NAME}")
+    parser.add_argument("--cover-profile", choices=sorted(COVER_PROFILES), default=DEFAULT_COVER_PROFILE,
+                        help="构建时使用的封面档位, 用于计算应有的封面尺寸")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output_dir):
+        print(f"错误: 找不到输出目录: {args.output_dir}")
+        return 1
+
+    if ijson is None:
+        print("提示: 未安装ijson, 谱面JSON将整体解析")
+
+    results = verify_tree(args.output_dir, args.workers, expected_image_size(cover_profile=args.cover_profile))
+    failed = [r for r in results if not r["ok"]]
+    for r in failed:
+        print(f"✗ {os.path.relpath(r['path'], args.output_dir)}")
+        for error in r["errors"]:
+            print(f"    {error}")
+
+    report_path = args.report or os.path.join(args.output_dir, REPORT_NAME)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({"total": len(results), "failed": len(failed), "results": results}, f, indent=2, ensure_ascii=False)
+
+    print("=" * 60)
+    print(f"校验完成: 总计{len(results)} | 通过{len(results) - len(failed)} | 失败{len(failed)}")
+    print(f"报告: {report_path}")
+    print("=" * 60)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
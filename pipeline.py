@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Any
+
+from vsb_parser import VSBRawConverter
+from vsd_parser import VSDParser
+from vsm_parser import find_vsm_file, load_vsm_event_layer
+from vsb2pez import (
+    BASE_DIR, OUTPUT_DIR, ConversionContext, make_sink, calculate_id, generate_meta_str, generate_info_txt,
+    build_final_json, convert_vsb_to_notes, copy_resource_files, get_pez_name, find_lint_targets,
+)
+from asset_store import AssetStore, DEFAULT_MAX_BYTES
+from pez_library import SINK_KINDS
+from sharding import in_shard, parse_shard, shard_dir_name, write_summary
+from metrics import METRICS, Progress
+from cover_render import COVER_PROFILES, DEFAULT_COVER_PROFILE
+
+SONG_INFO_BIN_PATH = os.path.join(BASE_DIR, "song_information.bin")
+
+WorkItem = namedtuple('WorkItem', ['chart_id', 'difficulty', 'vsb_path'])
+
+
+class TaskGraph:
+    """依赖感知的任务图: 任务的参数和依赖都完成后才提交到所属阶段的执行器
+
+    参数中的Future在提交前替换为其结果; 任一输入失败时任务以同一异常失败, 不再提交.
+    完成回调只把任务放进就绪队列, 由调用pump的线程统一提交, 不在执行器的回调线程中提交.
+    各阶段从提交到完成的时间(含在执行器中排队)记为pipeline_<阶段>.
+    """
+
+    def __init__(self, executors, metrics=None):
+        self.executors = executors
+        self.metrics = metrics or METRICS
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def add(self, stage, func, *args, deps=()) -> Future:
+        future = Future()
+        inputs = [a for a in args if isinstance(a, Future)] + list(deps)
+        remaining = [len(inputs)]
+        with self._lock:
+            self.pending += 1
+
+        def on_input_done(_):
+            with self._lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self._ready.put((future, stage, func, args, inputs))
+
+        if not inputs:
+            self._ready.put((future, stage, func, args, inputs))
+        for f in inputs:
+            f.add_done_callback(on_input_done)
+        return future
+
+    def _finish(self, future, inner=None, error=None, stage=None, submitted=None):
+        with self._lock:
+            self.pending -= 1
+        if submitted is not None:
+            self.metrics.observe(f"pipeline_{stage}", time.perf_counter() - submitted)
+        if inner is not None:
+            error = inner.exception()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(inner.result())
+
+    def pump(self, timeout=None) -> bool:
+        """提交一个就绪任务; 超时返回False"""
+        try:
+            future, stage, func, args, inputs = self._ready.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        failed = next((f.exception() for f in inputs if f.exception() is not None), None)
+        if failed is not None:
+            self._finish(future, error=failed)
+            return True
+        resolved = [a.result() if isinstance(a, Future) else a for a in args]
+        submitted = time.perf_counter()
+        inner = self.executors[stage].submit(func, *resolved)
+        inner.add_done_callback(lambda f: self._finish(future, f, stage=stage, submitted=submitted))
+        return True
+
+
+class CatalogStream:
+    """在后台逐条解析song_information.bin, 每个曲目的记录一解析出来就可用"""
+
+    def __init__(self, bin_path, json_path=None, recover=False):
+        self.bin_path = bin_path
+        self.json_path = json_path
+        self.recover = recover
+        self._records: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._done = False
+        self.thread = threading.Thread(target=self._run, name="catalog", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def record(self, chart_id) -> Future:
+        with self._lock:
+            future = self._records.get(chart_id)
+            if future is None:
+                future = self._records[chart_id] = Future()
+                if self._done:
+                    future.set_exception(LookupError(f"无元数据: {chart_id}"))
+            return future
+
+    def _run(self):
+        songs = []
+        try:
+            with METRICS.stage("catalog"):
+                for record in VSDParser(Path(self.bin_path), self.recover).iter_records():
+                    songs.append(record)
+                    if "chart_id" in record:
+                        f = self.record(record["chart_id"])
+                        if not f.done():
+                            f.set_result(record)
+        except Exception as e:
+            print(f"元数据解析失败: {e}")
+        finally:
+            with self._lock:
+                self._done = True
+                for chart_id, f in self._records.items():
+                    if not f.done():
+                        f.set_exception(LookupError(f"无元数据: {chart_id}"))
+
+        # 与vsd_parser.py的输出相同, 其它工具继续使用song_information.json
+        if self.json_path and songs:
+            with open(self.json_path, 'w', encoding='utf-8') as f:
+                json.dump(songs, f, indent=2, ensure_ascii=False)
+
+
+def parse_chart(vsb_path, json_path, recover=False):
+    # 与vsb_parser.py相同, 同时写出vsbjson; 恢复模式下跳过的数据作为警告返回
+    converter = VSBRawConverter(vsb_path, recover)
+    converter.read()
+    if json_path:
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(converter.notes, f, indent=2, ensure_ascii=False)
+    skipped = [f"跳过 {s.length} 字节 @ 位置{s.offset}: {s.error}" for s in converter.skipped]
+    return converter.json_notes(), skipped
+
+
+def convert_chart(parsed, song_info, diff_file, duration, audio_ext, vsm_path):
+    vsb_data, warnings = parsed
+    issues = []
+    notes = convert_vsb_to_notes(vsb_data, issues)
+    errors = [i for i in issues if i["level"] == "error"]
+    if errors:
+        raise ValueError(f"{errors[0]['code']} @ {_chart_ms_str(errors[0])}")
+    warnings = warnings + [f"{i['code']} @ {_chart_ms_str(i)}" for i in issues]
+
+    id_str = calculate_id(song_info["song_id"])
+    meta_str = generate_meta_str(song_info, diff_file, duration, id_str, audio_ext)
+    event_layer = load_vsm_event_layer(vsm_path, vsb_data) if vsm_path else None
+    return build_final_json(meta_str, notes, event_layer), len(notes), warnings
+
+
+def _chart_ms_str(issue):
+    return f"{issue['time']:.0f}ms" if issue["time"] is not None else "-"
+
+
+class Pipeline:
+    """每个难度的parse -> convert, render -> package只依赖自身输入和该曲目的元数据记录"""
+
+    def __init__(self, context: ConversionContext, catalog: CatalogStream, workers=None, io_workers=4,
+                 max_inflight=None, write_vsbjson=True, recover=False):
+        self.context = context
+        self.catalog = catalog
+        self.workers = workers or os.cpu_count() or 1
+        self.io_workers = io_workers
+        self.max_inflight = max_inflight or self.workers * 2
+        self.write_vsbjson = write_vsbjson
+        self.recover = recover
+
+    def _render(self, item, record, warnings):
+        context = self.context
+        assets = context.assets.get(item.chart_id)
+        id_str = calculate_id(record["song_id"])
+        staging_dir = tempfile.mkdtemp(prefix=f".{item.chart_id}-{item.difficulty}-", dir=context.output_dir)
+        try:
+            with METRICS.stage("resources"):
+                copy_resource_files(staging_dir, item.chart_id, id_str, assets.audio_ext, warnings=warnings,
+                                    assets=assets, store=context.asset_store, covers=context.covers)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        return staging_dir
+
+    def _package(self, item, record, converted, duration, staging_dir):
+        final_json, note_count, warnings = converted
+        diff_file = f"{item.difficulty}.json"
+        id_str = calculate_id(record["song_id"])
+        audio_ext = self.context.assets.get(item.chart_id).audio_ext
+        with open(os.path.join(staging_dir, f"{id_str}.json"), 'w', encoding='utf-8') as f:
+            f.write(final_json)
+        with open(os.path.join(staging_dir, "info.txt"), 'w', encoding='utf-8') as f:
+            f.write(generate_info_txt(record, diff_file, id_str, duration, audio_ext))
+        with METRICS.stage("package"):
+            output, size = self.context.sink.write(item.chart_id, diff_file, get_pez_name(diff_file, record),
+                                                   staging_dir)
+        METRICS.inc("bytes_written", size)
+        return output, note_count, warnings
+
+    def _submit(self, graph, item):
+        context = self.context
+        assets = context.assets.get(item.chart_id)
+        diff_file = f"{item.difficulty}.json"
+        warnings = []
+        record = self.catalog.record(item.chart_id)
+        json_path = os.path.join(context.vsb_json_dir, item.chart_id, diff_file) if self.write_vsbjson else None
+        vsm_path = find_vsm_file(os.path.join(context.charts_dir, item.chart_id), item.difficulty)
+
+        parsed = graph.add("parse", parse_chart, item.vsb_path, json_path, self.recover)
+        duration = graph.add("probe", context.get_audio_duration, item.chart_id, warnings)
+        converted = graph.add("convert", convert_chart, parsed, record, diff_file, duration, assets.audio_ext, vsm_path)
+        staging = graph.add("render", self._render, item, record, warnings)
+        packaged = graph.add("package", self._package, item, record, converted, duration, staging)
+
+        def cleanup(f):
+            # 打包前失败时render生成的staging目录要删掉
+            if f.exception() is not None and staging.done() and staging.exception() is None:
+                shutil.rmtree(staging.result(), ignore_errors=True)
+        packaged.add_done_callback(cleanup)
+        return packaged, warnings
+
+    def run(self, items, on_result):
+        """on_result(item, ok, output或错误, 音符数, warnings), 在调用run的线程中按完成顺序调用"""
+        done = queue.Queue()
+        inflight = 0
+        pending_items = list(items)
+        # 工作进程用spawn启动, 避免在已有线程的进程中fork
+        process_pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        io_pool = ThreadPoolExecutor(self.io_workers)
+        graph = TaskGraph({"parse": process_pool, "convert": process_pool,
+                           "probe": io_pool, "render": io_pool, "package": io_pool})
+        try:
+            while pending_items or inflight:
+                while pending_items and inflight < self.max_inflight:
+                    item = pending_items.pop(0)
+                    # probe和render的警告记在_submit返回的列表中, 转换的警告在结果中
+                    packaged, warnings = self._submit(graph, item)
+                    packaged.add_done_callback(lambda f, item=item, warnings=warnings: done.put((item, f, warnings)))
+                    inflight += 1
+
+                # 先提交所有就绪任务, 再处理完成的条目
+                while graph.pump(timeout=0):
+                    pass
+                try:
+                    item, f, warnings = done.get(timeout=0.01)
+                except queue.Empty:
+                    graph.pump(timeout=0.01)
+                    continue
+                inflight -= 1
+                if f.exception() is None:
+                    output, note_count, convert_warnings = f.result()
+                    on_result(item, True, output, note_count, warnings + convert_warnings)
+                else:
+                    e = f.exception()
+                    on_result(item, False, f"{type(e).__name__}: {e}", 0, list(warnings))
+        finally:
+            io_pool.shutdown()
+            process_pool.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Charts/*.vsb + song_information.bin -> pez, 各阶段流水线并行")
+    parser.add_argument("--workers", type=int, help="解析和转换的进程数, 默认CPU核数")
+    parser.add_argument("--io-workers", type=int, default=4, help="音频时长、封面和打包的线程数")
+    parser.add_argument("--max-inflight", type=int, help="同时在处理中的难度数, 默认进程数的2倍")
+    parser.add_argument("--shard", type=parse_shard, help="只构建第i个分片(共N个), 格式 i/N")
+    parser.add_argument("--output-dir")
+    parser.add_argument("--sink", choices=SINK_KINDS, default="dir")
+    parser.add_argument("--sink-path")
+    parser.add_argument("--asset-cache")
+    parser.add_argument("--asset-cache-mb", type=int, default=DEFAULT_MAX_BYTES // 1048576)
+    parser.add_argument("--no-vsbjson", action="store_true", help="不写出vsbjson")
+    parser.add_argument("--recover", action="store_true", help="跳过损坏的曲目记录和音符, 从下一个标记继续解析")
+    parser.add_argument("--cover-profile", choices=sorted(COVER_PROFILES), default=DEFAULT_COVER_PROFILE,
+                        help="封面PNG编码档位")
+    args = parser.parse_args(argv)
+
+    output_dir = args.output_dir
+    if not output_dir and args.shard is not None:
+        output_dir = os.path.join(OUTPUT_DIR, shard_dir_name(args.shard))
+    store = AssetStore(args.asset_cache, args.asset_cache_mb * 1048576) if args.asset_cache else None
+    context = ConversionContext(output_dir=output_dir, asset_store=store, cover_profile=args.cover_profile)
+    output_dir = context.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    if not os.path.exists(SONG_INFO_BIN_PATH):
+        print(f"错误: 找不到{SONG_INFO_BIN_PATH}")
+        return 1
+    if not os.path.isdir(context.charts_dir):
+        print(f"错误: 找不到Charts目录: {context.charts_dir}")
+        return 1
+
+    METRICS.reset()
+    started = time.perf_counter()
+    catalog = CatalogStream(SONG_INFO_BIN_PATH, context.song_info_path, args.recover).start()
+
+    targets = [WorkItem(*t) for t in find_lint_targets(context.charts_dir) if in_shard(t[0], args.shard)]
+    missing = set(context.assets.missing_report(t.chart_id for t in targets)["audio"])
+    if missing:
+        print(f"缺少音频 ({len(missing)}): {', '.join(sorted(missing))}")
+    items = [t for t in targets if t.chart_id not in missing]
+
+    summary = {"total": len(targets), "success": 0, "failed": 0, "failures": [],
+               "charts": sorted({t.chart_id for t in targets})}
+    for t in targets:
+        if t.chart_id in missing:
+            summary["failed"] += 1
+            summary["failures"].append({"chart_id": t.chart_id, "difficulty": t.difficulty})
+    progress = Progress(len(items), "难度")
+    first = []
+
+    def on_result(item, ok, output, note_count, warnings):
+        progress.advance()
+        if ok:
+            if not first:
+                first.append(time.perf_counter() - started)
+                print(f"首个pez用时 {first[0]:.2f}s")
+            summary["success"] += 1
+            METRICS.inc("difficulties_succeeded")
+            METRICS.inc("notes_converted", note_count)
+            print(f"  ✓ {item.chart_id}/{item.difficulty} {progress.line()}")
+        else:
+            summary["failed"] += 1
+            summary["failures"].append({"chart_id": item.chart_id, "difficulty": item.difficulty})
+            METRICS.inc("difficulties_failed")
+            print(f"  ✗ {item.chart_id}/{item.difficulty}: {output} {progress.line()}")
+        for warning in warnings:
+            print(f"    警告: {warning}")
+
+    context.sink = make_sink(args.sink, output_dir, args.sink_path)
+    try:
+        Pipeline(context, catalog, args.workers, args.io_workers, args.max_inflight,
+                 not args.no_vsbjson, args.recover).run(items, on_result)
+    finally:
+        context.sink.close()
+        context.close()
+        if store is not None:
+            store.close()
+
+    metrics_paths = METRICS.write(output_dir)
+    if args.shard is not None:
+        summary["shard"] = list(args.shard)
+        summary["failures"].sort(key=lambda f: (f["chart_id"], f["difficulty"]))
+        write_summary(output_dir, summary)
+
+    print("=" * 60)
+    print(f"转换完成: 总计{summary['total']} | 成功{summary['success']} | 失败{summary['failed']} "
+          f"| 用时{time.perf_counter() - started:.1f}s")
+    print(f"输出目录: {output_dir}")
+    print(f"运行指标: {metrics_paths[0]} / {metrics_paths[1]}")
+    print("=" * 60)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
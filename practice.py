@@ -0,0 +1,352 @@
+import io
+import os
+import sys
+import json
+import math
+import wave
+import bisect
+import shutil
+import zipfile
+import argparse
+import tempfile
+from fractions import Fraction
+from collections import namedtuple
+
+from mutagen.ogg import OggPage
+from mutagen.oggvorbis import OggVorbis
+
+from vsb2pez import (
+    BASE_DIR, TMPL, ConversionContext, build_final_json, calculate_id, compress_folder_to_pez, convert_vsb_to_notes,
+    generate_info_txt, generate_meta_str, get_pez_name, load_vsb_data, render_cover, resolve_difficulty,
+)
+from vsb_parser import read_vsb_notes
+from vsm_parser import find_vsm_file, load_vsm_event_layer
+from pez_verify import parse_info_txt
+from metadata_refresh import find_pez
+
+PRACTICE_DIR = os.path.join(BASE_DIR, "practiceOutput")
+DEFAULT_LEAD_IN = 2.0
+# 模板自带的事件层数, vsm事件追加在这之后
+_TMPL_LAYER_COUNT = len(json.loads(TMPL)["judgeLineList"][0]["eventLayers"])
+
+# 一个难度的完整转换结果和资源; audio和cover为文件内容
+ChartSource = namedtuple('ChartSource', ['chart_id', 'difficulty', 'record', 'timeline', 'audio', 'audio_ext',
+                                         'cover', 'origin'])
+
+
+def _rpe_time(t):
+    return t[0] + Fraction(t[1], t[2])
+
+
+def _rpe_list(t):
+    return [int(t), t.numerator % t.denominator, t.denominator]
+
+
+def _chart_time(seconds):
+    # 原谱秒 -> RPE时间(秒+1), 与_raw_note一样取到毫秒
+    return Fraction(round(seconds * 1000), 1000) + 1
+
+
+class NoteTimeline:
+    """转换好的RPE音符按开始时间建索引, 截取时间段只做二分查找和平移, 不重新转换
+
+    bumper的轨道在完整转换时已按整条链(头音符、尾音符、覆盖它的hold)确定, 截取后保持不变.
+    """
+
+    def __init__(self, notes, event_layer=None):
+        others = sorted(((_rpe_time(n['startTime']), n) for n in notes if n['type'] != 2), key=lambda tn: tn[0])
+        holds = sorted(((_rpe_time(n['startTime']), _rpe_time(n['endTime']), n) for n in notes if n['type'] == 2),
+                       key=lambda h: h[0])
+        self._starts = [t for t, _ in others]
+        self._notes = [n for _, n in others]
+        self._hold_starts = [h[0] for h in holds]
+        self._holds = holds
+        # 从窗口起点向前这么远开始找跨过起点的hold
+        self._max_hold = max((end - start for start, end, _ in holds), default=0)
+        self.event_layer = event_layer
+
+    def __len__(self):
+        return len(self._notes) + len(self._holds)
+
+    def section(self, start, end, origin):
+        """取开始时间在[start, end)内的音符, 平移到以origin为0秒; 时间均为原谱秒
+
+        跨过窗口起点或终点的hold截到窗口内.
+        """
+        lo, hi = _chart_time(start), _chart_time(end)
+        shift = _chart_time(origin) - 1
+        i, j = bisect.bisect_left(self._starts, lo), bisect.bisect_left(self._starts, hi)
+        picked = [(t, n, t) for t, n in zip(self._starts[i:j], self._notes[i:j])]
+        k = bisect.bisect_left(self._hold_starts, lo - self._max_hold)
+        m = bisect.bisect_left(self._hold_starts, hi)
+        for h_start, h_end, note in self._holds[k:m]:
+            if h_start < lo and h_end <= lo:
+                continue
+            picked.append((max(h_start, lo), note, min(h_end, hi)))
+        picked.sort(key=lambda p: p[0])
+
+        notes = [dict(note, startTime=_rpe_list(t - shift), endTime=_rpe_list(t_end - shift))
+                 for t, note, t_end in picked]
+        return notes, _section_event_layer(self.event_layer, _chart_time(origin), hi, shift)
+
+
+def _section_event_layer(layer, lo, hi, shift):
+    # 跨过起点的事件在起点截断, 起始值按线性插值近似; 起点之前已结束的属性用最后的结束值保持到下一个事件
+    if not layer:
+        return None
+    out = {}
+    for key, events in layer.items():
+        kept, before = [], None
+        for ev in events:
+            s, e = _rpe_time(ev['startTime']), _rpe_time(ev['endTime'])
+            if e <= lo:
+                if before is None or e >= before[0]:
+                    before = (e, ev)
+                continue
+            if s >= hi:
+                continue
+            ev = dict(ev, startTime=_rpe_list(max(s, lo) - shift), endTime=_rpe_list(min(e, hi) - shift))
+            if s < lo:
+                ev['start'] = ev['start'] + (ev['end'] - ev['start']) * float((lo - s) / (e - s))
+            kept.append(ev)
+        if before is not None:
+            until = _rpe_time(kept[0]['startTime']) if kept else hi - shift
+            if until > lo - shift:
+                value = before[1]['end']
+                kept.insert(0, dict(before[1], start=value, end=value, easingLeft=0.0, easingRight=1.0,
+                                    startTime=_rpe_list(lo - shift), endTime=_rpe_list(until)))
+        if kept:
+            out[key] = kept
+    return out or None
+
+
+def trim_wav(src, dst_path, start, end):
+    """按采样截取, 返回实际的(起点, 终点)秒"""
+    with wave.open(src, 'rb') as r:
+        rate, total = r.getframerate(), r.getnframes()
+        first = min(total, int(start * rate))
+        last = min(total, math.ceil(end * rate))
+        r.setpos(first)
+        frames = r.readframes(last - first)
+        with wave.open(dst_path, 'wb') as w:
+            w.setparams(r.getparams())
+            w.writeframes(frames)
+    return first / rate, last / rate
+
+
+def _read_ogg_pages(src):
+    pages = []
+    while True:
+        try:
+            pages.append(OggPage(src))
+        except EOFError:
+            return pages
+
+
+def trim_ogg(src, dst_path, start, end):
+    """按Ogg页截取Vorbis音频, 不解码也不重新编码; 返回实际的(起点, 终点)秒
+
+    起点取start之前最后一个页边界, 终点取end之后第一个页边界; 颗粒位置平移到从0开始,
+    解码器在起点处丢弃的第一个包不超过一个Vorbis块.
+    """
+    rate = OggVorbis(src).info.sample_rate
+    src.seek(0)
+    pages = _read_ogg_pages(src)
+    pages = [p for p in pages if p.serial == pages[0].serial]
+
+    # 三个头包之后的第一页开始是音频
+    packets, header_end = 0, 0
+    while packets < 3:
+        packets += len(pages[header_end].packets) - (0 if pages[header_end].complete else 1)
+        header_end += 1
+    headers, audio = pages[:header_end], pages[header_end:]
+
+    start_sample, end_sample = int(start * rate), math.ceil(end * rate)
+    first, base = 0, 0
+    last = len(audio) - 1
+    prev = 0
+    for i, page in enumerate(audio):
+        if prev <= start_sample:
+            first, base = i, prev
+        if page.position >= end_sample:
+            last = i
+            break
+        if page.position != -1:
+            prev = page.position
+    kept = audio[first:last + 1]
+
+    # 去掉起点页上属于上一页的半个包和终点页上不完整的包
+    while kept and kept[0].continued:
+        if len(kept[0].packets) > 1:
+            kept[0].packets = kept[0].packets[1:]
+            kept[0].continued = False
+        else:
+            kept.pop(0)
+    while kept and not kept[-1].complete:
+        if len(kept[-1].packets) > 1:
+            kept[-1].packets = kept[-1].packets[:-1]
+            kept[-1].complete = True
+        else:
+            kept.pop()
+    if not kept:
+        raise ValueError(f"{start:.3f}s-{end:.3f}s之间没有完整的音频包")
+
+    for page in kept:
+        if page.position != -1:
+            page.position -= base
+    for page in headers + kept:
+        page.last = False
+    kept[-1].last = True
+    for seq, page in enumerate(headers + kept):
+        page.sequence = seq
+    with open(dst_path, 'wb') as f:
+        for page in headers + kept:
+            f.write(page.write())
+    return base / rate, (kept[-1].position + base) / rate
+
+
+def trim_audio(audio, audio_ext, dst_path, start, end):
+    trim = trim_wav if audio_ext == '.wav' else trim_ogg
+    return trim(io.BytesIO(audio), dst_path, start, end)
+
+
+def load_source(context, chart_id, difficulty) -> ChartSource:
+    """已构建的pez中有完整转换结果时直接读取, 否则从vsbjson或vsb转换一次"""
+    record = context.song_info[chart_id]
+    pez_path = find_pez(context.output_dir, chart_id, difficulty, record)
+    if pez_path is not None:
+        with zipfile.ZipFile(pez_path) as src:
+            info = parse_info_txt(src.read("info.txt").decode('utf-8'))
+            line = json.loads(src.read(info["Chart"]))["judgeLineList"][0]
+            layers = line.get("eventLayers", [])
+            event_layer = layers[_TMPL_LAYER_COUNT] if len(layers) > _TMPL_LAYER_COUNT else None
+            timeline = NoteTimeline(line["notes"], event_layer)
+            return ChartSource(chart_id, difficulty, record, timeline, src.read(info["Song"]),
+                               os.path.splitext(info["Song"])[1], src.read(info["Picture"]), pez_path)
+
+    json_path = os.path.join(context.vsb_json_dir, chart_id, difficulty)
+    vsb_path = os.path.join(context.charts_dir, chart_id, difficulty.replace('.json', '.vsb'))
+    if os.path.exists(json_path):
+        vsb_data, origin = load_vsb_data(json_path), json_path
+    elif os.path.exists(vsb_path):
+        vsb_data, origin = read_vsb_notes(vsb_path), vsb_path
+    else:
+        raise FileNotFoundError(f"找不到{chart_id}/{difficulty.replace('.json', '')}的pez、vsbjson或vsb")
+    vsm_path = find_vsm_file(os.path.join(context.charts_dir, chart_id), difficulty.replace('.json', ''))
+    event_layer = load_vsm_event_layer(vsm_path, vsb_data) if vsm_path else None
+
+    assets = context.assets.get(chart_id)
+    if assets is None:
+        raise FileNotFoundError(f"找不到{chart_id}的音频")
+    with open(assets.audio_path, 'rb') as f:
+        audio = f.read()
+    cover = io.BytesIO()
+    render_cover(context.base_image.copy(), assets.sprite_path, cover, profile=context.cover_profile)
+    return ChartSource(chart_id, difficulty, record, NoteTimeline(convert_vsb_to_notes(vsb_data), event_layer),
+                       audio, assets.audio_ext, cover.getvalue(), origin)
+
+
+def format_time(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes)}:{seconds:04.1f}"
+
+
+def parse_time(text):
+    # 秒数或 分:秒
+    minutes, _, seconds = text.rpartition(':')
+    return float(minutes or 0) * 60 + float(seconds)
+
+
+def preview_window(record):
+    # 曲目信息中的试听区间(秒), 没有时返回None
+    try:
+        start, end = float(record["preview_start_time"]), float(record["preview_end_time"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (start, end) if end > start else None
+
+
+def write_section(source: ChartSource, start, end, output_dir, lead_in=DEFAULT_LEAD_IN):
+    """把[start, end)秒的音符打包成单独的pez, 音频从start之前lead_in秒截到end; 返回(pez路径, 音符数)"""
+    if end <= start:
+        raise ValueError(f"区间无效: {start}-{end}")
+    label = f"{format_time(start)}-{format_time(end)}"
+    record = dict(source.record, formatted_name=f"{source.record.get('formatted_name', 'Unknown Song')} [{label}]")
+    # 同一曲目的不同片段可以同时导入
+    id_str = f"{calculate_id(record['song_id'])}_{round(start * 1000)}"
+
+    os.makedirs(output_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=f".{source.chart_id}-practice-", dir=output_dir)
+    try:
+        audio_start, audio_end = trim_audio(source.audio, source.audio_ext,
+                                            os.path.join(staging_dir, f"{id_str}{source.audio_ext}"),
+                                            max(0.0, start - lead_in), end)
+        if audio_end <= start:
+            raise ValueError(f"区间{label}超出音频长度")
+        notes, event_layer = source.timeline.section(start, end, audio_start)
+        if not any(note["isFake"] == 0 for note in notes):
+            # 只有地雷(假音符)或没有音符的片段无法游玩
+            raise ValueError(f"区间{label}内没有可打的音符" + (f" (只有{len(notes)}个地雷)" if notes else ""))
+        # 与probe_audio_duration一样多算1秒
+        duration = audio_end - audio_start + 1
+
+        meta_str = generate_meta_str(record, source.difficulty, duration, id_str, source.audio_ext)
+        with open(os.path.join(staging_dir, f"{id_str}.json"), 'w', encoding='utf-8') as f:
+            f.write(build_final_json(meta_str, notes, event_layer))
+        with open(os.path.join(staging_dir, "info.txt"), 'w', encoding='utf-8') as f:
+            f.write(generate_info_txt(record, source.difficulty, id_str, duration, source.audio_ext))
+        with open(os.path.join(staging_dir, f"{id_str}.png"), 'wb') as f:
+            f.write(source.cover)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    pez_path = os.path.join(output_dir, source.chart_id, get_pez_name(source.difficulty, record))
+    os.makedirs(os.path.dirname(pez_path), exist_ok=True)
+    compress_folder_to_pez(staging_dir, pez_path)
+    return pez_path, len(notes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="从完整转换结果中截取片段, 打包成单独的练习pez")
+    parser.add_argument("chart_id")
+    parser.add_argument("difficulty", help="FINALE / FINALE.json / FN")
+    parser.add_argument("--window", nargs=2, action="append", default=[], metavar=("START", "END"),
+                        type=parse_time, help="截取区间, 秒或 分:秒; 可重复")
+    parser.add_argument("--preview", action="store_true", help="截取曲目信息中的试听区间")
+    parser.add_argument("--lead-in", type=float, default=DEFAULT_LEAD_IN, help="片段前保留的音频秒数")
+    parser.add_argument("--output-dir", default=PRACTICE_DIR)
+    args = parser.parse_args(argv)
+
+    context = ConversionContext()
+    try:
+        difficulty = resolve_difficulty(args.difficulty)
+        if args.chart_id not in context.song_info:
+            raise LookupError(f"无元数据: {args.chart_id}")
+        windows = list(args.window)
+        if args.preview:
+            window = preview_window(context.song_info[args.chart_id])
+            if window is None:
+                raise LookupError(f"{args.chart_id}没有试听区间")
+            windows.append(window)
+        if not windows:
+            parser.error("需要--window或--preview")
+        source = load_source(context, args.chart_id, difficulty)
+    except (LookupError, ValueError, FileNotFoundError) as e:
+        print(f"错误: {e}")
+        return 1
+
+    print(f"{args.chart_id}/{difficulty.replace('.json', '')}: {len(source.timeline)} 个音符, 来自 {source.origin}")
+    failed = 0
+    for start, end in windows:
+        try:
+            pez_path, count = write_section(source, start, end, args.output_dir, args.lead_in)
+            print(f"  ✓ {format_time(start)}-{format_time(end)}: {count} 个音符 -> {pez_path}")
+        except (OSError, ValueError) as e:
+            failed += 1
+            print(f"  ✗ {format_time(start)}-{format_time(end)}: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import zlib
+import argparse
+from typing import Dict, Any, List, Optional, Tuple
+
+SUMMARY_NAME = "summary.json"
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    # "i/N", i从0开始; 抛ArgumentTypeError以便直接作为argparse的type
+    try:
+        index, count = (int(x) for x in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"分片格式应为 i/N: {text}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"分片超出范围: {text}")
+    return index, count
+
+
+def shard_of(chart_id: str, count: int) -> int:
+    # crc32与进程/机器无关, 不能用受PYTHONHASHSEED影响的hash()
+    return zlib.crc32(chart_id.encode('utf-8')) % count
+
+
+def in_shard(chart_id: str, shard: Optional[Tuple[int, int]]) -> bool:
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(chart_id, count) == index
+
+
+def shard_dir_name(shard: Tuple[int, int]) -> str:
+    return f"shard-{shard[0]}-of-{shard[1]}"
+
+
+def write_summary(output_dir: str, summary: Dict[str, Any]) -> str:
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, SUMMARY_NAME)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def merge_summaries(summaries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    merged = {"shards": [], "charts": [], "total": 0, "success": 0, "failed": 0, "failures": [], "problems": []}
+    seen = {}
+    counts = set()
+
+    for summary in sorted(summaries, key=lambda s: tuple(s.get("shard") or (0, 1))):
+        shard = tuple(summary.get("shard") or (0, 1))
+        counts.add(shard[1])
+        merged["shards"].append(list(shard))
+        for key in ("total", "success", "failed"):
+            merged[key] += summary.get(key, 0)
+        merged["failures"].extend(summary.get("failures", []))
+        for chart_id in summary.get("charts", []):
+            if chart_id in seen:
+                merged["problems"].append(f"{chart_id} 同时出现在分片 {seen[chart_id]} 和 {list(shard)}")
+            seen[chart_id] = list(shard)
+            merged["charts"].append(chart_id)
+
+    if len(counts) > 1:
+        merged["problems"].append(f"分片总数不一致: {sorted(counts)}")
+    elif counts:
+        count = counts.pop()
+        missing = sorted(set(range(count)) - {s[0] for s in merged["shards"]})
+        if missing:
+            merged["problems"].append(f"缺少分片: {missing}")
+
+    merged["charts"].sort()
+    merged["failures"].sort(key=lambda f: (f["chart_id"], f["difficulty"]))
+    return merged
+
+
+def main(argv=None):
+    # python sharding.py merged.json pezOutput/shard-*/summary.json
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2:
+        print("用法: python sharding.py <合并输出.json> <summary.json>...")
+        return 2
+
+    output_path, inputs = argv[0], argv[1:]
+    summaries = []
+    for path in inputs:
+        if os.path.isdir(path):
+            path = os.path.join(path, SUMMARY_NAME)
+        with open(path, 'r', encoding='utf-8') as f:
+            summaries.append(json.load(f))
+
+    merged = merge_summaries(summaries)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(merged, f, indent=2, ensure_ascii=False)
+
+    print(f"合并 {len(summaries)} 个分片: 总计{merged['total']} | 成功{merged['success']} | 失败{merged['failed']}")
+    for problem in merged["problems"]:
+        print(f"  警告: {problem}")
+    print(f"输出: {output_path}")
+    return 1 if merged["problems"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import json
+import struct
+from collections.abc import Mapping
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+CATALOG_MAGIC = b"VSIC"
+_CATALOG_HEADER = struct.Struct("<4sI")  # magic, 曲目数
+_CATALOG_ENTRY = struct.Struct("<IHII")  # chart_id偏移, chart_id长度, 记录偏移, 记录长度
+_IMAGE_HEADER = struct.Struct("<II")     # 宽, 高; 之后为RGBA像素
+
+
+def pack_catalog(song_info) -> bytes:
+    """曲目信息打包成按chart_id排序的索引表加紧凑JSON记录, 查找时不需要解码整个目录"""
+    items = sorted((chart_id.encode('utf-8'),
+                    json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+                   for chart_id, record in song_info.items())
+    offset = _CATALOG_HEADER.size + _CATALOG_ENTRY.size * len(items)
+    entries, blobs = [], []
+    for key, record in items:
+        entries.append(_CATALOG_ENTRY.pack(offset, len(key), offset + len(key), len(record)))
+        blobs += [key, record]
+        offset += len(key) + len(record)
+    return _CATALOG_HEADER.pack(CATALOG_MAGIC, len(items)) + b"".join(entries) + b"".join(blobs)
+
+
+class PackedCatalog(Mapping):
+    """pack_catalog的结果, 可直接建在共享内存上; 按chart_id二分查找, 只解码查到的记录"""
+
+    def __init__(self, buf):
+        self._buf = memoryview(buf)
+        magic, self._count = _CATALOG_HEADER.unpack_from(self._buf)
+        if magic != CATALOG_MAGIC:
+            raise ValueError("不是打包的曲目信息")
+
+    def _entry(self, i):
+        return _CATALOG_ENTRY.unpack_from(self._buf, _CATALOG_HEADER.size + _CATALOG_ENTRY.size * i)
+
+    def _key(self, i) -> bytes:
+        key_offset, key_len, _, _ = self._entry(i)
+        return bytes(self._buf[key_offset:key_offset + key_len])
+
+    def __getitem__(self, chart_id):
+        key = chart_id.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._count or self._key(lo) != key:
+            raise KeyError(chart_id)
+        _, _, record_offset, record_len = self._entry(lo)
+        return json.loads(bytes(self._buf[record_offset:record_offset + record_len]))
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._key(i).decode('utf-8')
+
+    def __len__(self):
+        return self._count
+
+    def release(self):
+        self._buf.release()
+
+
+class SharedAssets:
+    """父进程把曲目信息和解码好的RGBA底图各放进一块共享内存, 工作进程按名字映射, 不复制也不重新解码
+
+    只读; 由publish创建的一方负责unlink.
+    """
+
+    def __init__(self, catalog_shm, image_shm, owner=False):
+        self._catalog_shm = catalog_shm
+        self._image_shm = image_shm
+        self._owner = owner
+        self.catalog = PackedCatalog(catalog_shm.buf)
+        width, height = _IMAGE_HEADER.unpack_from(image_shm.buf)
+        self._pixels = image_shm.buf[_IMAGE_HEADER.size:_IMAGE_HEADER.size + width * height * 4]
+        # 与共享内存共用像素, 使用时先copy()
+        self.base_image = Image.frombuffer("RGBA", (width, height), self._pixels, "raw", "RGBA", 0, 1)
+
+    @staticmethod
+    def _create(data):
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        shm.buf[:len(data)] = data
+        return shm
+
+    @classmethod
+    def publish(cls, song_info, base_image):
+        catalog_shm = cls._create(pack_catalog(song_info))
+        try:
+            image = base_image.convert("RGBA")
+            image_shm = cls._create(_IMAGE_HEADER.pack(*image.size) + image.tobytes())
+        except BaseException:
+            catalog_shm.close()
+            catalog_shm.unlink()
+            raise
+        return cls(catalog_shm, image_shm, owner=True)
+
+    @classmethod
+    def attach(cls, handle):
+        catalog_name, image_name = handle
+        return cls(shared_memory.SharedMemory(catalog_name), shared_memory.SharedMemory(image_name))
+
+    @property
+    def handle(self):
+        # 传给工作进程的初始化函数
+        return self._catalog_shm.name, self._image_shm.name
+
+    def close(self):
+        # 映射上的视图都释放后才能关闭
+        self.base_image = None
+        self._pixels.release()
+        self.catalog.release()
+        for shm in (self._catalog_shm, self._image_shm):
+            shm.close()
+            if self._owner:
+                shm.unlink()
@@ -1,21 +1,46 @@
 import json
+import heapq
 import re
 import os
+import sys
+import time
+import argparse
+import atexit
+import contextlib
 import shutil
 import zipfile
+import tempfile
+import threading
+from collections import namedtuple
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from fractions import Fraction
 from datetime import datetime
 from mutagen.oggvorbis import OggVorbis
 from mutagen.wave import WAVE
 from PIL import Image
+from vsb_parser import read_vsb_notes
+from vsm_parser import find_vsm_file, load_vsm_event_layer
+from sharding import in_shard, parse_shard, shard_dir_name, write_summary
+from metrics import METRICS, Metrics, Progress
+from asset_catalog import AssetCatalog
+from asset_store import AssetStore, DEFAULT_MAX_BYTES
+from shared_assets import SharedAssets
+from cover_render import (
+    COVER_PROFILES, COVER_OFFSET_DIVISORS, COVER_SIZE, DEFAULT_COVER_PROFILE, CoverRenderer, get_cover_profile,
+    render_cover,
+)
+from pez_library import BundleSink, SQLiteSink, BUNDLE_NAME, SQLITE_NAME, SINK_KINDS
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 VSB_JSON_DIR = os.path.join(BASE_DIR, "vsbjson")
+CHARTS_DIR = os.path.join(BASE_DIR, "Charts")
 AUDIO_DIR = os.path.join(BASE_DIR, "audiogroup_default")
 SPRITE_DIR = os.path.join(BASE_DIR, "Sprites")
 OUTPUT_DIR = os.path.join(BASE_DIR, "pezOutput")
 SONG_INFO_PATH = os.path.join(BASE_DIR, "song_information.json")
 BLACK_PNG_PATH = os.path.join(BASE_DIR, "black.png")
+LINT_REPORT_PATH = os.path.join(BASE_DIR, "lint_report.json")
 
 DIFFICULTY_MAP = {
     "OPENING.json": {"abbr": "OP", "level": 1},
@@ -332,34 +357,40 @@ TMPL = r'''{
 }'''
 
 
-def load_song_info():
-    if not os.path.exists(SONG_INFO_PATH):
-        raise FileNotFoundError(f"找不到{SONG_INFO_PATH}")
-    with open(SONG_INFO_PATH, 'r', encoding='utf-8') as f:
+def load_song_info(song_info_path=None):
+    song_info_path = song_info_path or SONG_INFO_PATH
+    if not os.path.exists(song_info_path):
+        raise FileNotFoundError(f"找不到{song_info_path}")
+    with open(song_info_path, 'r', encoding='utf-8') as f:
         song_list = json.load(f)
     return {item["chart_id"]: item for item in song_list}
 
 
-def get_audio_duration(chart_id):
-    cache_key = f"duration_{chart_id}"
-    if not hasattr(get_audio_duration, "_cache"):
-        get_audio_duration._cache = {}
-    if cache_key in get_audio_duration._cache:
-        return get_audio_duration._cache[cache_key]
-
+def find_audio(chart_id, audio_dir=None):
+    audio_dir = audio_dir or AUDIO_DIR
     for ext in ['.ogg', '.wav']:
-        audio_path = os.path.join(AUDIO_DIR, f"music_chart_{chart_id}{ext}")
+        audio_path = os.path.join(audio_dir, f"music_chart_{chart_id}{ext}")
         if os.path.exists(audio_path):
-            try:
-                audio = WAVE(audio_path) if ext == '.wav' else OggVorbis(audio_path)
-                duration = audio.info.length
-                get_audio_duration._cache[cache_key] = duration
-                return duration + 1
-            except Exception as e:
-                print(f"警告: 读取音频失败 {audio_path}: {e}")
+            return audio_path, ext
+    return None, None
+
+
+def probe_audio_duration(audio_path, ext, warnings=None):
+    # 时长 + 1秒; 读取失败按1秒处理
+    try:
+        audio = WAVE(audio_path) if ext == '.wav' else OggVorbis(audio_path)
+        return audio.info.length + 1
+    except Exception as e:
+        message = f"读取音频失败 {audio_path}: {e}"
+        if warnings is None:
+            print(f"警告: {message}")
+        else:
+            warnings.append(message)
+        return 1.0
 
-    get_audio_duration._cache[cache_key] = 0.0
-    return 1.0
+
+def get_audio_duration(chart_id):
+    return get_default_context().get_audio_duration(chart_id)
 
 
 def calculate_id(song_id):
@@ -417,37 +448,59 @@ Group: VIVIDSTASISTOPHIGROS
 """
 
 
-def copy_resource_files(target_dir, chart_id, id_str, audio_ext):
-    # 音频
-    src_audio = os.path.join(AUDIO_DIR, f"music_chart_{chart_id}{audio_ext}")
-    dst_audio = os.path.join(target_dir, f"{id_str}{audio_ext}")
-    if not os.path.exists(src_audio):
-        raise FileNotFoundError(f"音频文件不存在: {src_audio}")
-    shutil.copy2(src_audio, dst_audio)
-
-    # 图
-    output_png_path = os.path.join(target_dir, f"{id_str}.png")
-    sprite_path = os.path.join(SPRITE_DIR, f"song_{chart_id}_0.png")
-
-    if os.path.exists(BLACK_PNG_PATH):
+def load_base_image(black_png_path=None):
+    black_png_path = black_png_path or BLACK_PNG_PATH
+    if os.path.exists(black_png_path):
         try:
-            base = Image.open(BLACK_PNG_PATH).convert("RGBA")
+            return Image.open(black_png_path).convert("RGBA")
         except:
-            base = Image.new("RGBA", (300, 300), (0, 0, 0, 255))
+            pass
+    return Image.new("RGBA", (300, 300), (0, 0, 0, 255))
+
+
+def cover_cache_key(store, black_png_path, sprite_path, profile=None):
+    sources = [store.source_digest(black_png_path) if os.path.exists(black_png_path) else None,
+               store.source_digest(sprite_path) if sprite_path else None]
+    params = {"size": COVER_SIZE, "resample": "NEAREST", "offset_divisors": COVER_OFFSET_DIVISORS, "format": "PNG"}
+    profile = get_cover_profile(profile)
+    # legacy档位的输出与之前相同, 沿用原来的键
+    if profile != COVER_PROFILES["legacy"]:
+        params["profile"] = profile._asdict()
+    return store.make_key("cover", sources, params)
+
+
+def copy_resource_files(target_dir, chart_id, id_str, audio_ext, base_image=None,
+                        audio_dir=None, sprite_dir=None, warnings=None, assets=None,
+                        store=None, black_png_path=None, covers=None):
+    # store为AssetStore时音频和合成后的封面从缓存链接, 不再复制和重新合成
+    # assets为资源目录中的AssetEntry时直接使用其中的路径, 不再逐个exists
+    # covers为CoverRenderer时封面由它渲染(同一曲绘只渲染一次), 此时不使用base_image和store
+    if assets is not None:
+        src_audio = assets.audio_path
+        sprite_path = assets.sprite_path
     else:
-        base = Image.new("RGBA", (300, 300), (0, 0, 0, 255))
+        src_audio = os.path.join(audio_dir or AUDIO_DIR, f"music_chart_{chart_id}{audio_ext}")
+        if not os.path.exists(src_audio):
+            raise FileNotFoundError(f"音频文件不存在: {src_audio}")
+        sprite_path = os.path.join(sprite_dir or SPRITE_DIR, f"song_{chart_id}_0.png")
+        if not os.path.exists(sprite_path):
+            sprite_path = None
 
-    if os.path.exists(sprite_path):
-        try:
-            cover = Image.open(sprite_path).convert("RGBA").resize((300, 300), Image.NEAREST)
-            base_w, base_h = base.size
-            offset_x = (base_w - 300) // 15
-            offset_y = (base_h - 300) // 2
-            base.paste(cover, (offset_x, offset_y), cover)
-        except Exception as e:
-            print(f"警告: 封面处理失败 {sprite_path}: {e}")
+    # 音频
+    dst_audio = os.path.join(target_dir, f"{id_str}{audio_ext}")
+    if store is None:
+        shutil.copy2(src_audio, dst_audio)
+    else:
+        audio_key = store.make_key("audio", [store.source_digest(src_audio)])
+        store.fetch(audio_key, dst_audio, lambda tmp_path: shutil.copyfile(src_audio, tmp_path))
+
+    # 图
+    if covers is None:
+        black_png_path = black_png_path or BLACK_PNG_PATH
+        covers = CoverRenderer(base_image if base_image is not None else load_base_image(black_png_path), store=store,
+                               key_func=lambda sprite: cover_cache_key(store, black_png_path, sprite))
+    covers.fetch(sprite_path, os.path.join(target_dir, f"{id_str}.png"), warnings)
 
-    base.save(output_png_path, "PNG")
 
 def compress_folder_to_pez(folder_path, pez_path):
     zip_path = pez_path.replace('.pez', '.zip')
@@ -461,284 +514,384 @@ def compress_folder_to_pez(folder_path, pez_path):
     shutil.rmtree(folder_path)
 
 
-def convert_vsb_to_notes(vsb_data):
-    lane_map_type0_2 = {0: -405, 1: -135, 2: 135, 3: 405}
-    lane_map_type1 = {0: -270, 2: 270}
-    fixed_note_template = {
-        "above": 1, "alpha": 255, "color": [255, 255, 255],
-        "endTime": [0, 0, 1], "isFake": 0, "judgeArea": 1.0,
-        "positionX": 0.0, "size": 1.0, "speed": 1.0,
-        "startTime": [0, 0, 1], "type": 1, "visibleTime": 1.0, "yOffset": 0.0
-    }
+def _chart_ms(t):
+    # RPE时间(秒+1) -> 原谱毫秒
+    return float((t - 1) * 1000)
 
-    notes_list = []
-    raw_notes = []  # (时间, 类型, 轨道, 原始索引, 结束时间, 半区)
 
-    # 预处理
-    for idx, note in enumerate(vsb_data):
-        if note['type'] not in [0, 1, 2, 6, 7, 8]:
-            continue
+_LANE_MAP_TYPE0_2 = {0: -405, 1: -135, 2: 135, 3: 405}
+_LANE_MAP_TYPE1 = {0: -270, 2: 270}
+_FIXED_NOTE_TEMPLATE = {
+    "above": 1, "alpha": 255, "color": [255, 255, 255],
+    "endTime": [0, 0, 1], "isFake": 0, "judgeArea": 1.0,
+    "positionX": 0.0, "size": 1.0, "speed": 1.0,
+    "startTime": [0, 0, 1], "type": 1, "visibleTime": 1.0, "yOffset": 0.0
+}
 
-        t_start = Fraction(int(note['time']), 1000) + 1
-        t_end = t_start
-
-        if note['type'] == 0:  # chip
-            half = 0 if note['lane'] in [0, 1] else 2
-            raw_notes.append((t_start, 0, note['lane'], idx, t_end, half))
-        elif note['type'] == 2:  # hold
-            half = 0 if note['lane'] in [0, 1] else 2
-            raw_notes.append((t_start, 2, note['lane'], idx, Fraction(int(note['extra']['1']), 1000) + 1, half))
-        elif note['type'] in [1, 8]:  # bumper
-            half = note['lane']
-            raw_notes.append((t_start, 1, note['lane'], idx, t_end, half))
-        elif note['type'] == 6:  # mine
-            half = 0 if note['lane'] in [0, 1] else 2
-            raw_notes.append((t_start, 6, note['lane'], idx, t_end, half))
-        elif note['type'] == 7:  # bumper mine
-            half = note['lane']
-            raw_notes.append((t_start, 7, note['lane'], idx, t_end, half))
 
+def _raw_note(idx, note):
+    # (时间, 类型, 轨道, 原始索引, 结束时间, 半区), 不参与转换的音符返回None
+    if note['type'] not in [0, 1, 2, 6, 7, 8]:
+        return None
+
+    t_start = Fraction(int(note['time']), 1000) + 1
+    t_end = t_start
+
+    if note['type'] == 0:  # chip
+        half = 0 if note['lane'] in [0, 1] else 2
+        return (t_start, 0, note['lane'], idx, t_end, half)
+    elif note['type'] == 2:  # hold
+        half = 0 if note['lane'] in [0, 1] else 2
+        return (t_start, 2, note['lane'], idx, Fraction(int(note['extra']['1']), 1000) + 1, half)
+    elif note['type'] in [1, 8]:  # bumper
+        half = note['lane']
+        return (t_start, 1, note['lane'], idx, t_end, half)
+    elif note['type'] == 6:  # mine
+        half = 0 if note['lane'] in [0, 1] else 2
+        return (t_start, 6, note['lane'], idx, t_end, half)
+    else:  # bumper mine
+        half = note['lane']
+        return (t_start, 7, note['lane'], idx, t_end, half)
+
+
+def _prepare_raw_notes(vsb_data):
+    raw_notes = [raw for raw in (_raw_note(idx, note) for idx, note in enumerate(vsb_data)) if raw is not None]
     raw_notes.sort(key=lambda x: x[0])
+    return raw_notes
+
+
+def _scan_half(half_notes, target_half, issues=None, start=0, lane_state=None):
+    """按时间顺序处理一个半区, 每确定一个非bumper音符或一整条bumper链就产出一组(时间, RPE音符)
+
+    产出(起始位置, 轨道状态, 组); 轨道状态为该位置之前两个轨道各自最晚的hold结束时间和最后一个非bumper音符,
+    以它和起始位置调用可以从任意一组开始重新处理.
+    """
+    # 下标为 轨道 - target_half; 向前推进时维护, 代替从每条链向前逐个查找
+    hold_end = [None, None] if lane_state is None else list(lane_state[:2])
+    last = [None, None] if lane_state is None else list(lane_state[2:])
+    i = start
+
+    while i < len(half_notes):
+        time, typ, lane, orig_idx, end_time, _ = half_notes[i]
+        state = (hold_end[0], hold_end[1], last[0], last[1])
+
+        # not bumper
+        if typ != 1 and typ != 8:
+            k = lane - target_half
+            if k in (0, 1):
+                last[k] = (time, typ, end_time)
+                if typ == 2 and (hold_end[k] is None or end_time > hold_end[k]):
+                    hold_end[k] = end_time
+
+            new_note = _FIXED_NOTE_TEMPLATE.copy()
+            new_note['startTime'] = [int(time), time.numerator % time.denominator, time.denominator]
+            new_note['endTime'] = [int(end_time), end_time.numerator % end_time.denominator, end_time.denominator]
+
+            if typ == 0:  # Chip
+                new_note['positionX'] = _LANE_MAP_TYPE0_2[lane]
+            elif typ == 2:  # Hold
+                new_note['type'] = 2
+                new_note['positionX'] = _LANE_MAP_TYPE0_2[lane]
+            elif typ == 6:  # 普通地雷
+                new_note['type'] = 3
+                new_note['isFake'] = 1
+                new_note['alpha'] = 127
+                new_note['positionX'] = _LANE_MAP_TYPE0_2.get(lane, 0.0)
+            elif typ == 7:  # bumper地雷
+                new_note['type'] = 3
+                new_note['isFake'] = 1
+                new_note['alpha'] = 127
+                new_note['positionX'] = _LANE_MAP_TYPE1.get(lane, 0.0)
+                new_note['size'] = 2.6
+
+            yield i, state, [(time, new_note)]
+            i += 1
+            continue
 
-    # 半区处理
-    for target_half in [0, 2]:
-        half_notes = [n for n in raw_notes if n[5] == target_half]
-        i = 0
-
-        while i < len(half_notes):
-            time, typ, lane, orig_idx, end_time, _ = half_notes[i]
-
-            # not bumper
-            if typ != 1 and typ != 8:
-                new_note = fixed_note_template.copy()
-                new_note['startTime'] = [int(time), time.numerator % time.denominator, time.denominator]
-                new_note['endTime'] = [int(end_time), end_time.numerator % end_time.denominator, end_time.denominator]
-
-                if typ == 0:  # Chip
-                    new_note['positionX'] = lane_map_type0_2[lane]
-                elif typ == 2:  # Hold
-                    new_note['type'] = 2
-                    new_note['positionX'] = lane_map_type0_2[lane]
-                elif typ == 6:  # 普通地雷
-                    new_note['type'] = 3
-                    new_note['isFake'] = 1
-                    new_note['alpha'] = 127
-                    new_note['positionX'] = lane_map_type0_2.get(lane, 0.0)
-                elif typ == 7:  # bumper地雷
-                    new_note['type'] = 3
-                    new_note['isFake'] = 1
-                    new_note['alpha'] = 127
-                    new_note['positionX'] = lane_map_type1.get(lane, 0.0)
-                    new_note['size'] = 2.6
-
-                notes_list.append(new_note)
-                i += 1
-                continue            
-
-            # bumper chain detection
-            chain_start = i
-            chain_end = i
-
-            # extend chain as far as p
-            while chain_end + 1 < len(half_notes) and half_notes[chain_end + 1][1] == 1:
-                chain_end += 1
-
-            chain = half_notes[chain_start:chain_end + 1]
-
-            # 如果有hold盖着直接确定
-            filtered_chain = []
-            for bumper in chain:
+        # bumper chain detection
+        chain_start = i
+        chain_end = i
+
+        # extend chain as far as p
+        while chain_end + 1 < len(half_notes) and half_notes[chain_end + 1][1] == 1:
+            chain_end += 1
+
+        chain = half_notes[chain_start:chain_end + 1]
+        group = []
+
+        # 如果有hold盖着直接确定
+        filtered_chain = []
+        for bumper in chain:
+            b_time = bumper[0]
+            cover_info = None
+
+            # 確定是否被覆蓋以及檢測是否有同側雙押hold覆蓋(非法配置)
+            for k, lane in enumerate([target_half, target_half + 1]):
+                if hold_end[k] is not None and hold_end[k] >= b_time:
+                    if cover_info is not None:
+                        if issues is None:
+                            raise ValueError(f"轨道{target_half}/{target_half + 1}上同时有Hold覆盖Bumper，bro你这怎么打")
+                        issues.append({"level": "error", "code": "hold_covers_bumper_both_lanes",
+                                       "time": _chart_ms(b_time), "lanes": [target_half, target_half + 1]})
+                        break
+                    cover_info = (True, lane)
+
+            if cover_info:
+                new_note = _FIXED_NOTE_TEMPLATE.copy()
                 b_time = bumper[0]
-                cover_info = None
-
-                # 確定是否被覆蓋以及檢測是否有同側雙押hold覆蓋(非法配置)
-                for lane in [target_half, target_half + 1]:
-                    idx = chain_start - 1
-                    while idx >= 0:
-                        t, tp, ln, _, et, _ = half_notes[idx]
-                        if ln == lane and tp == 2 and et >= b_time:
-                            if cover_info is not None:
-                                raise ValueError(f"轨道{target_half}/{target_half + 1}上同时有Hold覆盖Bumper，bro你这怎么打")
-                            cover_info = (True, ln)
-                            break
-                        idx -= 1
-
-                if cover_info:
-                    new_note = fixed_note_template.copy()
-                    b_time = bumper[0]
-                    new_note['startTime'] = [int(b_time), b_time.numerator % b_time.denominator, b_time.denominator]
-                    new_note['endTime'] = new_note['startTime'].copy()
-                    new_note['type'] = 1
-                    base_pos = -270 if target_half == 0 else 270
-                    cover_lane = cover_info[1]
-                    offset = 85 if cover_lane in [0, 2] else -85
-                    new_note['positionX'] = base_pos + offset
-                    notes_list.append(new_note)
-                else:
-                    filtered_chain.append(bumper)
+                new_note['startTime'] = [int(b_time), b_time.numerator % b_time.denominator, b_time.denominator]
+                new_note['endTime'] = new_note['startTime'].copy()
+                new_note['type'] = 1
+                base_pos = -270 if target_half == 0 else 270
+                cover_lane = cover_info[1]
+                offset = 85 if cover_lane in [0, 2] else -85
+                new_note['positionX'] = base_pos + offset
+                group.append((b_time, new_note))
+            else:
+                filtered_chain.append(bumper)
 
-            if not filtered_chain:
-                i = chain_end + 1
-                continue
+        if not filtered_chain:
+            yield i, state, group
+            i = chain_end + 1
+            continue
 
-            # (虚拟)头音符, 返回time和lane
-            def get_virtual_head_note():
-                candidates = []
-
-                for lane in [target_half, target_half + 1]:
-                    idx = chain_start - 1
-                    while idx >= 0:
-                        if half_notes[idx][2] == lane and half_notes[idx][1] != 1 and half_notes[idx][1] != 8:
-                            t, tp, ln, _, et, _ = half_notes[idx]
-                            is_chip = (tp == 0)
-                            effective_time = et if (tp == 2) else t
-                            candidates.append((effective_time, ln, is_chip))
-                            break
-                        idx -= 1
-
-                if not candidates:
+        # (虚拟)头音符, 返回time和lane
+        def get_virtual_head_note():
+            candidates = []
+
+            for k, lane in enumerate([target_half, target_half + 1]):
+                if last[k] is not None:
+                    t, tp, et = last[k]
+                    is_chip = (tp == 0)
+                    effective_time = et if (tp == 2) else t
+                    candidates.append((effective_time, lane, is_chip))
+
+            if not candidates:
+                return None, None, False
+
+            # 双押情况下Chip优先
+            chip_candidates = [c for c in candidates if c[2]]
+            if len(candidates) == 2 and candidates[0][0] == candidates[1][0]:
+                if len(chip_candidates) == 1:
+                    return chip_candidates[0][0], chip_candidates[0][1], False
+                elif len(chip_candidates) == 2:
                     return None, None, False
 
-                # 双押情况下Chip优先
-                chip_candidates = [c for c in candidates if c[2]]
-                if len(candidates) == 2 and candidates[0][0] == candidates[1][0]:
-                    if len(chip_candidates) == 1:
-                        return chip_candidates[0][0], chip_candidates[0][1]
-                    elif len(chip_candidates) == 2:
-                        return None, None
-
-                best = max(candidates, key=lambda x: x[0])
-
-                # hold特殊情況處理
-                if not best[2]:
-                    return best[0], best[1], True
-
-                return best[0], best[1], False
-
-            # 尾音符 BREAKPOINT 為什麼此處沒有雙軌判斷?
-            def get_tail_note():
-                idx = chain_end + 1
-
-                if idx >= len(half_notes):
-                    return None, None
-
-                while idx < len(half_notes) and half_notes[idx][1] == 1:
-                    idx += 1
-
-                t, tp, ln, _, et, _ = half_notes[idx]
-                return (t, ln)
-
-            head_time, head_lane, head_is_hold = get_virtual_head_note()
-            tail_time, tail_lane = get_tail_note()
-
-            # 倾向
-            def get_tendency(lane, half):
-                if lane == half:
-                    return half + 1
-                elif lane == half + 1:
-                    return half
-                return None
-
-            head_tendency = get_tendency(head_lane, target_half) if head_lane is not None else None
-            tail_tendency = get_tendency(tail_lane, target_half) if tail_lane is not None else None
-
-            # 双押处理
-            if head_tendency is None and tail_tendency is not None:
-                head_tendency = tail_tendency
-            elif tail_tendency is None and head_tendency is not None:
-                tail_tendency = head_tendency
-            elif head_tendency is None and tail_tendency is None:
-                if len(filtered_chain) % 2 == 1:
-                    head_tendency = 1 if target_half == 0 else 2
-                    tail_tendency = 1 if target_half == 0 else 2
-                else:
-                    head_tendency = 0 if target_half == 0 else 3
-                    tail_tendency = 1 if target_half == 0 else 2
-
-            # 初始交替分配
-            assigned_lanes = []
-            cur = head_tendency
-            for _ in filtered_chain:
-                assigned_lanes.append(cur)
-                cur = target_half + 1 if cur == target_half else target_half
-
-            # 对齐验证
-            if assigned_lanes and tail_tendency is not None:
-                if assigned_lanes[-1] != tail_tendency:
-                    intervals = []
-
-                    # 头->首
-                    if head_time is not None:
-                        gap = filtered_chain[0][0] - head_time
-                        intervals.append((gap, -1))
-
-                    # 中间
-                    for j in range(len(filtered_chain) - 1):
-                        gap = filtered_chain[j + 1][0] - filtered_chain[j][0]
-                        intervals.append((gap, j))
-
-                    # 尾->末
-                    if tail_time is not None:
-                        last_end = filtered_chain[-1][0]
-                        gap = tail_time - last_end
-                        intervals.append((gap, len(filtered_chain) - 1))
-
-                    first_interval = intervals[0]
-
-                    intervals.sort(key=lambda x: (-float(x[0]), -x[1]))
-
-                    if intervals[0][0] < 0.05:
-                        if head_is_hold:
-                            for k in range(len(assigned_lanes)):
-                                assigned_lanes[k] = target_half + 1 if assigned_lanes[k] == target_half else target_half
-                        elif first_interval[0] == 0:
-                            print(f"警告: {head_lane}轨chip与同侧bumper需同时于{int(head_time)}:{head_time.numerator % head_time.denominator}/{head_time.denominator}击打, 别写这种配置啊!")
-                    else:
-                        max_gap_idx = intervals[0][1]
-
-                        for k in range(max_gap_idx + 1, len(assigned_lanes)):
+            best = max(candidates, key=lambda x: x[0])
+
+            # hold特殊情況處理
+            if not best[2]:
+                return best[0], best[1], True
+
+            return best[0], best[1], False
+
+        # 尾音符 BREAKPOINT 為什麼此處沒有雙軌判斷?
+        def get_tail_note():
+            idx = chain_end + 1
+
+            if idx >= len(half_notes):
+                return None, None
+
+            while idx < len(half_notes) and half_notes[idx][1] == 1:
+                idx += 1
+
+            if idx >= len(half_notes):
+                return None, None
+
+            t, tp, ln, _, et, _ = half_notes[idx]
+            return (t, ln)
+
+        head_time, head_lane, head_is_hold = get_virtual_head_note()
+        tail_time, tail_lane = get_tail_note()
+
+        # 倾向
+        def get_tendency(lane, half):
+            if lane == half:
+                return half + 1
+            elif lane == half + 1:
+                return half
+            return None
+
+        head_tendency = get_tendency(head_lane, target_half) if head_lane is not None else None
+        tail_tendency = get_tendency(tail_lane, target_half) if tail_lane is not None else None
+
+        # 双押处理
+        if head_tendency is None and tail_tendency is not None:
+            head_tendency = tail_tendency
+        elif tail_tendency is None and head_tendency is not None:
+            tail_tendency = head_tendency
+        elif head_tendency is None and tail_tendency is None:
+            if len(filtered_chain) % 2 == 1:
+                head_tendency = 1 if target_half == 0 else 2
+                tail_tendency = 1 if target_half == 0 else 2
+            else:
+                head_tendency = 0 if target_half == 0 else 3
+                tail_tendency = 1 if target_half == 0 else 2
+
+        # 初始交替分配
+        assigned_lanes = []
+        cur = head_tendency
+        for _ in filtered_chain:
+            assigned_lanes.append(cur)
+            cur = target_half + 1 if cur == target_half else target_half
+
+        # 对齐验证
+        if assigned_lanes and tail_tendency is not None:
+            if assigned_lanes[-1] != tail_tendency:
+                intervals = []
+
+                # 头->首
+                if head_time is not None:
+                    gap = filtered_chain[0][0] - head_time
+                    intervals.append((gap, -1))
+
+                # 中间
+                for j in range(len(filtered_chain) - 1):
+                    gap = filtered_chain[j + 1][0] - filtered_chain[j][0]
+                    intervals.append((gap, j))
+
+                # 尾->末
+                if tail_time is not None:
+                    last_end = filtered_chain[-1][0]
+                    gap = tail_time - last_end
+                    intervals.append((gap, len(filtered_chain) - 1))
+
+                first_interval = intervals[0]
+
+                intervals.sort(key=lambda x: (-float(x[0]), -x[1]))
+
+                if intervals[0][0] < 0.05:
+                    if head_is_hold:
+                        for k in range(len(assigned_lanes)):
                             assigned_lanes[k] = target_half + 1 if assigned_lanes[k] == target_half else target_half
+                    elif first_interval[0] == 0 and head_time is not None and issues is not None:
+                        issues.append({"level": "warning", "code": "chip_and_same_side_bumper",
+                                       "time": _chart_ms(head_time), "lanes": [head_lane]})
+                    elif first_interval[0] == 0 and head_time is not None:
+                        print(f"警告: {head_lane}轨chip与同侧bumper需同时于{int(head_time)}:{head_time.numerator % head_time.denominator}/{head_time.denominator}击打, 别写这种配置啊!")
+                else:
+                    max_gap_idx = intervals[0][1]
 
-            # 输出bumper
-            for (time, _, _, _, _, _), out_lane in zip(filtered_chain, assigned_lanes):
-                new_note = fixed_note_template.copy()
-                new_note['startTime'] = [int(time), time.numerator % time.denominator, time.denominator]
-                new_note['endTime'] = new_note['startTime'].copy()
-                new_note['type'] = 1
+                    for k in range(max_gap_idx + 1, len(assigned_lanes)):
+                        assigned_lanes[k] = target_half + 1 if assigned_lanes[k] == target_half else target_half
 
-                base_pos = -270 if target_half == 0 else 270
-                offset = -85 if out_lane in [0, 2] else 85
-                new_note['positionX'] = base_pos + offset
+        # 输出bumper
+        for (time, _, _, _, _, _), out_lane in zip(filtered_chain, assigned_lanes):
+            new_note = _FIXED_NOTE_TEMPLATE.copy()
+            new_note['startTime'] = [int(time), time.numerator % time.denominator, time.denominator]
+            new_note['endTime'] = new_note['startTime'].copy()
+            new_note['type'] = 1
 
-                notes_list.append(new_note)
+            base_pos = -270 if target_half == 0 else 270
+            offset = -85 if out_lane in [0, 2] else 85
+            new_note['positionX'] = base_pos + offset
 
-            i = chain_end + 1
+            group.append((time, new_note))
+
+        yield i, state, group
+        i = chain_end + 1
+
+
+def _iter_half_groups(half_notes, target_half, issues=None):
+    for _, _, group in _scan_half(half_notes, target_half, issues):
+        yield group
+
+
+def _half_streams(vsb_data, issues=None):
+    raw_notes = _prepare_raw_notes(vsb_data)
+    return [_iter_half_groups([n for n in raw_notes if n[5] == target_half], target_half, issues)
+            for target_half in [0, 2]]
+
+
+def convert_vsb_to_notes(vsb_data, issues=None):
+    # issues不为None时, 非法配置记录到其中而不是抛出/打印
+    # 先左半区再右半区, 每条bumper链内被hold覆盖的bumper在前
+    return [note for stream in _half_streams(vsb_data, issues) for group in stream for _, note in group]
+
+
+def iter_notes_time_ordered(vsb_data, issues=None):
+    """与convert_vsb_to_notes音符相同, 但按startTime全局排序逐个产出
+
+    两个半区交替推进, 一条bumper链确定后其中的音符即可产出; 同一时间的音符左半区在前.
+    """
+    def ordered(stream):
+        for group in stream:
+            # 链内被hold覆盖的bumper与其它bumper按时间归并
+            yield from sorted(group, key=lambda tn: tn[0])
+
+    for _, note in heapq.merge(*(ordered(stream) for stream in _half_streams(vsb_data, issues)),
+                               key=lambda tn: tn[0]):
+        yield note
 
-    return notes_list
 
 import re
 import unicodedata
 
-def build_final_json(meta_str, notes_list):
-    def _flatten_lists(obj):
-        if isinstance(obj, list):
-            return str(obj)
-        if isinstance(obj, dict):
-            return {k: _flatten_lists(v) for k, v in obj.items()}
-        return obj
+def render_event_layer(event_layer):
+    layer_str = json.dumps(event_layer, ensure_ascii=False, indent=3, sort_keys=True, separators=(',', ' : '))
+    # 数字列表写成单行, 与模板一致
+    layer_str = re.sub(r'\[\s*(-?\d[\d.eE+-]*(?:,\s*-?\d[\d.eE+-]*)*)\s*\]',
+                       lambda m: '[ ' + ', '.join(re.split(r',\s*', m.group(1))) + ' ]', layer_str)
+    return '\n'.join(' ' * 12 + line for line in layer_str.split('\n'))
+
+
+_TMPL_META = '"META" : {\n      "RPEVersion" : 170,\n      "background" : "black.png",\n      "charter" : "vsb2pez",\n      "composer" : "vsb2pez",\n      "duration" : 392.90701293945312,\n      "id" : "6708198698448521",\n      "illustration" : "",\n      "level" : "0",\n      "name" : "vsb2pez",\n      "offset" : -1028,\n      "song" : "6708198698448521.ogg"\n   },'
+_TMPL_EVENT_ANCHOR = '            }\n         ],\n         "extended"'
+
+
+def _flatten_lists(obj):
+    if isinstance(obj, list):
+        return str(obj)
+    if isinstance(obj, dict):
+        return {k: _flatten_lists(v) for k, v in obj.items()}
+    return obj
 
+
+def _insert_event_layer(out, event_layer):
+    # vsm事件作为额外一层追加, 与模板中的基础层叠加
+    return out.replace(_TMPL_EVENT_ANCHOR,
+                       '            },\n' + render_event_layer(event_layer) + '\n         ],\n         "extended"', 1)
+
+
+def build_final_json(meta_str, notes_list, event_layer=None):
     flat_notes = [_flatten_lists(n) for n in notes_list]
     notes_str = json.dumps(flat_notes, ensure_ascii=False, indent=3, separators=(',', ' : '))
     notes_str = re.sub(r'"\[(\d+(?:, \d+)*)\]"', r'[\1]', notes_str)
     notes_str = re.sub(r'^\[\n', '', notes_str)
     notes_str = re.sub(r'\n\]$', '', notes_str)
-    out = TMPL.replace(
-        '"META" : {\n      "RPEVersion" : 170,\n      "background" : "black.png",\n      "charter" : "vsb2pez",\n      "composer" : "vsb2pez",\n      "duration" : 392.90701293945312,\n      "id" : "6708198698448521",\n      "illustration" : "",\n      "level" : "0",\n      "name" : "vsb2pez",\n      "offset" : -1028,\n      "song" : "6708198698448521.ogg"\n   },',
-        meta_str)
-    out = out.replace('"notes" : []', f'"notes" : [{notes_str}\n         ]')
+    out = TMPL.replace(_TMPL_META, meta_str)
+    if flat_notes:
+        # 没有音符时保留模板中的"notes" : []
+        out = out.replace('"notes" : []', f'"notes" : [{notes_str}\n         ]')
     out = out.replace('"numOfNotes" : 0', f'"numOfNotes" : {len(notes_list)}')
+    if event_layer:
+        out = _insert_event_layer(out, event_layer)
     return out
 
+
+def write_final_json(f, meta_str, notes, event_layer=None):
+    """与build_final_json输出相同, 但notes可以是生成器, 逐个音符写入f; 返回音符数
+
+    模板中numOfNotes在notes之后, 写到那里时音符数已知.
+    """
+    out = TMPL.replace(_TMPL_META, meta_str)
+    if event_layer:
+        out = _insert_event_layer(out, event_layer)
+    head, rest = out.split('"notes" : []', 1)
+    middle, tail = rest.split('"numOfNotes" : 0', 1)
+
+    f.write(head + '"notes" : [')
+    count = 0
+    for note in notes:
+        note_str = json.dumps([_flatten_lists(note)], ensure_ascii=False, indent=3, separators=(',', ' : '))
+        note_str = re.sub(r'"\[(\d+(?:, \d+)*)\]"', r'[\1]', note_str)
+        # 去掉外层的"[\n"和"\n]"
+        f.write((',\n' if count else '') + note_str[2:-2])
+        count += 1
+    # 与build_final_json一样, 没有音符时输出"notes" : []
+    f.write(('\n         ]' if count else ']') + middle + f'"numOfNotes" : {count}' + tail)
+    return count
+
 def sanitize(name: str, replacement: str = ' ') -> str:
     if not isinstance(name, str):
         raise TypeError('name 必须是 str 类型')
@@ -757,100 +910,591 @@ def sanitize(name: str, replacement: str = ' ') -> str:
     return name
 
 
+def load_vsb_data(vsb_path):
+    with open(vsb_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_chart_notes(vsb_path):
+    vsb_data = load_vsb_data(vsb_path)
+    return vsb_data, convert_vsb_to_notes(vsb_data)
+
+
+def get_pez_name(difficulty, song_info):
+    return f"{sanitize(song_info['formatted_name'].replace('#', r' '))} - {difficulty.replace('.json', '')}.pez"
+
+
+def get_pez_path(chart_id, difficulty, song_info, output_dir=None):
+    return os.path.join(output_dir or OUTPUT_DIR, chart_id, get_pez_name(difficulty, song_info))
+
+
+def resolve_difficulty(difficulty):
+    # 接受 FINALE / FINALE.json / FN
+    name = str(difficulty).upper().replace(".JSON", "")
+    for diff_file, info in DIFFICULTY_MAP.items():
+        if name in (diff_file.replace(".json", ""), info["abbr"]):
+            return diff_file
+    raise ValueError(f"未知难度: {difficulty}")
+
+
+class DirectorySink:
+    """输出为 <output_dir>/<chart_id>/<曲名> - <难度>.pez"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock_for(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def write(self, chart_id, difficulty, pez_name, staging_dir):
+        pez_path = os.path.join(self.output_dir, chart_id, pez_name)
+        os.makedirs(os.path.dirname(pez_path), exist_ok=True)
+        # 同一个pez的临时zip路径相同, 需要串行
+        with self._lock_for(pez_path):
+            compress_folder_to_pez(staging_dir, pez_path)
+        return pez_path, os.path.getsize(pez_path)
+
+    def close(self):
+        pass
+
+
+class StagingSink:
+    """不打包, 把staging目录原样作为输出; 工作进程转换后由父进程写入真正的sink
+
+    成功数由父进程在打包之后计入.
+    """
+
+    deferred = True
+
+    def write(self, chart_id, difficulty, pez_name, staging_dir):
+        return staging_dir, 0
+
+    def close(self):
+        pass
+
+
+def make_sink(kind, output_dir, path=None):
+    # dir: 每个pez一个文件; bundle: 单个zip库; sqlite: SQLite BLOB库
+    if kind == "dir":
+        return DirectorySink(path or output_dir)
+    if kind == "bundle":
+        return BundleSink(path or os.path.join(output_dir, BUNDLE_NAME))
+    if kind == "sqlite":
+        return SQLiteSink(path or os.path.join(output_dir, SQLITE_NAME))
+    raise ValueError(f"未知输出方式: {kind}")
+
+
+ConversionResult = namedtuple('ConversionResult', ['chart_id', 'difficulty', 'ok', 'output', 'notes',
+                                                   'error', 'warnings', 'elapsed'])
+
+
+class ConversionContext:
+    """转换所需的路径、曲目信息、缓存和输出; convert可被多个线程同时调用"""
+
+    def __init__(self, base_dir=None, output_dir=None, sink=None, note_loader=load_chart_notes, metrics=None,
+                 vsb_json_dir=None, charts_dir=None, audio_dir=None, sprite_dir=None,
+                 song_info_path=None, black_png_path=None, asset_store=None, stream_notes=False,
+                 song_info=None, base_image=None, cover_profile=None, cover_dir=None, data_loader=load_vsb_data):
+        def path(explicit, name, default):
+            if explicit:
+                return explicit
+            return os.path.join(base_dir, name) if base_dir else default
+
+        self.vsb_json_dir = path(vsb_json_dir, "vsbjson", VSB_JSON_DIR)
+        self.charts_dir = path(charts_dir, "Charts", CHARTS_DIR)
+        self.audio_dir = path(audio_dir, "audiogroup_default", AUDIO_DIR)
+        self.sprite_dir = path(sprite_dir, "Sprites", SPRITE_DIR)
+        self.output_dir = path(output_dir, "pezOutput", OUTPUT_DIR)
+        self.song_info_path = path(song_info_path, "song_information.json", SONG_INFO_PATH)
+        self.black_png_path = path(black_png_path, "black.png", BLACK_PNG_PATH)
+        self.sink = sink or DirectorySink(self.output_dir)
+        # AssetStore, 为None时每次都复制音频、重新合成封面
+        self.asset_store = asset_store
+        self.note_loader = note_loader
+        # 为True时音符按时间顺序边生成边写入谱面JSON, 不构建完整的音符列表; 此时用data_loader只读取vsbjson
+        self.stream_notes = stream_notes
+        self.data_loader = data_loader
+        self.metrics = metrics or METRICS
+        # 封面编码档位(见cover_render.COVER_PROFILES); cover_dir为已渲染好的封面目录(如父进程的), 可与其它进程共用
+        self.cover_profile = get_cover_profile(cover_profile)
+        self._cover_dir = cover_dir
+
+        self._lock = threading.Lock()
+        # 可以直接给出已加载的曲目信息和底图(如共享内存中的), 否则首次使用时从路径加载
+        self._song_info = song_info
+        self._base_image = base_image
+        self._assets = None
+        self._covers = None
+        self._durations = {}
+
+    @property
+    def song_info(self):
+        with self._lock:
+            if self._song_info is None:
+                self._song_info = load_song_info(self.song_info_path)
+            return self._song_info
+
+    @property
+    def base_image(self):
+        with self._lock:
+            if self._base_image is None:
+                self._base_image = load_base_image(self.black_png_path)
+            return self._base_image
+
+    @property
+    def assets(self):
+        with self._lock:
+            if self._assets is None:
+                self._assets = AssetCatalog(self.audio_dir, self.sprite_dir)
+            return self._assets
+
+    @property
+    def covers(self):
+        base_image = self.base_image
+        with self._lock:
+            if self._covers is None:
+                store, black_png_path, profile = self.asset_store, self.black_png_path, self.cover_profile
+                self._covers = CoverRenderer(
+                    base_image, profile, store,
+                    key_func=lambda sprite_path: cover_cache_key(store, black_png_path, sprite_path, profile),
+                    cache_dir=self._cover_dir, work_dir=self.output_dir)
+            return self._covers
+
+    @contextlib.contextmanager
+    def using_covers(self):
+        # reload可能在转换过程中换下渲染器, 用完之前不删除它的目录
+        while True:
+            covers = self.covers
+            with self._lock:
+                # 取到之后又被reload换下的渲染器可能已经删除, 重新取
+                if self._covers is covers:
+                    covers.acquire()
+                    break
+        try:
+            yield covers
+        finally:
+            covers.release()
+
+    def close(self):
+        # 删除本进程建立的封面临时目录; 还在使用的在最后一个使用者结束时删除
+        with self._lock:
+            covers, self._covers = self._covers, None
+        if covers is not None:
+            covers.retire()
+
+    def reload(self):
+        self.close()
+        with self._lock:
+            self._song_info = None
+            self._base_image = None
+            self._assets = None
+            self._durations.clear()
+
+    def get_audio_duration(self, chart_id, warnings=None):
+        with self._lock:
+            if chart_id in self._durations:
+                self.metrics.inc("duration_cache_hits")
+                return self._durations[chart_id]
+        self.metrics.inc("duration_cache_misses")
+
+        entry = self.assets.get(chart_id)
+        duration = probe_audio_duration(entry.audio_path, entry.audio_ext, warnings) if entry else 1.0
+        with self._lock:
+            self._durations[chart_id] = duration
+        return duration
+
+    def convert(self, chart_id, difficulty):
+        try:
+            diff_file = resolve_difficulty(difficulty)
+            song_info = self.song_info.get(chart_id)
+            if song_info is None:
+                raise LookupError(f"无元数据: {chart_id}")
+        except Exception as e:
+            return ConversionResult(chart_id, difficulty, False, None, 0, str(e), [], 0.0)
+        vsb_path = os.path.join(self.vsb_json_dir, chart_id, diff_file)
+        return self.convert_file(vsb_path, chart_id, diff_file, song_info)
+
+    def convert_file(self, vsb_path, chart_id, difficulty, song_info):
+        start = time.perf_counter()
+        metrics = self.metrics
+        warnings = []
+        staging_dir = None
+        note_count = 0
+        try:
+            with metrics.stage("notes"):
+                if self.stream_notes:
+                    vsb_data, notes = self.data_loader(vsb_path), None
+                else:
+                    vsb_data, notes = self.note_loader(vsb_path)
+                    note_count = len(notes)
+            metrics.inc("bytes_read", os.path.getsize(vsb_path))
+
+            assets = self.assets.get(chart_id)
+            if assets is None:
+                raise FileNotFoundError(f"音频文件不存在: music_chart_{chart_id}.ogg 或 .wav")
+            audio_ext = assets.audio_ext
+
+            id_str = calculate_id(song_info["song_id"])
+            duration = self.get_audio_duration(chart_id, warnings)
+            meta_str = generate_meta_str(song_info, difficulty, duration, id_str, audio_ext)
+            event_layer = None
+            vsm_path = find_vsm_file(os.path.join(self.charts_dir, chart_id), difficulty.replace(".json", ""))
+            if vsm_path:
+                with metrics.stage("events"):
+                    event_layer = load_vsm_event_layer(vsm_path, vsb_data)
+
+            # 每次转换独立的临时目录, 并发转换互不干扰
+            os.makedirs(self.output_dir, exist_ok=True)
+            staging_dir = tempfile.mkdtemp(prefix=f".{chart_id}-{difficulty.replace('.json', '')}-",
+                                           dir=self.output_dir)
+            with metrics.stage("build_json"), \
+                    open(os.path.join(staging_dir, f"{id_str}.json"), 'w', encoding='utf-8') as f:
+                if notes is None:
+                    note_count = write_final_json(f, meta_str, iter_notes_time_ordered(vsb_data), event_layer)
+                else:
+                    f.write(build_final_json(meta_str, notes, event_layer))
+            metrics.inc("notes_converted", note_count)
+            info_content = generate_info_txt(song_info, difficulty, id_str, duration, audio_ext)
+            with open(os.path.join(staging_dir, "info.txt"), 'w', encoding='utf-8') as f:
+                f.write(info_content)
+            with metrics.stage("resources"), self.using_covers() as covers:
+                copy_resource_files(staging_dir, chart_id, id_str, audio_ext, warnings=warnings, assets=assets,
+                                    store=self.asset_store, covers=covers)
+            metrics.inc("bytes_read", assets.audio_size)
+
+            with metrics.stage("package"):
+                output, size = self.sink.write(chart_id, difficulty, get_pez_name(difficulty, song_info), staging_dir)
+            staging_dir = None
+            metrics.inc("bytes_written", size)
+            if not getattr(self.sink, "deferred", False):
+                metrics.inc("difficulties_succeeded")
+            return ConversionResult(chart_id, difficulty, True, output, note_count, None, warnings,
+                                    time.perf_counter() - start)
+        except Exception as e:
+            metrics.inc("difficulties_failed")
+            return ConversionResult(chart_id, difficulty, False, None, note_count, f"{type(e).__name__}: {e}",
+                                    warnings, time.perf_counter() - start)
+        finally:
+            if staging_dir and os.path.isdir(staging_dir):
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+_worker_shared = None
+_worker_context = None
+
+
+def _init_convert_worker(shared_handle, output_dir, asset_cache, asset_cache_bytes, stream_notes, cover_profile,
+                         cover_dir):
+    # 曲目信息和底图直接映射父进程发布的共享内存, 工作进程不再各自加载、解码
+    # 封面由父进程预先渲染到cover_dir(或资源缓存)中, 工作进程只链接
+    global _worker_shared, _worker_context
+    _worker_shared = SharedAssets.attach(shared_handle)
+    store = AssetStore(asset_cache, asset_cache_bytes) if asset_cache else None
+    _worker_context = ConversionContext(output_dir=output_dir, sink=StagingSink(), asset_store=store,
+                                        stream_notes=stream_notes, song_info=_worker_shared.catalog,
+                                        base_image=_worker_shared.base_image, cover_profile=cover_profile,
+                                        cover_dir=cover_dir)
+
+
+def _convert_in_worker(vsb_path, chart_id, difficulty):
+    # 返回结果(output为staging目录)和这次转换的指标, 由父进程打包并合并指标
+    context = _worker_context
+    context.metrics = Metrics()
+    store = context.asset_store
+    hits, misses = (store.hits, store.misses) if store is not None else (0, 0)
+    result = context.convert_file(vsb_path, chart_id, difficulty, context.song_info[chart_id])
+    if store is not None:
+        context.metrics.inc("asset_cache_hits", store.hits - hits)
+        context.metrics.inc("asset_cache_misses", store.misses - misses)
+    return result, context.metrics.to_dict()
+
+
+_default_context = None
+
+
+def get_default_context():
+    # 兼容按模块全局变量调用的旧接口
+    global _default_context
+    if _default_context is None:
+        _default_context = ConversionContext()
+        atexit.register(_default_context.close)
+    return _default_context
+
+
 def process_single_chart(vsb_path, chart_id, difficulty, song_info):
+    result = get_default_context().convert_file(vsb_path, chart_id, difficulty, song_info)
+    for warning in result.warnings:
+        print(f"警告: {warning}")
+    if not result.ok:
+        print(f"  失败: {result.error}")
+    return result.ok
+
+
+def lint_chart(chart_id, difficulty, vsb_path):
+    issues = []
     try:
-        with open(vsb_path, 'r', encoding='utf-8') as f:
-            vsb_data = json.load(f)
-
-        src_audio_ogg = os.path.join(AUDIO_DIR, f"music_chart_{chart_id}.ogg")
-        src_audio_wav = os.path.join(AUDIO_DIR, f"music_chart_{chart_id}.wav")
-        if os.path.exists(src_audio_ogg):
-            audio_ext = ".ogg"
-        elif os.path.exists(src_audio_wav):
-            audio_ext = ".wav"
-        else:
-            raise FileNotFoundError(f"音频文件不存在: {src_audio_ogg} 或 {src_audio_wav}")
-
-        id_str = calculate_id(song_info["song_id"])
-        duration = get_audio_duration(chart_id)
-        meta_str = generate_meta_str(song_info, difficulty, duration, id_str, audio_ext)
-        notes = convert_vsb_to_notes(vsb_data)
-        final_json = build_final_json(meta_str, notes)
-        output_subdir = os.path.join(OUTPUT_DIR, chart_id, difficulty.replace(".json", ""))
-        os.makedirs(output_subdir, exist_ok=True)
-        output_json_path = os.path.join(output_subdir, f"{id_str}.json")
-        with open(output_json_path, 'w', encoding='utf-8') as f:
-            f.write(final_json)
-        info_content = generate_info_txt(song_info, difficulty, id_str, duration, audio_ext)
-        with open(os.path.join(output_subdir, "info.txt"), 'w', encoding='utf-8') as f:
-            f.write(info_content)
-        copy_resource_files(output_subdir, chart_id, id_str, audio_ext)
-        pez_path = os.path.join(OUTPUT_DIR, chart_id, f"{sanitize(song_info['formatted_name'].replace('#', r' '))} - {difficulty.replace('.json', '')}.pez")
-        compress_folder_to_pez(output_subdir, pez_path)
-        return True
+        convert_vsb_to_notes(read_vsb_notes(vsb_path), issues)
     except Exception as e:
-        print(f"  失败: {str(e)}")
-        return False
+        issues.append({"level": "error", "code": "exception", "time": None, "lanes": [], "message": str(e)})
+    for issue in issues:
+        issue["chart_id"] = chart_id
+        issue["difficulty"] = difficulty
+    return issues
+
+
+def find_lint_targets(charts_dir=CHARTS_DIR):
+    targets = []
+    for root, dirs, files in os.walk(charts_dir):
+        chart_id = os.path.relpath(root, charts_dir)
+        if chart_id == '.':
+            continue
+        for diff_file in DIFFICULTY_MAP:
+            difficulty = diff_file.replace(".json", "")
+            if f"{difficulty}.vsb" in files:
+                targets.append((chart_id, difficulty, os.path.join(root, f"{difficulty}.vsb")))
+    targets.sort()
+    return targets
+
+
+def lint_library(charts_dir=CHARTS_DIR, workers=None):
+    targets = find_lint_targets(charts_dir)
+    if not targets:
+        return [], 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lint_chart, *zip(*targets), chunksize=16)
+        issues = [issue for chart_issues in results for issue in chart_issues]
+    return issues, len(targets)
+
+
+def lint_main():
+    # 只做音符分析, 不渲染图片、不复制音频、不打包
+    if not os.path.isdir(CHARTS_DIR):
+        print(f"错误: 找不到Charts目录: {CHARTS_DIR}")
+        return 1
+
+    issues, total = lint_library()
+    errors = [i for i in issues if i["level"] == "error"]
+    for issue in issues:
+        time_str = f"{issue['time']:.0f}ms" if issue["time"] is not None else "-"
+        print(f"  [{issue['level']}] {issue['chart_id']}/{issue['difficulty']} @ {time_str}: "
+              f"{issue.get('message', issue['code'])}")
+
+    with open(LINT_REPORT_PATH, 'w', encoding='utf-8') as f:
+        json.dump({"charts": total, "issues": issues}, f, indent=2, ensure_ascii=False)
 
+    print("=" * 60)
+    print(f"检查完成: 谱面{total} | 错误{len(errors)} | 警告{len(issues) - len(errors)}")
+    print(f"报告: {LINT_REPORT_PATH}")
+    return 1 if errors else 0
+
+
+def main(shard=None, output_dir=None, sink="dir", sink_path=None, asset_cache=None,
+         asset_cache_bytes=DEFAULT_MAX_BYTES, stream_notes=False, workers=None, cover_profile=None,
+         cover_workers=None):
+    if not output_dir and shard is not None:
+        # 每个分片写到自己的输出根目录
+        output_dir = os.path.join(OUTPUT_DIR, shard_dir_name(shard))
+    store = AssetStore(asset_cache, asset_cache_bytes) if asset_cache else None
+    context = ConversionContext(output_dir=output_dir, asset_store=store, stream_notes=stream_notes,
+                                cover_profile=cover_profile)
+    output_dir = context.output_dir
 
-def main():
     print("加载song_information.json...")
     try:
-        song_info_dict = load_song_info()
+        song_info_dict = context.song_info
         print(f"加载了 {len(song_info_dict)} 个曲目信息")
     except Exception as e:
         print(f"元数据加载失败: {e}")
         return
 
-    if not os.path.exists(SPRITE_DIR):
-        print(f"警告: Sprites目录不存在: {SPRITE_DIR}，将只能使用black.png作为封面")
+    if not os.path.exists(context.sprite_dir):
+        print(f"警告: Sprites目录不存在: {context.sprite_dir}，将只能使用black.png作为封面")
 
     print("\n扫描谱面文件...")
-    if not os.path.exists(VSB_JSON_DIR):
-        print(f"错误: 找不到vsbjson目录: {VSB_JSON_DIR}")
+    if not os.path.exists(context.vsb_json_dir):
+        print(f"错误: 找不到vsbjson目录: {context.vsb_json_dir}")
         return
 
     total_files = 0
     success_files = 0
     failed_files = 0
-
-    for chart_id in os.listdir(VSB_JSON_DIR):
-        chart_path = os.path.join(VSB_JSON_DIR, chart_id)
-        if not os.path.isdir(chart_path):
-            continue
-
-        if chart_id not in song_info_dict:
-            print(f"\n跳过: {chart_id} (无元数据)")
+    built_charts = []
+    failures = []
+
+    # 先列出所有待处理的难度, 以便计算进度和剩余时间
+    jobs = []
+    for chart_id in sorted(os.listdir(context.vsb_json_dir)):
+        chart_path = os.path.join(context.vsb_json_dir, chart_id)
+        if not os.path.isdir(chart_path) or not in_shard(chart_id, shard):
             continue
-
-        song_info = song_info_dict[chart_id]
-        print(f"\n\n处理曲目: {song_info.get('formatted_name', chart_id)} (ID: {chart_id})")
-
-        for diff_file in DIFFICULTY_MAP.keys():
-            vsb_file_path = os.path.join(chart_path, diff_file)
-            diff_pez = diff_file.replace(".json", ".pez")
-
-            if diff_file == "ENCORE.json" and not os.path.exists(vsb_file_path):
-                print(f"  {diff_pez} (无)", end="")
+        jobs.append((chart_id, chart_path, set(os.listdir(chart_path))))
+
+    # 转换前一次性报告缺失的资源
+    missing = context.assets.missing_report(chart_id for chart_id, _, _ in jobs)
+    print(f"资源目录: {len(context.assets)} 个音频, {len(context.assets.sprites)} 个封面")
+    if missing["audio"]:
+        print(f"缺少音频 ({len(missing['audio'])}): {', '.join(missing['audio'])}")
+    if missing["sprite"]:
+        print(f"缺少封面, 将使用black.png ({len(missing['sprite'])}): {', '.join(missing['sprite'])}")
+    missing_audio = set(missing["audio"])
+
+    METRICS.reset()
+
+    # 封面只取决于曲绘, 各曲目先在线程池中批量渲染一次, 各难度转换时只链接
+    sprite_paths = [context.assets.sprite(chart_id) for chart_id, _, _ in jobs
+                    if chart_id in song_info_dict and chart_id not in missing_audio]
+    started = time.perf_counter()
+    with METRICS.stage("covers"):
+        failed_covers = context.covers.render_many(sprite_paths, cover_workers)
+    print(f"封面: {len(set(sprite_paths))} 张, 用时{time.perf_counter() - started:.1f}s"
+          + (f", 合成失败{failed_covers}" if failed_covers else ""))
+
+    progress = Progress(sum(len(files & DIFFICULTY_MAP.keys()) for _, _, files in jobs), "难度")
+
+    def record_result(chart_id, diff_file, result, prefix=""):
+        nonlocal success_files, failed_files
+        for warning in result.warnings:
+            print(f"{prefix}警告: {warning}")
+        if result.ok:
+            success_files += 1
+        else:
+            print(f"{prefix}  失败: {result.error}")
+            failed_files += 1
+            failures.append({"chart_id": chart_id, "difficulty": diff_file.replace(".json", "")})
+        progress.advance()
+
+    # workers>1时在进程池中转换, 曲目信息和底图只在这里加载一次, 通过共享内存交给工作进程
+    shared = pool = None
+    futures = {}
+    if workers and workers > 1:
+        shared = SharedAssets.publish(song_info_dict, context.base_image)
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_convert_worker,
+                                   initargs=(shared.handle, output_dir, asset_cache, asset_cache_bytes, stream_notes,
+                                             context.cover_profile, context.covers.shared_dir()))
+
+    # bundle的中央目录在close时写出, 中断时也要关闭
+    context.sink = make_sink(sink, output_dir, sink_path)
+    try:
+        for chart_id, chart_path, chart_files in jobs:
+            if chart_id not in song_info_dict:
+                print(f"\n跳过: {chart_id} (无元数据)")
+                progress.advance(len(chart_files & DIFFICULTY_MAP.keys()))
                 continue
 
-            if not os.path.exists(vsb_file_path):
-                print(f"  {diff_pez} (无)", end="")
+            if chart_id in missing_audio:
+                # 没有音频的曲目所有难度都会失败, 不再逐个转换
+                print(f"\n跳过: {chart_id} (无音频)")
+                for diff_file in DIFFICULTY_MAP.keys() & chart_files:
+                    total_files += 1
+                    failed_files += 1
+                    failures.append({"chart_id": chart_id, "difficulty": diff_file.replace(".json", "")})
+                METRICS.inc("missing_audio")
+                progress.advance(len(chart_files & DIFFICULTY_MAP.keys()))
                 continue
 
-            total_files += 1
-            print(f"  {diff_pez} √ ", end="")
-
-            if process_single_chart(vsb_file_path, chart_id, diff_file, song_info):
-                success_files += 1
-            else:
-                failed_files += 1
+            song_info = song_info_dict[chart_id]
+            built_charts.append(chart_id)
+            METRICS.inc("charts")
+            print(f"\n\n处理曲目: {song_info.get('formatted_name', chart_id)} (ID: {chart_id})")
+
+            for diff_file in DIFFICULTY_MAP.keys():
+                vsb_file_path = os.path.join(chart_path, diff_file)
+                diff_pez = diff_file.replace(".json", ".pez")
+
+                if diff_file not in chart_files:
+                    print(f"  {diff_pez} (无)", end="")
+                    continue
+
+                total_files += 1
+                METRICS.inc("difficulties")
+                print(f"  {diff_pez} √ ", end="")
+
+                if pool is not None:
+                    future = pool.submit(_convert_in_worker, vsb_file_path, chart_id, diff_file)
+                    futures[future] = (chart_id, diff_file)
+                    continue
+                record_result(chart_id, diff_file, context.convert_file(vsb_file_path, chart_id, diff_file, song_info))
+
+            print(f"  {progress.line()}", end="")
+
+        if futures:
+            print("\n")
+        for future in as_completed(futures):
+            chart_id, diff_file = futures[future]
+            result, worker_metrics = future.result()
+            METRICS.merge(worker_metrics)
+            if result.ok:
+                # 工作进程只生成staging目录, 打包到sink在这里串行进行
+                try:
+                    with METRICS.stage("package"):
+                        output, size = context.sink.write(chart_id, diff_file,
+                                                          get_pez_name(diff_file, song_info_dict[chart_id]),
+                                                          result.output)
+                    METRICS.inc("bytes_written", size)
+                    METRICS.inc("difficulties_succeeded")
+                    result = result._replace(output=output)
+                except Exception as e:
+                    shutil.rmtree(result.output, ignore_errors=True)
+                    METRICS.inc("difficulties_failed")
+                    result = result._replace(ok=False, output=None, error=f"{type(e).__name__}: {e}")
+            record_result(chart_id, diff_file, result, f"  {chart_id}/{diff_file.replace('.json', '')} ")
+            print(f"  {'✓' if result.ok else '✗'} {chart_id}/{diff_file.replace('.json', '')} {progress.line()}")
+    finally:
+        context.sink.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+            shared.close()
+        context.close()
+
+    if store is not None:
+        METRICS.inc("asset_cache_hits", store.hits)
+        METRICS.inc("asset_cache_misses", store.misses)
+        hits = METRICS.counters.get("asset_cache_hits", 0)
+        misses = METRICS.counters.get("asset_cache_misses", 0)
+        print(f"\n资源缓存: 命中{hits} | 未命中{misses} | {store.total_bytes() / 1048576:.1f} MiB")
+        store.close()
+
+    metrics_paths = METRICS.write(output_dir)
+
+    if shard is not None:
+        write_summary(output_dir, {
+            "shard": list(shard), "charts": built_charts,
+            "total": total_files, "success": success_files, "failed": failed_files, "failures": failures,
+        })
 
     print("\n" + "=" * 60)
     print(f"转换完成: 总计{total_files} | 成功{success_files} | 失败{failed_files}")
-    print(f"输出目录: {OUTPUT_DIR}")
+    print(f"输出目录: {output_dir}")
+    print(f"运行指标: {metrics_paths[0]} / {metrics_paths[1]}")
     print("=" * 60)
 
 
 if __name__ == '__main__':
-    main()
+    arg_parser = argparse.ArgumentParser(description="vsbjson -> pez")
+    arg_parser.add_argument("mode", nargs="?", choices=["build", "lint"], default="build")
+    arg_parser.add_argument("--shard", type=parse_shard, help="只构建第i个分片(共N个), 格式 i/N")
+    arg_parser.add_argument("--output-dir", help="输出目录, 默认pezOutput(分片时为pezOutput/shard-i-of-N)")
+    arg_parser.add_argument("--sink", choices=SINK_KINDS, default="dir",
+                            help=f"dir: 每个pez一个文件; bundle: 单个{BUNDLE_NAME}; sqlite: 单个{SQLITE_NAME}")
+    arg_parser.add_argument("--sink-path", help="bundle/sqlite库的路径, 默认在输出目录下")
+    arg_parser.add_argument("--asset-cache", help="音频和合成封面的缓存目录, 多次构建之间共用")
+    arg_parser.add_argument("--asset-cache-mb", type=int, default=DEFAULT_MAX_BYTES // 1048576,
+                            help="缓存大小上限, 超出时淘汰最久未用的对象")
+    arg_parser.add_argument("--workers", type=int,
+                            help="转换进程数; 曲目信息和底图通过共享内存交给各进程, 默认在当前进程中转换")
+    arg_parser.add_argument("--stream", action="store_true",
+                            help="音符按时间顺序逐个写入谱面JSON, 长谱面内存占用更低")
+    arg_parser.add_argument("--cover-profile", choices=sorted(COVER_PROFILES), default=DEFAULT_COVER_PROFILE,
+                            help="封面PNG编码档位: legacy与之前相同; fast无损且编码更快; small/compact量化为256色, "
+                                 "compact再把底图缩小一半")
+    arg_parser.add_argument("--cover-workers", type=int, help="批量渲染封面的线程数")
+    args = arg_parser.parse_args()
+
+    if args.mode == 'lint':
+        sys.exit(lint_main())
+    main(args.shard, args.output_dir, args.sink, args.sink_path, args.asset_cache, args.asset_cache_mb * 1048576,
+         args.stream, args.workers, args.cover_profile, args.cover_workers)
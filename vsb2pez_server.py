@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import vsb2pez
+from metrics import METRICS
+from asset_store import AssetStore
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 51571
+NOTE_CACHE_SIZE = 64
+
+
+class NoteCache:
+    """最近转换过的谱面, 以(路径, mtime, 大小)为键, 谱面被修改后自然失效
+
+    load返回(vsb数据, 音符列表); load_data只返回vsb数据, 供--stream使用, 不转换音符.
+    """
+
+    def __init__(self, max_size=NOTE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, vsb_path, need_notes):
+        st = os.stat(vsb_path)
+        key = (vsb_path, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None and (value[1] is not None or not need_notes):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                METRICS.inc("note_cache_hits")
+                return value
+            self.misses += 1
+            METRICS.inc("note_cache_misses")
+
+        if value is not None:
+            # 之前只读过vsb数据
+            value = (value[0], vsb2pez.convert_vsb_to_notes(value[0]))
+        elif need_notes:
+            value = vsb2pez.load_chart_notes(vsb_path)
+        else:
+            value = (vsb2pez.load_vsb_data(vsb_path), None)
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def load(self, vsb_path):
+        return self._get(vsb_path, True)
+
+    def load_data(self, vsb_path):
+        return self._get(vsb_path, False)[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ConversionServer:
+    """常驻进程: 一个ConversionContext, 曲目信息、底图、音频时长和音符缓存只加载一次"""
+
+    def __init__(self, context=None, asset_store=None, stream_notes=False):
+        self.note_cache = NoteCache()
+        self.context = context or vsb2pez.ConversionContext(note_loader=self.note_cache.load, asset_store=asset_store,
+                                                            stream_notes=stream_notes,
+                                                            data_loader=self.note_cache.load_data)
+        # 预热
+        self.context.song_info
+        self.context.base_image
+        self.context.assets
+        self.started = time.time()
+        self.builds = 0
+        self._lock = threading.Lock()
+
+    def reload(self):
+        self.context.reload()
+        self.note_cache.clear()
+        return {"ok": True, "songs": len(self.context.song_info)}
+
+    def build(self, chart_id, difficulty):
+        result = self.context.convert(chart_id, difficulty)
+        # 多个处理线程同时构建
+        with self._lock:
+            self.builds += 1
+        return {
+            "ok": result.ok,
+            "chart_id": result.chart_id,
+            "difficulty": result.difficulty,
+            "pez": result.output,
+            "notes": result.notes,
+            "error": result.error,
+            "warnings": result.warnings,
+            "elapsed": round(result.elapsed, 4),
+        }
+
+    def status(self):
+        status = {
+            "ok": True,
+            "uptime": round(time.time() - self.started, 1),
+            "songs": len(self.context.song_info),
+            "builds": self.builds,
+            "note_cache": {"size": len(self.note_cache.entries),
+                           "hits": self.note_cache.hits, "misses": self.note_cache.misses},
+        }
+        store = self.context.asset_store
+        if store is not None:
+            status["asset_cache"] = {"bytes": store.total_bytes(), "hits": store.hits, "misses": store.misses}
+        return status
+
+    def handle(self, request):
+        action = request.get("action", "build")
+        try:
+            if action == "build":
+                return self.build(request["chart_id"], request["difficulty"])
+            if action == "status":
+                return self.status()
+            if action == "reload":
+                return self.reload()
+            return {"ok": False, "error": f"未知操作: {action}"}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+
+def make_http_handler(server_state):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, result):
+            body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+            self.send_response(200 if result.get("ok") else 400)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = METRICS.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self._reply(server_state.handle({"action": self.path.strip('/') or "status"}))
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError as e:
+                self._reply({"ok": False, "error": f"请求不是合法JSON: {e}"})
+                return
+            request.setdefault("action", self.path.strip('/') or "build")
+            self._reply(server_state.handle(request))
+
+        def log_message(self, format, *args):
+            print(f"[{self.log_date_time_string()}] {format % args}")
+
+    return Handler
+
+
+def make_unix_handler(server_state):
+    # 每行一个JSON请求, 每行一个JSON响应
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    result = server_state.handle(json.loads(line))
+                except ValueError as e:
+                    result = {"ok": False, "error": f"请求不是合法JSON: {e}"}
+                self.wfile.write(json.dumps(result, ensure_ascii=False).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+    return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="vsb2pez 常驻转换服务")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", help="监听Unix socket而不是HTTP")
+    parser.add_argument("--asset-cache", help="音频和合成封面的缓存目录")
+    parser.add_argument("--stream", action="store_true", help="同vsb2pez.py --stream; vsb数据同样走音符缓存")
+    args = parser.parse_args(argv)
+
+    print("加载song_information.json...")
+    state = ConversionServer(asset_store=AssetStore(args.asset_cache) if args.asset_cache else None,
+                             stream_notes=args.stream)
+    print(f"加载了 {len(state.context.song_info)} 个曲目信息")
+
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+        server = socketserver.ThreadingUnixStreamServer(args.unix, make_unix_handler(state))
+        print(f"监听 unix:{args.unix}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), make_http_handler(state))
+        print(f"监听 http://{args.host}:{args.port}")
+
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        state.context.close()
+        if args.unix and os.path.exists(args.unix):
+            os.unlink(args.unix)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,33 @@
 import os
+import math
 import struct
+import argparse
 import json
 
+from sharding import in_shard, parse_shard
+from metrics import Metrics, Progress
+from vsd_parser import SkippedRange
+
 MAGIC = [0x56, 0x53, 0x43, 0x01, 0x00]
+# 音符以A0开始, 紧跟类型字段A2; 只找A0会停在浮点数据里
+NOTE_MARKER = b'\xA0\xA2'
+LANES = 4
 
 class VSBRawConverter:
-    def __init__(self, file_path):
+    def __init__(self, file_path, recover=False):
+        """recover为True时跳过无法解析的音符, 从下一个音符标记继续; 跳过的数据记在skipped中"""
         self.file_path = file_path
+        self.recover = recover
         self.offset = 0
         self.notes = []
+        self.skipped = []
         with open(file_path, 'rb') as f:
             self.buffer = f.read()
 
+    @property
+    def skipped_bytes(self):
+        return sum(s.length for s in self.skipped)
+
     def u8(self):
         val = self.buffer[self.offset]
         self.offset += 1
@@ -61,6 +77,9 @@ class VSBRawConverter:
             else:
                 raise ValueError(f'Unknown flag in note: 0x{flag:02x}')
 
+        if self.recover and not (0 <= note['lane'] < LANES and math.isfinite(note['time'])):
+            # 重新同步时可能从数据中间开始解析
+            raise ValueError(f"Implausible note: lane {note['lane']}, time {note['time']}")
         self.notes.append(note)
 
     def read(self):
@@ -71,19 +90,50 @@ class VSBRawConverter:
         self.verify(0xC0, 'notes section start')
 
         while True:
-            flag = self.u8()
-            if flag == 0xC1:
-                break
-            if flag == 0xA0:
-                self.read_note()
-            else:
-                raise ValueError(f'Unknown flag in notes section: 0x{flag:02x}')
-
-        if self.u8() not in (0xFF, 0xE0):
-            raise ValueError('Unexpected end-of-chart marker')
+            start = self.offset
+            try:
+                flag = self.u8()
+                if flag == 0xC1:
+                    break
+                if flag == 0xA0:
+                    self.read_note()
+                else:
+                    raise ValueError(f'Unknown flag in notes section: 0x{flag:02x}')
+            except (ValueError, IndexError, struct.error) as e:
+                if not self.recover:
+                    raise
+                if not self._resync(start, e):
+                    return
+
+        start = self.offset
+        try:
+            end_marker = self.u8()
+        except IndexError:
+            end_marker = None
+        if end_marker not in (0xFF, 0xE0):
+            if not self.recover:
+                raise ValueError('Unexpected end-of-chart marker')
+            # 音符都已读出, 只记录
+            self.skipped.append(SkippedRange(start, len(self.buffer) - start, 'Unexpected end-of-chart marker'))
+
+    def _resync(self, start, error):
+        # 跳到start之后的下一个音符标记; 找不到时跳过剩余数据并返回False
+        resume = self.buffer.find(NOTE_MARKER, start + 1)
+        end = resume if resume >= 0 else len(self.buffer)
+        self.skipped.append(SkippedRange(start, end - start, f'{type(error).__name__}: {error}'))
+        self.offset = end
+        return resume >= 0
+
+    def json_notes(self):
+        # 与写入vsbjson后再读回的结构一致(extra的键为字符串)
+        return [
+            {'type': n['type'], 'lane': n['lane'], 'time': n['time'],
+             'extra': {str(k): v for k, v in n['extra'].items()}}
+            for n in self.notes
+        ]
 
     @staticmethod
-    def convert_all_vsb_files():
+    def convert_all_vsb_files(shard=None, recover=False):
         current_dir = os.path.dirname(os.path.abspath(__file__))
 
         input_dir = os.path.join(current_dir, 'Charts')
@@ -100,19 +150,26 @@ class VSBRawConverter:
         total_converted = 0
         total_errors = 0
         total_notes = 0
+        metrics = Metrics("vsb_parser")
 
         print(f"开始扫描 '{input_dir}' 中的谱面文件...\n")
 
+        jobs = []
         for root, dirs, files in os.walk(input_dir):
+            dirs.sort()
             rel_path = os.path.relpath(root, input_dir)
 
-            if rel_path == '.':
+            if rel_path == '.' or not in_shard(rel_path, shard):
                 continue
 
             found_files = [f for f in target_files if f in files]
-            if not found_files:
-                continue
+            if found_files:
+                jobs.append((root, rel_path, found_files))
+
+        progress = Progress(sum(len(found_files) for _, _, found_files in jobs), "文件")
 
+        for root, rel_path, found_files in jobs:
+            metrics.inc("charts")
             output_subdir = os.path.join(output_dir, rel_path)
             os.makedirs(output_subdir, exist_ok=True)
 
@@ -124,31 +181,61 @@ class VSBRawConverter:
                 output_path = os.path.join(output_subdir, output_filename)
 
                 try:
-                    converter = VSBRawConverter(input_path)
-                    converter.read()
-
-                    with open(output_path, 'w', encoding='utf-8') as f:
-                        json.dump(converter.notes, f, indent=2, ensure_ascii=False)
+                    with metrics.stage("parse"):
+                        converter = VSBRawConverter(input_path, recover)
+                        converter.read()
+                    metrics.inc("bytes_read", len(converter.buffer))
+                    if converter.skipped:
+                        for skipped in converter.skipped:
+                            print(f"  ! {target_file} 位置 {skipped.offset}: {skipped.error}, 跳过 {skipped.length} 字节")
+                        metrics.inc("files_recovered")
+                        metrics.inc("ranges_skipped", len(converter.skipped))
+                        metrics.inc("bytes_skipped", converter.skipped_bytes)
+
+                    with metrics.stage("write"):
+                        with open(output_path, 'w', encoding='utf-8') as f:
+                            json.dump(converter.notes, f, indent=2, ensure_ascii=False)
+                    metrics.inc("bytes_written", os.path.getsize(output_path))
 
                     print(f"  ✓ {target_file} -> {output_filename} ({len(converter.notes)} 个音符)")
                     total_converted += 1
                     total_notes += len(converter.notes)
+                    metrics.inc("files_succeeded")
+                    metrics.inc("notes_parsed", len(converter.notes))
 
                 except Exception as e:
                     print(f"  ✗ {target_file} 转换失败: {str(e)}")
                     total_errors += 1
+                    metrics.inc("files_failed")
+                progress.advance()
 
-            print()
+            print(f"  {progress.line()}\n")
+
+        metrics_paths = metrics.write(output_dir)
 
         print("=" * 50)
         print(f">◹ < 转换完成:")
         print(f"  成功: {total_converted} 个文件")
         print(f"  失败: {total_errors} 个文件")
         print(f"  总计解析 {total_notes} 个音符")
+        if metrics.counters.get("files_recovered"):
+            print(f"  恢复: {metrics.counters['files_recovered']} 个文件, 跳过 {metrics.counters['ranges_skipped']} 处, "
+                  f"共 {metrics.counters['bytes_skipped']} 字节")
+        print(f"  运行指标: {metrics_paths[0]} / {metrics_paths[1]}")
 
         if total_errors > 0:
             print(f"\n警告: {total_errors} 个文件转换失败，请检查错误信息")
 
 
+def read_vsb_notes(file_path, recover=False):
+    converter = VSBRawConverter(file_path, recover)
+    converter.read()
+    return converter.json_notes()
+
+
 if __name__ == '__main__':
-    VSBRawConverter.convert_all_vsb_files()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Charts/*.vsb -> vsbjson")
+    arg_parser.add_argument("--shard", type=parse_shard, help="只解析第i个分片(共N个), 格式 i/N")
+    arg_parser.add_argument("--recover", action="store_true", help="跳过损坏的音符, 从下一个音符标记继续解析")
+    args = arg_parser.parse_args()
+    VSBRawConverter.convert_all_vsb_files(args.shard, args.recover)
\ No newline at end of file
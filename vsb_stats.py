@@ -0,0 +1,171 @@
+import os
+import sys
+import math
+import json
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List
+
+import numpy as np
+
+from vsb_parser import read_vsb_notes
+from vsb2pez import convert_vsb_to_notes
+from vsm_parser import TempoMap
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CHARTS_DIR = os.path.join(BASE_DIR, "Charts")
+REPORT_PATH = os.path.join(BASE_DIR, "stats_report.json")
+
+# 与.stats中同名、必须完全一致的计数; 全部由解码后的.vsb计算, 不取.stats中的值
+# (peakDensity等密度指标的计算口径未知, 无法复现, 不做校验)
+COUNT_KEYS = [
+    "noteCount", "normalNotes", "bumpers", "leftBumpers", "rightBumpers",
+    "holdNotes", "holdPieces", "multiNoteCount", "multiHoldNoteCount",
+]
+
+# vsb时间按毫秒取整, hold长度先对齐到1/16拍
+HOLD_BEAT_GRID = 16
+
+
+def parse_stats_file(path) -> Dict[str, Dict[str, Any]]:
+    sections = {}
+    current = sections.setdefault("", {})
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                current = sections.setdefault(line[1:-1], {})
+                continue
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+            value = value.strip().strip('"')
+            try:
+                current[key.strip()] = float(value)
+            except ValueError:
+                current[key.strip()] = value
+    return sections
+
+
+def note_arrays(notes):
+    types = np.fromiter((n['type'] for n in notes), dtype=np.int8, count=len(notes))
+    lanes = np.fromiter((n['lane'] for n in notes), dtype=np.int8, count=len(notes))
+    times = np.fromiter((n['time'] for n in notes), dtype=np.float64, count=len(notes))
+    return types, lanes, times
+
+
+def count_hold_pieces(notes, tempo: TempoMap) -> int:
+    """hold头尾之间(不含)每拍一个判定点, 拍从hold头起算"""
+    pieces = 0
+    for note in notes:
+        if note['type'] != 2:
+            continue
+        end = int(note['extra']['1'])
+        beats = tempo.ms_to_beat(end) - tempo.ms_to_beat(note['time'])
+        beats = round(beats * HOLD_BEAT_GRID) / HOLD_BEAT_GRID
+        pieces += max(math.ceil(beats) - 1, 0)
+    return pieces
+
+
+def compute_chart_stats(notes) -> Dict[str, int]:
+    types, lanes, times = note_arrays(notes)
+
+    normal = types == 0
+    bumper = (types == 1) | (types == 8)
+    hold = types == 2
+    playable = normal | bumper | hold
+
+    stats = {
+        "normalNotes": int(normal.sum()),
+        "bumpers": int(bumper.sum()),
+        "leftBumpers": int((bumper & (lanes == 0)).sum()),
+        "rightBumpers": int((bumper & (lanes == 2)).sum()),
+        "holdNotes": int(hold.sum()),
+        "mines": int(((types == 6) | (types == 7)).sum()),
+    }
+    stats["holdPieces"] = count_hold_pieces(notes, TempoMap.from_vsb_notes(notes))
+    # Hold头尾各算一个, 再加中间的判定点
+    stats["noteCount"] = stats["normalNotes"] + stats["bumpers"] + 2 * stats["holdNotes"] + stats["holdPieces"]
+
+    _, counts = np.unique(times[playable], return_counts=True)
+    stats["multiNoteCount"] = int((counts > 1).sum())
+    _, hold_counts = np.unique(times[hold], return_counts=True)
+    stats["multiHoldNoteCount"] = int((hold_counts > 1).sum())
+    return stats
+
+
+def check_chart(stats_path, charts_dir=CHARTS_DIR) -> Dict[str, Any]:
+    chart_dir, stats_file = os.path.split(stats_path)
+    difficulty = os.path.splitext(stats_file)[0]
+    result = {
+        # 与find_lint_targets、chart_index相同, 取相对Charts的路径
+        "chart_id": os.path.relpath(chart_dir, charts_dir),
+        "difficulty": difficulty,
+        "mismatches": {},
+        "error": None,
+    }
+    try:
+        expected = parse_stats_file(stats_path).get("stats", {})
+        vsb_path = os.path.join(chart_dir, f"{difficulty}.vsb")
+        notes = read_vsb_notes(vsb_path)
+        actual = compute_chart_stats(notes)
+
+        for key in COUNT_KEYS:
+            if key in expected and int(expected[key]) != actual[key]:
+                result["mismatches"][key] = {"expected": int(expected[key]), "actual": actual[key]}
+        # 转换后的真音符数应等于 Chip + Bumper + Hold
+        converted = sum(1 for n in convert_vsb_to_notes(notes) if not n['isFake'])
+        playable = actual["normalNotes"] + actual["bumpers"] + actual["holdNotes"]
+        if converted != playable:
+            result["mismatches"]["convertedNotes"] = {"expected": playable, "actual": converted}
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def find_stats_files(charts_dir) -> List[str]:
+    found = []
+    for root, dirs, files in os.walk(charts_dir):
+        for name in files:
+            if name.endswith('.stats') and os.path.exists(os.path.join(root, name[:-6] + '.vsb')):
+                found.append(os.path.join(root, name))
+    found.sort()
+    return found
+
+
+def check_library(charts_dir=CHARTS_DIR, workers=None) -> List[Dict[str, Any]]:
+    stats_files = find_stats_files(charts_dir)
+    if not stats_files:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(check_chart, stats_files, [charts_dir] * len(stats_files), chunksize=16))
+
+
+def main():
+    if not os.path.isdir(CHARTS_DIR):
+        print(f"错误: 找不到Charts目录: {CHARTS_DIR}")
+        return 1
+
+    print(f"校验 '{CHARTS_DIR}' 中的.stats...")
+    results = check_library()
+
+    bad = [r for r in results if r["mismatches"] or r["error"]]
+    for r in bad:
+        print(f"  ✗ {r['chart_id']}/{r['difficulty']}", end="")
+        if r["error"]:
+            print(f" 失败: {r['error']}")
+            continue
+        print(" " + ", ".join(f"{k}: {v['expected']} != {v['actual']}" for k, v in r["mismatches"].items()))
+
+    with open(REPORT_PATH, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    print("=" * 50)
+    print(f"校验完成: 总计{len(results)} | 一致{len(results) - len(bad)} | 不一致{len(bad)}")
+    print(f"报告: {REPORT_PATH}")
+    return 1 if bad else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
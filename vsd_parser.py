@@ -1,7 +1,16 @@
 import struct
 import json
+import argparse
 from pathlib import Path
-from typing import List, Dict, Any
+from collections import namedtuple
+from typing import List, Dict, Any, Iterator, Optional
+
+RECORD_MARKER = b'\xA0\xA2\xB2'
+END_MARKER = 0xFF
+_RESYNC_CHUNK = 1 << 16
+
+# 恢复模式下跳过的一段数据: 起始偏移、字节数、原因
+SkippedRange = namedtuple('SkippedRange', ['offset', 'length', 'error'])
 
 
 class VSDParser:
@@ -13,12 +22,19 @@ class VSDParser:
         12: "unlock_id", 13: "preview_start_time", 14: "preview_end_time",
     }
 
-    def __init__(self, filepath: Path):
+    def __init__(self, filepath: Path, recover: bool = False):
+        """recover为True时, 解析失败的记录被跳过, 从下一个记录标记A0 A2 B2继续; 跳过的数据记在skipped中"""
         self.filepath = filepath
+        self.recover = recover
         self.buf = None
         self.position = 0
         self.unknown_field_ids = set()
         self.difficulties = []  # [(display, constant, designer)]
+        self.skipped: List[SkippedRange] = []
+
+    @property
+    def skipped_bytes(self) -> int:
+        return sum(s.length for s in self.skipped)
 
     def read_bytes(self, n: int) -> bytes:
         data = self.buf.read(n)
@@ -43,6 +59,9 @@ class VSDParser:
             if byte[0] == 0:
                 break
             result.extend(byte)
+        if self.recover and RECORD_MARKER in result:
+            # 前一个字段损坏, 字符串读进了下一条记录
+            raise ValueError("字符串中出现记录标记")
         return result.decode('utf-8', errors='replace')
 
     def parse_record(self) -> Dict[str, Any]:
@@ -65,6 +84,13 @@ class VSDParser:
                 self.read_bytes(1)
                 break
 
+            if self.recover and peek[0] == 0xA0:
+                # 结束标记损坏时不把下一条记录当作字段读进来
+                ahead = self.buf.read(len(RECORD_MARKER))
+                if ahead == RECORD_MARKER:
+                    raise ValueError("记录缺少结束标记A1")
+                self.buf.seek(-len(ahead), 1)
+
             # 类型标记
             type_byte = self.read_u8()
 
@@ -110,6 +136,10 @@ class VSDParser:
         return record
 
     def parse_file(self) -> List[Dict[str, Any]]:
+        return list(self.iter_records())
+
+    def iter_records(self) -> Iterator[Dict[str, Any]]:
+        # 逐条产出, 调用方可以在整个文件解析完之前使用已解析的记录
         with open(self.filepath, "rb") as f:
             self.buf = f
 
@@ -119,26 +149,56 @@ class VSDParser:
 
             print(f"VSD文件头: VSD v1.{header[4]}")
 
-            records = []
             while True:
                 pos = self.buf.tell()
                 peek = self.buf.read(1)
-                if not peek or peek[0] != 0xA0:
+                if not peek or peek[0] == END_MARKER or (peek[0] != 0xA0 and not self.recover):
+                    # FF之后是文件尾部数据, 不是记录
                     break
                 self.buf.seek(pos)
 
-                try:
-                    record = self.parse_record()
-                    records.append(record)
-                except Exception as e:
-                    print(f"解析失败 (位置: {pos}): {e}")
+                if peek[0] != 0xA0:
+                    error = f"记录之间出现0x{peek[0]:02x}"
+                else:
+                    try:
+                        record = self.parse_record()
+                    except Exception as e:
+                        print(f"解析失败 (位置: {pos}): {e}")
+                        if not self.recover:
+                            break
+                        error = str(e)
+                    else:
+                        yield record
+                        continue
+
+                resume = self._find_marker(pos + 1)
+                end = resume if resume is not None else self.buf.seek(0, 2)
+                self.skipped.append(SkippedRange(pos, end - pos, error))
+                if resume is None:
+                    print(f"  位置 {pos} 之后没有记录标记, 跳过剩余 {end - pos} 字节")
                     break
-
-            return records
-
+                print(f"  跳过 {end - pos} 字节, 从位置 {resume} 继续")
+                self.buf.seek(resume)
+                self.position = resume
+
+    def _find_marker(self, start) -> Optional[int]:
+        # 分块查找, 块之间保留标记长度-1字节, 跨块的标记也能找到
+        self.buf.seek(start)
+        base, carry = start, b''
+        while True:
+            chunk = self.buf.read(_RESYNC_CHUNK)
+            if not chunk:
+                return None
+            data = carry + chunk
+            idx = data.find(RECORD_MARKER)
+            if idx >= 0:
+                return base + idx
+            carry = data[-(len(RECORD_MARKER) - 1):]
+            base += len(data) - len(carry)
 
 def process_song_information(
         input_file: str = "song_information.bin",
+        recover: bool = False,
 ):
     input_path = Path(input_file)
     output_path = Path() / "song_information.json"
@@ -151,7 +211,7 @@ def process_song_information(
     print(f"文件大小: {input_path.stat().st_size} 字节")
 
     try:
-        parser = VSDParser(input_path)
+        parser = VSDParser(input_path, recover)
         songs = parser.parse_file()
 
         output_path.parent.mkdir(parents=True, exist_ok=True)
@@ -165,6 +225,11 @@ def process_song_information(
         if parser.unknown_field_ids:
             print(f"\n未知字段ID: {sorted(parser.unknown_field_ids)}")
 
+        if parser.skipped:
+            print(f"\n跳过 {len(parser.skipped)} 处损坏记录, 共 {parser.skipped_bytes} 字节:")
+            for skipped in parser.skipped:
+                print(f"  位置 {skipped.offset}: {skipped.length} 字节 ({skipped.error})")
+
         return songs
 
     except Exception as e:
@@ -175,4 +240,9 @@ def process_song_information(
 
 
 if __name__ == "__main__":
-    process_song_information()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="song_information.bin -> song_information.json")
+    arg_parser.add_argument("input", nargs="?", default="song_information.bin")
+    arg_parser.add_argument("--recover", action="store_true",
+                            help="跳过损坏的记录, 从下一个记录标记继续解析")
+    args = arg_parser.parse_args()
+    process_song_information(args.input, args.recover)
@@ -0,0 +1,284 @@
+import bisect
+import math
+import os
+from collections import namedtuple
+from fractions import Fraction
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# 一行补间: time,duration,easing,id,value,property,flag (time/duration单位为拍)
+Tween = namedtuple('Tween', ['obj', 'time', 'duration', 'easing', 'target_id', 'value', 'prop', 'flag'])
+
+
+def _ease_in_out(f):
+    return lambda x: f(2 * x) / 2 if x < 0.5 else 1 - f(2 - 2 * x) / 2
+
+
+def _ease_out(f):
+    return lambda x: 1 - f(1 - x)
+
+
+_IN_CURVES = {
+    'sine': lambda x: 1 - math.cos(x * math.pi / 2),
+    'quad': lambda x: x ** 2,
+    'cubic': lambda x: x ** 3,
+    'quart': lambda x: x ** 4,
+    'quint': lambda x: x ** 5,
+    'expo': lambda x: 0.0 if x == 0 else 2 ** (10 * x - 10),
+    'circ': lambda x: 1 - math.sqrt(max(0.0, 1 - x ** 2)),
+}
+
+# RPE easingType编号
+_RPE_EASING_IDS = {
+    'sine': (3, 2, 6), 'quad': (5, 4, 7), 'cubic': (9, 8, 12), 'quart': (11, 10, 13),
+    'quint': (15, 14, None), 'expo': (17, 16, None), 'circ': (19, 18, 22),
+}
+
+# easing名(小写) -> (RPE easingType, 缓动函数)
+EASINGS = {'linear': (1, lambda x: x)}
+for _name, _curve in _IN_CURVES.items():
+    _in_id, _out_id, _io_id = _RPE_EASING_IDS[_name]
+    EASINGS[f'in{_name}'] = (_in_id, _curve)
+    EASINGS[f'out{_name}'] = (_out_id, _ease_out(_curve))
+    if _io_id is not None:
+        EASINGS[f'inout{_name}'] = (_io_id, _ease_in_out(_curve))
+
+# vsm属性 -> (RPE事件列表, 缩放, 基准值)
+# 生成的事件层叠加在模板第0层之上, 基准值是第0层已经提供的部分
+PROPERTY_EVENT_MAP = {
+    'pra': ('alphaEvents', 255.0, 255.0),
+    'prx': ('moveXEvents', 1.0, 0.0),
+    'pry': ('moveYEvents', 1.0, 0.0),
+    'prr': ('rotateEvents', 1.0, 0.0),
+}
+
+
+def get_easing(name: str):
+    return EASINGS.get(name.lower(), EASINGS['linear'])
+
+
+class PropertyTimeline:
+    """单个属性编译后的时间线: 按时间排序且互不重叠的分段, 以分段起点做区间索引"""
+
+    def __init__(self, initial=None):
+        self.initial = initial
+        self.starts = []  # 分段起点(拍), bisect索引
+        self.segments = []  # (start, end, stop, v0, v1, easing) stop为被后续补间截断的位置
+
+    def _value_in(self, segment, t):
+        start, end, stop, v0, v1, easing = segment
+        if end <= start:
+            return v1
+        x = (min(t, stop) - start) / (end - start)
+        return v0 + (v1 - v0) * get_easing(easing)[1](min(max(x, 0.0), 1.0))
+
+    def append(self, tween: Tween):
+        # 需按时间顺序追加; 与上一段重叠时截断上一段, 本段从截断处的值开始
+        start = tween.time
+        end = start + max(tween.duration, 0.0)
+        if self.segments:
+            prev = self.segments[-1]
+            v0 = self._value_in(prev, start)
+            if prev[2] > start:
+                self.segments[-1] = prev[:2] + (start,) + prev[3:]
+        else:
+            v0 = tween.value if self.initial is None else self.initial
+        if tween.duration <= 0:
+            v0 = tween.value
+        self.starts.append(start)
+        self.segments.append((start, end, end, v0, tween.value, tween.easing))
+
+    def value_at(self, t):
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i < 0:
+            return self.initial if self.initial is not None else self.segments[0][3]
+        return self._value_in(self.segments[i], t)
+
+    def __len__(self):
+        return len(self.segments)
+
+
+class TempoMap:
+    """拍 -> 毫秒, BPM取自type 3音符(extra[1])"""
+
+    def __init__(self, changes: Iterable[Tuple[float, float]]):
+        self.beats = []
+        self.times = []
+        self.bpms = []
+        beat = 0.0
+        for time_ms, bpm in sorted(changes):
+            if bpm <= 0:
+                continue
+            if self.times:
+                beat += (time_ms - self.times[-1]) * self.bpms[-1] / 60000
+            elif time_ms > 0:
+                # 第一个BPM之前的部分按同一BPM外推
+                beat = time_ms * bpm / 60000
+            self.beats.append(beat)
+            self.times.append(time_ms)
+            self.bpms.append(bpm)
+        if not self.bpms:
+            self.beats, self.times, self.bpms = [0.0], [0.0], [120.0]
+
+    @classmethod
+    def from_vsb_notes(cls, vsb_data):
+        changes = []
+        for note in vsb_data:
+            if note['type'] != 3:
+                continue
+            extra = note.get('extra', {})
+            bpm = extra.get('1', extra.get(1))
+            if bpm:
+                changes.append((note['time'], float(bpm)))
+        return cls(changes)
+
+    def ms_to_beat(self, time_ms):
+        i = max(bisect.bisect_right(self.times, time_ms) - 1, 0)
+        return self.beats[i] + (time_ms - self.times[i]) * self.bpms[i] / 60000
+
+    def beat_to_ms(self, beat):
+        i = max(bisect.bisect_right(self.beats, beat) - 1, 0)
+        return self.times[i] + (beat - self.beats[i]) * 60000 / self.bpms[i]
+
+
+class VSMParser:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.headers = {}
+        self.skipped_lines = 0
+
+    def iter_tweens(self) -> Iterator[Tween]:
+        # 逐行读取, 不把整个脚本读入内存
+        obj = None
+        with open(self.file_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('!'):
+                    key, _, value = line[1:].partition(':')
+                    key, value = key.strip(), value.strip()
+                    if key == 'obj':
+                        obj = value
+                    else:
+                        self.headers[key] = value
+                    continue
+
+                parts = line.split(',')
+                if len(parts) != 7:
+                    self.skipped_lines += 1
+                    continue
+                try:
+                    yield Tween(obj, float(parts[0]), float(parts[1]), parts[2], parts[3],
+                                float(parts[4]), parts[5], int(parts[6]))
+                except ValueError:
+                    self.skipped_lines += 1
+
+    def compile(self) -> Dict[Tuple[Optional[str], str], PropertyTimeline]:
+        grouped = {}
+        for tween in self.iter_tweens():
+            grouped.setdefault((tween.obj, tween.prop), []).append(tween)
+
+        timelines = {}
+        for key, tweens in grouped.items():
+            # 脚本基本有序, 稳定排序接近线性; 同一时间保持文件中的先后
+            tweens.sort(key=lambda tw: tw.time)
+            timeline = PropertyTimeline()
+            for tween in tweens:
+                timeline.append(tween)
+            timelines[key] = timeline
+        return timelines
+
+
+def _rpe_time(beat, tempo: TempoMap):
+    t = Fraction(int(tempo.beat_to_ms(beat)), 1000) + 1
+    return [int(t), t.numerator % t.denominator, t.denominator]
+
+
+def find_line_obj(timelines, property_map=None) -> Optional[str]:
+    """判定线对应的!obj: 脚本中第一个有映射属性补间的对象"""
+    if property_map is None:
+        property_map = PROPERTY_EVENT_MAP
+    # compile按补间在文件中首次出现的顺序建立时间线
+    return next((obj for obj, prop in timelines if prop in property_map), None)
+
+
+def _merge_segments(segments):
+    # 同一事件列表的分段合并后按起点排序, 与PropertyTimeline.append一样截断与后一段重叠的部分
+    segments.sort(key=lambda s: s[0])
+    merged = []
+    for segment in segments:
+        if merged and merged[-1][2] > segment[0]:
+            merged[-1] = merged[-1][:2] + (segment[0],) + merged[-1][3:]
+        merged.append(segment)
+    return merged
+
+
+def build_event_layer(timelines, tempo: TempoMap, property_map=None,
+                      line_obj=None) -> Optional[Dict[str, List[dict]]]:
+    """只取line_obj(默认find_line_obj)的补间; 其它对象的动画不属于判定线, RPE也不允许同一事件列表中重叠"""
+    if property_map is None:
+        property_map = PROPERTY_EVENT_MAP
+    if line_obj is None:
+        line_obj = find_line_obj(timelines, property_map)
+
+    grouped = {}
+    for (obj, prop), timeline in timelines.items():
+        if obj != line_obj or prop not in property_map:
+            continue
+        event_key, scale, base = property_map[prop]
+        grouped.setdefault(event_key, []).extend(segment + (scale, base) for segment in timeline.segments)
+
+    layer = {}
+    for event_key, segments in grouped.items():
+        events = layer[event_key] = []
+        for start, end, stop, v0, v1, easing, scale, base in _merge_segments(segments):
+            easing_type, curve = get_easing(easing)
+            if end > start:
+                easing_right = (stop - start) / (end - start)
+                v_stop = v0 + (v1 - v0) * curve(easing_right)
+            else:
+                easing_right = 1.0
+                v_stop = v1
+            events.append({
+                "bezier": 0,
+                "bezierPoints": [0.0, 0.0, 0.0, 0.0],
+                "easingLeft": 0.0,
+                "easingRight": easing_right,
+                "easingType": easing_type,
+                "end": v_stop * scale - base,
+                "endTime": _rpe_time(stop, tempo),
+                "linkgroup": 0,
+                "start": v0 * scale - base,
+                "startTime": _rpe_time(start, tempo),
+            })
+    return layer or None
+
+
+def load_vsm_event_layer(vsm_path, vsb_data, property_map=None, line_obj=None):
+    parser = VSMParser(vsm_path)
+    timelines = parser.compile()
+    return build_event_layer(timelines, TempoMap.from_vsb_notes(vsb_data), property_map, line_obj)
+
+
+def find_vsm_file(chart_dir, difficulty_name):
+    # 难度专属脚本优先, 否则使用GLOBAL.vsm
+    for name in (f"{difficulty_name}.vsm", "GLOBAL.vsm"):
+        path = os.path.join(chart_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+if __name__ == '__main__':
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join('Charts', 'tutorial', 'GLOBAL.vsm')
+    parser = VSMParser(path)
+    timelines = parser.compile()
+    print(f"解析: {path}")
+    print(f"判定线对象: {find_line_obj(timelines)}")
+    for (obj, prop), timeline in sorted(timelines.items(), key=lambda kv: (str(kv[0][0]), kv[0][1])):
+        print(f"  {obj}.{prop}: {len(timeline)} 段")
+    if parser.skipped_lines:
+        print(f"跳过 {parser.skipped_lines} 行无法识别的内容")